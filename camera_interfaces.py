@@ -7,11 +7,25 @@ Some useful tips for dealing with muliple cameras from this CD thread:
 
 
 ***IMPORTANT***
-To lower the exposure of the Microsoft HD3000 Lifecam install v4l2-ctl
-and run the following in a terminal
+The exposure of the Microsoft HD3000 Lifecam has to be lowered. Each usb
+camera is opened with a CaptureProfile which sets its resolution, pixel
+format (MJPG so two cameras fit in the usb bandwidth), frame rate,
+exposure, white balance and buffer size through cv2 capture properties,
+and the power line frequency (which opencv has no property for) with an
+ioctl on the camera's /dev/video device.
+A raw_yuyv profile asks for uncompressed YUYV frames instead and turns off
+opencv's conversion to BGR, so each frame keeps the raw image for the
+"yuyv" mask strategy (see mask_engine.py) as well as the BGR image we
+convert it to for drawing and saving, which is much quicker than decoding
+a jpeg. Both are buffers kept with the frame in the pool. Two
+cameras sending YUYV at 640x480 30fps may not fit on one usb bus.
+Each setting is read back to check the camera took it and the profile is
+applied again whenever the camera is reopened after failing.
 
-sudo apt-get install v4l-utils
+This used to be done by running v4l2-ctl (sudo apt-get install v4l-utils)
+before starting, which is still handy to see what the camera is set to:
 
+v4l2-ctl -d /dev/video0 --list-ctrls
 v4l2-ctl --set-fmt-video=width=640,height=480,pixelformat=1
 v4l2-ctl -d /dev/video0 -c brightness=80 -c contrast=0 -c saturation=200 -c white_balance_temperature_auto=0 -c power_line_frequency=2 -c white_balance_temperature=10000 -c sharpness=0 -c exposure_auto=1 -c exposure_absolute=5 -c pan_absolute=0 -c tilt_absolute=0 -c zoom_absolute=0; v4l2-ctl -d /dev/video1 -c brightness=80 -c contrast=0 -c saturation=200 -c white_balance_temperature_auto=0 -c power_line_frequency=2 -c white_balance_temperature=10000 -c sharpness=0 -c exposure_auto=1 -c exposure_absolute=5 -c pan_absolute=0 -c tilt_absolute=0 -c zoom_absolute=0
 
@@ -21,32 +35,166 @@ Solution was found here:
 
 Show how much USB bandwith devices are using:
     cat /sys/kernel/debug/usb/devices | grep "B: "
+
+Opening a usb camera can take a second or more, so each camera is opened
+by its own thread and they all open at the same time. test_camera waits
+(up to FIRST_FRAME_TIMEOUT) for the first frame instead of sleeping.
+
+A disabled camera is kept on standby, it keeps grabbing frames from the
+driver without decoding them so its buffers never fill up with old frames.
+get_frame never returns a frame captured before the camera was last
+enabled, so the first frame after the robot changes cameras is a new one.
+CameraSwitchTimer measures how long that first frame and the first lock
+take after the robot asks for the camera.
 '''
 
 import cv2
+import fcntl
+import numpy as np
 import time
+import struct
 import sys
 import os
 from subprocess import check_output
 import threading
 import traceback
+from frame_pool import FramePool
+
+FRAME_TIMEOUT = 2 # seconds to wait for a new frame before giving up
+FIRST_FRAME_TIMEOUT = 10 # seconds to wait for a camera to appear, open and give us its first frame
+CAMERA_REOPEN_WAIT = 0.5 # seconds between attempts to open a camera
+V4L2_MANUAL_EXPOSURE = 1 # exposure_auto=1 (manual), opencv 3.4's v4l2 backend takes raw control values like the rest of the profile
+V4L2_CID_POWER_LINE_FREQUENCY = 0x00980918 # V4L2_CID_BASE + 24, opencv has no property for it
+V4L2_POWER_LINE_60HZ = 2
+VIDIOC_G_CTRL = 0xc008561b # _IOWR('V', 27, struct v4l2_control)
+VIDIOC_S_CTRL = 0xc008561c # _IOWR('V', 28, struct v4l2_control)
+PROFILE_TOLERANCE = 0.01 # how close a setting has to read back to count as taken
+
+# The settings a usb camera is opened with, None leaves a setting as the
+# camera has it. The values are the ones v4l2-ctl used to set.
+class CaptureProfile():
+    def __init__(self, width = 640, height = 480, fourcc = "MJPG", fps = 30, exposure = 5, white_balance = 10000,\
+            buffer_size = 1, brightness = 80, contrast = 0, saturation = 200, sharpness = 0,\
+            power_line_frequency = V4L2_POWER_LINE_60HZ, raw_yuyv = False):
+        self.raw_yuyv = raw_yuyv # fourcc is YUYV and frames keep the raw image
+        if raw_yuyv:
+            fourcc = "YUYV"
+        self.width = width
+        self.height = height
+        self.fourcc = fourcc
+        self.fps = fps
+        self.exposure = exposure
+        self.white_balance = white_balance
+        self.buffer_size = buffer_size
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.sharpness = sharpness
+        self.power_line_frequency = power_line_frequency # set with an ioctl, see set_v4l2_control
+
+    # the shape of the images we process
+    def get_shape(self):
+        return (self.height, self.width, 3)
+
+    # returns (name, property, value) for each setting in the order they have
+    # to be set, the pixel format and size decide which frame rates are allowed
+    # and the exposure and white balance have to be switched to manual first
+    def get_properties(self):
+        properties = []
+        if self.fourcc is not None:
+            properties.append(("fourcc", cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc)))
+        if self.raw_yuyv:
+            properties.append(("convert_rgb", cv2.CAP_PROP_CONVERT_RGB, 0))
+        properties += [("width", cv2.CAP_PROP_FRAME_WIDTH, self.width),
+            ("height", cv2.CAP_PROP_FRAME_HEIGHT, self.height),
+            ("fps", cv2.CAP_PROP_FPS, self.fps),
+            ("buffer_size", cv2.CAP_PROP_BUFFERSIZE, self.buffer_size)]
+        if self.exposure is not None:
+            properties += [("auto_exposure", cv2.CAP_PROP_AUTO_EXPOSURE, V4L2_MANUAL_EXPOSURE),
+                ("exposure", cv2.CAP_PROP_EXPOSURE, self.exposure)]
+        if self.white_balance is not None:
+            properties += [("auto_white_balance", cv2.CAP_PROP_AUTO_WB, 0),
+                ("white_balance", cv2.CAP_PROP_WB_TEMPERATURE, self.white_balance)]
+        properties += [("brightness", cv2.CAP_PROP_BRIGHTNESS, self.brightness),
+            ("contrast", cv2.CAP_PROP_CONTRAST, self.contrast),
+            ("saturation", cv2.CAP_PROP_SATURATION, self.saturation),
+            ("sharpness", cv2.CAP_PROP_SHARPNESS, self.sharpness)]
+        return [(name, prop, value) for name, prop, value in properties if value is not None]
+
+GOAL_CAPTURE_PROFILE = CaptureProfile()
+GEAR_CAPTURE_PROFILE = CaptureProfile()
+YUYV_CAPTURE_PROFILE = CaptureProfile(raw_yuyv = True)
+
+# sets every setting in profile on cap (usb camera number id) then reads them
+# back, returns a list of (name, wanted, got) for the ones the camera didn't take
+def apply_capture_profile(cap, profile, id = None):
+    properties = profile.get_properties()
+    for name, prop, value in properties:
+        cap.set(prop, value)
+    mismatches = []
+    for name, prop, value in properties:
+        got = cap.get(prop)
+        if abs(got - value) > PROFILE_TOLERANCE * max(abs(value), 1):
+            mismatches.append((name, value, got))
+    if id is not None and profile.power_line_frequency is not None:
+        got = set_v4l2_control(id, V4L2_CID_POWER_LINE_FREQUENCY, profile.power_line_frequency)
+        if got != profile.power_line_frequency:
+            mismatches.append(("power_line_frequency", profile.power_line_frequency, got))
+    return mismatches
+
+# sets a v4l2 control which opencv has no property for on /dev/video<id>
+# the way v4l2-ctl -c does, returns what it reads back or None if it can't
+def set_v4l2_control(id, control, value):
+    try:
+        device = os.open("/dev/video%d" % id, os.O_RDWR | os.O_NONBLOCK)
+    except OSError, e:
+        print("Unable to open /dev/video%d to set control %#x: %s" % (id, control, e))
+        return None
+    try:
+        fcntl.ioctl(device, VIDIOC_S_CTRL, struct.pack("Ii", control, value))
+        return struct.unpack("Ii", fcntl.ioctl(device, VIDIOC_G_CTRL, struct.pack("Ii", control, 0)))[1]
+    except IOError, e:
+        print("Unable to set control %#x on /dev/video%d: %s" % (control, id, e))
+        return None
+    finally:
+        os.close(device)
+
+# turns a fourcc code read from a capture back into its 4 characters
+def decode_fourcc(code):
+    code = int(code)
+    return "".join(chr((code >> (8 * i)) & 0xff) for i in range(4))
 
 # handles grabbing images from a usb camera
+# images are read straight into frames from a FramePool, get_frame hands
+# out references to the newest one
 class UsbCameraInterface(threading.Thread):
-    def __init__(self, id):
+    def __init__(self, id, profile = GOAL_CAPTURE_PROFILE):
         threading.Thread.__init__(self)
         self.daemon = True
         self.capture_timestamp = None
-        self.image = None
+        self.frame = None
+        self.profile = profile
+        self.shape = profile.get_shape()
+        self.frame_pool = FramePool(shape = self.shape)
+        self.resizing = False # if the camera doesn't give us images of self.shape
+        self.decoding = False # if the camera doesn't give us raw images with a raw_yuyv profile
         self.broken = False
         self.ret = None
         self.enabled = True
-        self.cap = cv2.VideoCapture(id)
+        self.enable_time = 0
+        self.id = id
+        self.cap = None # opened by the thread
+        self.open_time = None # when the camera finished opening
+        self.first_frame_time = None
+        self.ready = threading.Event() # set once we have a frame
         self.condition = threading.Condition()
         self.start()
 
+    # frames captured before the last time the camera was enabled aren't used
     def enable(self):
-        self.enabled = True
+        if not self.enabled:
+            self.enable_time = time.time()
+            self.enabled = True
 
     def disable(self):
         self.enabled = False
@@ -57,56 +205,137 @@ class UsbCameraInterface(threading.Thread):
     def is_broken(self):
         return self.broken
 
-    # Grabs an image from a usb camera and notifies get_image
+    # Grabs an image from a usb camera and notifies get_frame
+    # read blocks until the camera sends the next frame, so the capture
+    # timestamp is taken once it returns rather than including the wait.
+    # (opencv's CAP_PROP_POS_MSEC is the driver's monotonic clock, which
+    # can't be compared with time.time() here)
     def grab_image(self):
         try:
             #print("Trying to grab an image from %s" % self.cap)
-            while True:
+            while self.enabled and not self.broken:
+                frame = self.frame_pool.acquire(self.shape)
+                if self.profile.raw_yuyv:
+                    ret, image = self.cap.read(self.get_raw_buffer(frame))
+                else:
+                    ret, image = self.cap.read(frame.image)
                 capture_timestamp = time.time()
-                ret, image = self.cap.read()
                 if not ret:
-                    print("Failed to get image from camera %s" % self.cap)
-                    time.sleep(2)
+                    frame.release()
+                    print("Failed to get image from camera %s, reopening it" % self.id)
+                    self.close_camera()
+                    time.sleep(CAMERA_REOPEN_WAIT)
                     return
                 if image is None:
+                    frame.release()
                     print("Got a null image from the camera, trying again")
                     continue
-                image = image[0:480, 0:640]
-                self.condition.acquire()
-                self.capture_timestamp = capture_timestamp
-                self.image = image
-                self.condition.notify()
-                self.condition.release()
+                frame.raw = None
+                if self.profile.raw_yuyv:
+                    self.store_raw(frame, image)
+                elif image is not frame.image:
+                    # the camera gave us a different size image so it couldn't be read into the frame
+                    if not self.resizing:
+                        print("Camera %s gives %dx%d images, resizing them" % (self.id, image.shape[1], image.shape[0]))
+                        self.resizing = True
+                    store_image(frame, image)
+                self.set_frame(frame, capture_timestamp)
         except Exception, e:
             print("Image grab failed: %s" % e)
             traceback.print_exc(file=sys.stdout)
             time.sleep(1)
 
-    # called by the main processing thread to acquire a new image
-    def get_image(self, old_timestamp):
+    # returns the buffer the raw image for frame is read into, opencv gives us
+    # the raw image as one row. It is only allocated once for each frame in the pool.
+    def get_raw_buffer(self, frame):
+        height, width = self.shape[:2]
+        if frame.raw_buffer is None:
+            frame.raw_buffer = np.empty((1, height * width * 2), np.uint8)
+        return frame.raw_buffer
+
+    # keeps the raw yuyv image in frame and converts it to BGR for everything
+    # else, opencv gives us the raw image as one row
+    def store_raw(self, frame, image):
+        height, width = self.shape[:2]
+        if image.size != height * width * 2:
+            # probably the camera or backend couldn't give us raw images
+            if not self.decoding:
+                print("Camera %s gives %s images, not raw %dx%d yuyv" % (self.id, image.shape, width, height))
+                self.decoding = True
+            store_image(frame, image)
+            return
+        frame.raw = image.reshape(height, width, 2)
+        cv2.cvtColor(frame.raw, cv2.COLOR_YUV2BGR_YUYV, dst = frame.image)
+
+    # makes frame the newest frame and notifies get_frame
+    def set_frame(self, frame, capture_timestamp):
+        frame.capture_timestamp = capture_timestamp
         self.condition.acquire()
-        if old_timestamp == self.capture_timestamp:
-            self.condition.wait()
+        old_frame = self.frame
+        self.capture_timestamp = capture_timestamp
+        self.frame = frame
+        self.condition.notify()
         self.condition.release()
-        return self.image, self.capture_timestamp
+        if old_frame is not None:
+            old_frame.release()
+        if self.first_frame_time is None:
+            self.first_frame_time = capture_timestamp
+            self.ready.set()
 
-    # get an image from the camera and check to make sure it is returning images
+    # called by the main processing thread to acquire a new frame
+    # the caller must release() the frame once it has finished with it
+    def get_frame(self, old_timestamp):
+        return get_newest_frame(self, old_timestamp)
+
+    # wait for the camera to give us its first frame and check to make sure it is returning images
     # this may occur when a camera is not present on the robot or if it is already
     # in use
-    def test_camera(self):
-        ret, image = self.cap.read()
-        if image is None:
-            print "*************************************************************"
-            print "ERROR: Failed to get a image from a camera, disabling it"
-            print "*************************************************************"
-            self.set_broken(True)
+    def test_camera(self, timeout = FIRST_FRAME_TIMEOUT):
+        test_camera_ready(self, timeout)
+
+    # opens the camera and applies our profile, returns False if it couldn't be opened
+    def open_camera(self):
+        cap = cv2.VideoCapture(self.id)
+        if not cap.isOpened():
+            cap.release()
+            return False
+        mismatches = apply_capture_profile(cap, self.profile, self.id)
+        for name, wanted, got in mismatches:
+            if name == "fourcc":
+                wanted, got = decode_fourcc(wanted), decode_fourcc(got)
+            print("Camera %s didn't take %s %s, it is %s" % (self.id, name, wanted, got))
+        self.resizing = False
+        self.decoding = False
+        self.cap = cap
+        self.open_time = time.time()
+        print("Opened camera %s" % self.id)
+        return True
 
+    # takes frames from the driver without decoding them while we are disabled
+    # grab() waits for the next frame so this runs at the camera's frame rate
+    def standby(self):
+        if not self.cap.grab():
+            print("Failed to grab from camera %s, reopening it" % self.id)
+            self.close_camera()
+            time.sleep(CAMERA_REOPEN_WAIT)
+
+    def close_camera(self):
+        if self.cap is not None:
+            self.cap.release()
+        self.cap = None
+
+    # the camera is opened again if it fails, test_camera gives up on it if
+    # it doesn't give us a first frame in time
     def run(self):
         while not self.broken:
-            if self.enabled:
+            if self.cap is None:
+                if not self.open_camera():
+                    time.sleep(CAMERA_REOPEN_WAIT)
+            elif self.enabled:
                 self.grab_image()
             else:
-                time.sleep(0.005)
+                self.standby()
+        self.close_camera()
 
 # handles grabbing images from a local file specified by image_name
 class LocalFileCameraInterface(threading.Thread):
@@ -115,8 +344,13 @@ class LocalFileCameraInterface(threading.Thread):
         self.broken = False
         self.daemon = True
         self.capture_timestamp = None
-        self.image = None
+        self.frame = None
+        self.frame_pool = FramePool()
         self.image_name = image_name
+        self.enable_time = 0
+        self.open_time = time.time()
+        self.first_frame_time = None
+        self.ready = threading.Event()
         self.condition = threading.Condition()
         self.start()
 
@@ -132,46 +366,126 @@ class LocalFileCameraInterface(threading.Thread):
     def is_broken(self):
         return self.broken
 
-    # Grabs an image from a usb camera and notifies get_image
+    # Grabs an image from a usb camera and notifies get_frame
     def grab_image(self):
-        capture_timestamp = time.time()
         image = cv2.imread(self.image_name, 1)
+        capture_timestamp = time.time()
         image = image[0:480, 0:640]
+        frame = self.frame_pool.acquire(image.shape)
+        frame.image[:] = image
+        frame.capture_timestamp = capture_timestamp
         self.condition.acquire()
+        old_frame = self.frame
         self.capture_timestamp = capture_timestamp
-        self.image = image
+        self.frame = frame
         self.condition.notify()
         self.condition.release()
+        if old_frame is not None:
+            old_frame.release()
+        if self.first_frame_time is None:
+            self.first_frame_time = capture_timestamp
+            self.ready.set()
 
-    # called by the main processing thread to acquire a new image
-    def get_image(self, old_timestamp):
-        self.condition.acquire()
-        if old_timestamp == self.capture_timestamp:
-            self.condition.wait()
-        self.condition.release()
-        return self.image, self.capture_timestamp
+    # called by the main processing thread to acquire a new frame
+    # the caller must release() the frame once it has finished with it
+    def get_frame(self, old_timestamp):
+        return get_newest_frame(self, old_timestamp)
 
-    # get an image from the camera and check to make sure it is returning images
-    # this may occur when a camera is not present on the robot or if it is already
-    # in use
-    def test_camera(self):
-        image = cv2.imread(self.image_name, 1)
-        if image is None:
-            print "*************************************************************"
-            print "ERROR: Failed to get a image from camera_1, disabling it"
-            print "*************************************************************"
-            self.set_broken(True)
+    # wait for the first image and check to make sure the file could be read
+    def test_camera(self, timeout = FIRST_FRAME_TIMEOUT):
+        test_camera_ready(self, timeout)
 
     def run(self):
         while not self.broken:
+            try:
+                self.grab_image()
+            except Exception, e:
+                print("Failed to read %s: %s" % (self.image_name, e))
+                self.set_broken(True)
+                self.ready.set()
             time.sleep(1)
-            self.grab_image()
+
+# waits for a camera's first frame, a camera which doesn't give us one in
+# time is given up on
+def test_camera_ready(camera, timeout):
+    if not camera.ready.wait(timeout) or camera.frame is None:
+        print "*************************************************************"
+        print "ERROR: Failed to get a image from a camera, disabling it"
+        print "*************************************************************"
+        camera.set_broken(True)
+
+# waits for a camera to have a frame newer than old_timestamp, captured
+# since the camera was enabled, and returns a reference to it, or None if the
+# camera stops giving us frames
+def get_newest_frame(camera, old_timestamp):
+    give_up_time = time.time() + FRAME_TIMEOUT
+    frame = None
+    camera.condition.acquire()
+    while camera.frame is None or old_timestamp == camera.capture_timestamp or\
+            camera.capture_timestamp < camera.enable_time:
+        wait_time = give_up_time - time.time()
+        if wait_time <= 0:
+            break
+        camera.condition.wait(wait_time)
+    else:
+        frame = camera.frame.retain()
+    camera.condition.release()
+    return frame
+
+# Measures the time from the robot asking for a camera to the first frame
+# and the first locked result from it, recorded in metrics as
+# camera_switch_frame and camera_switch_lock
+class CameraSwitchTimer():
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.camera_id = None
+        self.switch_time = None # None once we have both times for the last switch
+        self.waiting_for_frame = False
+
+    # called every frame with the camera the robot wants and when it asked for it
+    def update(self, camera_id, switch_time):
+        if camera_id == self.camera_id:
+            return
+        if self.camera_id is not None: # the first camera isn't a switch
+            self.switch_time = switch_time or time.time()
+            self.waiting_for_frame = True
+            self.metrics.count("camera_switches")
+        self.camera_id = camera_id
+
+    # called with each result sent to the robot
+    def got_result(self, camera_id, capture_timestamp, lock):
+        if self.switch_time is None or camera_id != self.camera_id:
+            return
+        if capture_timestamp < self.switch_time:
+            self.metrics.count("camera_switch_stale_frames")
+            return
+        now = time.time()
+        if self.waiting_for_frame:
+            self.metrics.record("camera_switch_frame", now - self.switch_time)
+            self.waiting_for_frame = False
+        if lock:
+            self.metrics.record("camera_switch_lock", now - self.switch_time)
+            self.switch_time = None
+
+# puts an image which couldn't be read straight into a frame into it,
+# resizing it to the size we process so the field of view stays the same
+def store_image(frame, image):
+    if image.shape == frame.image.shape:
+        frame.image[:] = image
+    elif image.ndim == 3 and image.shape[2] == frame.image.shape[2]:
+        cv2.resize(image, (frame.image.shape[1], frame.image.shape[0]), dst = frame.image)
+    else:
+        frame.image = image
 
 # Test only code, streams images from the local camera.
 if __name__ == "__main__":
-    cap = cv2.VideoCapture(id)
+    camera = UsbCameraInterface(0)
     timestamp = 0
     while(True):
-        image, timestamp = cap.get_image(timestamp)
-        cv2.imshow('Image', image)
+        frame = camera.get_frame(timestamp)
+        if frame is None:
+            continue
+        timestamp = frame.capture_timestamp
+        cv2.imshow('Image', frame.image)
+        frame.release()
         cv2.waitKey(1)
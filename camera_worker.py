@@ -0,0 +1,177 @@
+'''
+Runs each camera in its own process so every camera is processed at the
+same time on its own core, instead of one at a time in the main process
+(python threads can't do this because of the GIL).
+
+Each worker has its own camera, Goal, GoalHistory, mask engine and image
+saver, and processes every frame with its camera's selection values. It
+puts its results on a queue shared with the main process, which picks the
+result of the camera the robot wants and sends it.
+
+The main process tells a worker to draw everything on its images and send
+them back through image_wanted, this is only done for the camera the robot
+wants when someone is looking at the live image.
+'''
+
+import multiprocessing
+import Queue
+import sys
+import time
+import traceback
+from camera_interfaces import UsbCameraInterface, LocalFileCameraInterface, GOAL_CAPTURE_PROFILE
+from process_image import Goal, GoalHistory, process_frame
+from mask_engine import MaskEngine
+from metrics import Metrics
+from image_saver import ImageSaver
+
+RESULT_TIMEOUT = 1 # seconds to wait for the wanted camera before giving up on it
+
+# The result of processing one frame, sent from a worker to the main process
+class WorkerResult():
+    def __init__(self, camera_id, data, vision_result, capture_timestamp, stage_times, rejections, pair_score, image):
+        self.camera_id = camera_id
+        self.data = data
+        self.vision_result = vision_result
+        self.capture_timestamp = capture_timestamp
+        self.stage_times = stage_times
+        self.rejections = rejections # Goal.rejections
+        self.pair_score = pair_score # Goal.pair_score, None unless the camera looks for a dual target
+        self.image = image # only sent when image_wanted is set
+
+class CameraWorker(multiprocessing.Process):
+    # camera_id is the id the robot uses for this camera ("b" or "g")
+    # source is a usb camera number or the name of a local image
+    def __init__(self, camera_id, source, results, mask_values, mask_strategy, duel_target,\
+            selection_values, use_tracking, use_prediction, pyramid_factor, use_components, save_dir, write_file, save_format,\
+            save_rate, save_workers, verbose, capture_profile = GOAL_CAPTURE_PROFILE):
+        multiprocessing.Process.__init__(self)
+        self.daemon = True
+        self.camera_id = camera_id
+        self.source = source
+        self.results = results
+        self.mask_values = list(mask_values)
+        self.mask_strategy = mask_strategy
+        self.duel_target = duel_target
+        self.selection_values = selection_values
+        self.use_tracking = use_tracking
+        self.use_prediction = use_prediction
+        self.pyramid_factor = pyramid_factor
+        self.use_components = use_components
+        self.save_dir = save_dir
+        self.write_file = write_file
+        self.save_format = save_format
+        self.save_rate = save_rate
+        self.save_workers = save_workers
+        self.verbose = verbose
+        self.capture_profile = capture_profile
+        self.image_wanted = multiprocessing.Value("b", False)
+
+    def open_camera(self):
+        if isinstance(self.source, str):
+            return LocalFileCameraInterface(self.source)
+        return UsbCameraInterface(self.source, self.capture_profile)
+
+    def run(self):
+        try:
+            self.process_frames()
+        except Exception, e:
+            print("Camera worker %s failed: %s" % (self.camera_id, e))
+            traceback.print_exc(file=sys.stdout)
+
+    def process_frames(self):
+        metrics = Metrics()
+        # the image saver's workers have to be started before the camera's thread
+        image_saver = ImageSaver(self.save_dir, self.write_file, "capture_%s" % self.camera_id, False,\
+            self.save_format, self.save_rate, self.save_workers, metrics)
+        camera = self.open_camera()
+        camera.test_camera() # waits for the first frame
+        if camera.is_broken():
+            print("Camera worker %s has no camera, stopping" % self.camera_id)
+            return
+        goal = Goal(self.pyramid_factor, self.use_components)
+        goal_history = GoalHistory(self.use_tracking, self.use_prediction)
+        mask_engine = MaskEngine(self.mask_strategy)
+
+        capture_timestamp = 1
+        while True:
+            frame = camera.get_frame(capture_timestamp)
+            if frame is None:
+                print("Camera worker %s got a null image, continuing" % self.camera_id)
+                continue
+            capture_timestamp = frame.capture_timestamp
+            image_wanted = bool(self.image_wanted.value)
+            # the image saver gets a clean frame every 1 / save_rate seconds even while someone is watching
+            draw_extra = image_wanted and not image_saver.is_frame_due(capture_timestamp)
+            data, image, image_mask = process_frame(frame.image, mask_engine, self.mask_values, goal, goal_history,\
+                capture_timestamp, False, draw_extra, self.verbose, self.duel_target, self.selection_values, metrics,\
+                frame.raw)
+            live_image = None
+            if image_wanted:
+                live_image = image # pickled by the queue so it can be released straight away
+            if not draw_extra:
+                image_saver.give_frame(frame, self.camera_id, data)
+            pair_score = None
+            if self.duel_target:
+                pair_score = goal.pair_score
+            self.results.put(WorkerResult(self.camera_id, data, goal_history.last_result, capture_timestamp,\
+                dict(goal.stage_times), goal.rejections, pair_score, live_image))
+            frame.release()
+            sys.stdout.flush()
+
+# Starts a worker for each camera and keeps the newest result from each one
+class CameraWorkerPool():
+    def __init__(self):
+        self.results = multiprocessing.Queue()
+        self.workers = {}
+        self.newest = {} # camera id: newest WorkerResult
+
+    def add_worker(self, camera_id, source, *args):
+        self.workers[camera_id] = CameraWorker(camera_id, source, self.results, *args)
+
+    # must be called before any threads are started in this process
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+
+    def has_camera(self, camera_id):
+        worker = self.workers.get(camera_id)
+        return worker is not None and worker.is_alive()
+
+    # only the wanted camera draws everything and sends back its images
+    def set_image_wanted(self, wanted_camera_id, image_wanted):
+        for camera_id, worker in self.workers.items():
+            worker.image_wanted.value = image_wanted and camera_id == wanted_camera_id
+
+    # waits for a result from camera_id newer than old_timestamp, keeping
+    # the newest result from all of the other cameras on the way
+    # returns None if the camera doesn't give us one in time
+    def get_result(self, camera_id, old_timestamp):
+        give_up_time = time.time() + RESULT_TIMEOUT
+        while True:
+            result = self.newest.get(camera_id)
+            if result is not None and result.capture_timestamp != old_timestamp:
+                # don't send the same image to the live image server twice
+                self.newest[camera_id] = WorkerResult(result.camera_id, result.data, result.vision_result,\
+                    result.capture_timestamp, result.stage_times, result.rejections, result.pair_score, None)
+                return result
+            wait_time = give_up_time - time.time()
+            if wait_time <= 0:
+                return None
+            try:
+                result = self.results.get(True, wait_time)
+            except Queue.Empty:
+                return None
+            self.newest[result.camera_id] = result
+            self.drain_results()
+
+    # takes every result waiting in the queue without blocking, keeping only
+    # the newest from each camera. Called every loop whichever camera is
+    # wanted so the queue can't grow while we aren't waiting for a result,
+    # eg. while the wanted camera's worker is dead.
+    def drain_results(self):
+        try:
+            while True:
+                result = self.results.get_nowait()
+                self.newest[result.camera_id] = result
+        except Queue.Empty:
+            pass
@@ -0,0 +1,96 @@
+'''
+Works out how the robot's clock relates to ours so every result can say
+when its frame was captured in robot time, then the robot can line the
+result up with its own odometry history instead of guessing from age.
+
+ControlConnection sends a ping every CLOCK_SYNC_INTERVAL seconds and the
+robot answers with a pong (see vision_protocol.py), which gives four times:
+    t0  we sent the ping            (our clock)
+    t1  the robot got it            (robot clock)
+    t2  the robot sent the pong     (robot clock)
+    t3  we got the pong             (our clock)
+    round trip = (t3 - t0) - (t2 - t1)
+    offset     = ((t1 - t0) + (t2 - t3)) / 2   robot clock - our clock
+The offset is only exact if the ping and pong took as long as each other,
+a sample with a long round trip was probably held up one way so only the
+CLOCK_BEST_FRACTION of recent samples with the shortest round trips are
+used. Once they cover CLOCK_DRIFT_MIN_SPAN seconds a line is fitted through
+them so the clocks drifting apart is followed too.
+'''
+
+import collections
+import numpy as np
+import threading
+
+CLOCK_SYNC_INTERVAL = 0.5 # seconds between pings
+CLOCK_SAMPLES = 64 # recent samples kept
+CLOCK_BEST_FRACTION = 0.5 # of the samples, with the shortest round trips, used for the estimate
+CLOCK_DRIFT_MIN_SPAN = 10 # seconds the samples used have to cover before the drift is estimated
+CLOCK_DRIFT_MIN_SAMPLES = 4
+
+class ClockSync():
+    def __init__(self, metrics = None):
+        self.metrics = metrics
+        self.samples = collections.deque(maxlen = CLOCK_SAMPLES) # (our time, offset, round trip)
+        self.lock = threading.Lock()
+        # (our time, offset at that time, drift), replaced as a whole so to_robot_time doesn't need the lock
+        self.estimate = None
+        self.jitter = 0
+
+    # adds the times from one ping/pong, see above
+    def add_sample(self, send_time, robot_receive_time, robot_send_time, receive_time):
+        round_trip = (receive_time - send_time) - (robot_send_time - robot_receive_time)
+        offset = ((robot_receive_time - send_time) + (robot_send_time - receive_time)) / 2.0
+        self.lock.acquire()
+        self.samples.append(((send_time + receive_time) / 2.0, offset, round_trip))
+        self.update()
+        self.lock.release()
+
+    def update(self):
+        samples = np.array(self.samples)
+        round_trips = samples[:, 2]
+        best = samples[round_trips <= np.percentile(round_trips, CLOCK_BEST_FRACTION * 100)]
+        # fit around the newest sample so the numbers stay small
+        reference = samples[-1, 0]
+        times = best[:, 0] - reference
+        if len(best) >= CLOCK_DRIFT_MIN_SAMPLES and np.ptp(times) >= CLOCK_DRIFT_MIN_SPAN:
+            drift, offset = np.polyfit(times, best[:, 1], 1)
+        else:
+            drift, offset = 0, np.median(best[:, 1])
+        self.estimate = (reference, offset, drift)
+        # how far the offsets we are using are from the fitted line
+        self.jitter = np.std(best[:, 1] - (offset + drift * times))
+
+        if self.metrics:
+            self.metrics.set_gauge("clock_offset_ms", round(offset * 1000, 3))
+            self.metrics.set_gauge("clock_drift_ppm", round(drift * 1e6, 3))
+            self.metrics.set_gauge("clock_round_trip_ms", round(np.min(best[:, 2]) * 1000, 3))
+            self.metrics.set_gauge("clock_jitter_ms", round(self.jitter * 1000, 3))
+            self.metrics.set_gauge("clock_samples", len(samples))
+
+    # forgets everything, the robot may have restarted with a different clock
+    def reset(self):
+        self.lock.acquire()
+        self.samples.clear()
+        self.estimate = None
+        self.lock.release()
+
+    def is_synced(self):
+        return self.estimate is not None
+
+    # returns local_time (from time.time()) on the robot's clock, or 0 if
+    # we haven't heard from the robot yet
+    def to_robot_time(self, local_time):
+        estimate = self.estimate
+        if estimate is None or not local_time:
+            return 0
+        reference, offset, drift = estimate
+        return local_time + offset + drift * (local_time - reference)
+
+    def status(self):
+        estimate = self.estimate
+        if estimate is None:
+            return "clock not synced"
+        reference, offset, drift = estimate
+        return "clock offset %.3f ms, drift %.1f ppm, jitter %.3f ms from %d samples" % (offset * 1000,\
+            drift * 1e6, self.jitter * 1000, len(self.samples))
@@ -1,79 +1,293 @@
 """
 This class handles the connection between the jetson/pi and the roborio.
-It runs its own thread to restart the socket connection if it fails
+It runs its own thread which owns the socket, it connects (and reconnects
+if the connection fails, waiting longer after each failure), reads which
+camera the robot wants and sends our results.
+
+The main loop never touches the socket. send() leaves the newest message
+for the connection thread and wakes it up, if the last message hasn't
+been sent yet it is replaced, the robot only wants the newest result.
+wantedCameraID() just returns what the connection thread last read.
+
+Results are sent as text or as binary messages (see vision_protocol.py).
+With use_udp they are sent to the robot as UDP packets on the same port
+instead of over the TCP connection, so a stalled connection never holds up
+a newer result, the TCP connection is then only used to choose the camera.
+
+Given a ClockSync the connection thread also pings the robot every
+CLOCK_SYNC_INTERVAL seconds over the TCP connection and binary results
+carry their capture time on the robot's clock (see clock_sync.py).
 """
 
-import threading
+import collections
+import errno
+import fcntl
+import os
+import select
 import socket
 import threading
 import time
+from clock_sync import CLOCK_SYNC_INTERVAL
+from vision_protocol import VisionResult, cal_message_size, pack_ping, unpack_pong
+
+CAMERA_IDS = ["b", "g"]
+CONNECT_TIMEOUT = 2 # seconds
+RECONNECT_MIN_WAIT = 0.25 # seconds to wait after the first failure to connect, doubled after each one
+RECONNECT_MAX_WAIT = 4
+RECV_SIZE = 64
 
 class ControlConnection(threading.Thread):
-    def __init__(self, robot_ip, robot_port, present):
+    # protocol is "text" or "binary"
+    def __init__(self, robot_ip, robot_port, present, protocol = "text", use_udp = False, metrics = None,\
+            clock_sync = None):
         threading.Thread.__init__(self)
         self.daemon = True
         self.socket = None
+        self.connected = False
         self.robot_ip = robot_ip
         self.robot_port = robot_port
+        self.robot_address = None # found by the connection thread so sending never waits for dns
         self.camera_id = "b" # "b" or "g" or "l"
+        self.camera_id_time = 0 # when the robot last changed camera_id
+        self.protocol = protocol
+        self.metrics = metrics
+        self.sequence = 0 # of the last binary message
+        self.connect_start = 0
+        self.next_connect_time = 0
+        self.reconnect_wait = RECONNECT_MIN_WAIT
+        # the newest message waiting to be sent, appending replaces the old one
+        self.pending = collections.deque(maxlen = 1)
+        self.out_buffer = "" # the rest of the message being sent
+        self.in_buffer = "" # received bytes which aren't a whole message yet
+        self.clock_sync = clock_sync
+        self.ping_id = 0
+        self.next_ping_time = 0
+        # writing to this pipe wakes the connection thread up
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for fd in (self.wakeup_read, self.wakeup_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.woken = False
+        self.udp_socket = None
+        if use_udp:
+            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_socket.setblocking(0)
         if present: self.start() # we sometimes don't want to start the thread (-r parser flag)
 
-    # Opens a socket with the robot (currently the laptop running the script)
-    def open_connection(self):
+    def count(self, name):
+        if self.metrics:
+            self.metrics.count("connection_" + name)
+
+    # Sends data (the text format) or result (a VisionResult, for the binary
+    # format) to the robot. result is None if we don't have one.
+    # Doesn't wait for anything, the message is sent by the connection thread.
+    def send(self, data, result = None):
+        if self.protocol == "binary":
+            data = self.make_message(result)
+        if self.udp_socket:
+            self.send_udp(data)
+            return
+        if not self.connected: return
+        if self.pending:
+            self.count("coalesced") # the last one hasn't gone yet
+        self.pending.append(data)
+        self.wake()
+
+    # packs result with the next sequence number and how old it is now
+    def make_message(self, result):
+        self.sequence += 1
+        if result is None:
+            result = VisionResult()
+        age = 0
+        if result.capture_timestamp:
+            age = time.time() - result.capture_timestamp
+        robot_timestamp = 0
+        if self.clock_sync:
+            robot_timestamp = self.clock_sync.to_robot_time(result.capture_timestamp)
+        return VisionResult(result.capture_timestamp, result.lock, result.aim, result.distance, result.skew,\
+            age, self.sequence, robot_timestamp).pack()
+
+    # UDP never blocks, a packet which can't be sent is dropped as a newer one will follow
+    def send_udp(self, data):
+        if not self.robot_address: return
+        try:
+            self.udp_socket.sendto(data, self.robot_address)
+        except Exception, e:
+            print("Error sending udp data: " + str(e))
+
+    def wake(self):
+        if self.woken: return
+        self.woken = True
         try:
+            os.write(self.wakeup_write, "w")
+        except OSError:
+            pass # the pipe is full so it is already awake
+
+    # returns which camera should be used
+    def wantedCameraID(self):
+        return self.camera_id
+
+    def run(self):
+        while True:
+            self.poll()
+
+    # waits for something to happen on the socket or for a message to send and handles it
+    def poll(self):
+        now = time.time()
+        if self.socket is None and now >= self.next_connect_time:
+            self.start_connect()
+        elif self.socket is not None and not self.connected and now - self.connect_start > CONNECT_TIMEOUT:
+            print("Timed out connecting to robot: " + self.robot_ip)
+            self.close_connection()
+
+        readers = [self.wakeup_read]
+        writers = []
+        timeout = None
+        if self.socket is None:
+            timeout = max(self.next_connect_time - now, 0)
+        elif not self.connected:
+            writers.append(self.socket) # writable once connected
+            timeout = max(self.connect_start + CONNECT_TIMEOUT - now, 0)
+        else:
+            readers.append(self.socket)
+            if self.out_buffer or self.pending or self.is_ping_due(now):
+                writers.append(self.socket)
+            elif self.clock_sync:
+                timeout = max(self.next_ping_time - now, 0)
+        readable, writable, errored = select.select(readers, writers, [], timeout)
+
+        if self.wakeup_read in readable:
+            # drain before clearing woken, a wake() in between then writes
+            # again instead of its byte being drained with the old ones
+            try:
+                os.read(self.wakeup_read, 4096)
+            except OSError:
+                pass
+            self.woken = False
+        if self.socket is not None and self.socket in writable:
+            if self.connected:
+                self.write()
+            else:
+                self.finish_connect()
+        if self.socket is not None and self.connected and self.socket in readable:
+            self.read()
+
+    def is_ping_due(self, now):
+        return self.clock_sync is not None and now >= self.next_ping_time
+
+    # starts opening a socket with the robot (currently the laptop running the script)
+    def start_connect(self):
+        self.connect_start = time.time()
+        try:
+            self.robot_address = (socket.gethostbyname(self.robot_ip), self.robot_port)
             s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(2)
-            s.connect((self.robot_ip, self.robot_port))
-            s.settimeout(5)
+            s.setblocking(0)
             # Don't wait for a complete packet before sending.
             s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             self.socket = s
-            print("Control connection established with: " + self.robot_ip)
+            error = s.connect_ex(self.robot_address)
+            if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                raise socket.error(error, os.strerror(error))
         except Exception, e:
-	    self.socket = None
             print("Unable to connect to robot: " + self.robot_ip)
             print(e)
+            self.close_connection()
+
+    def finish_connect(self):
+        error = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            print("Unable to connect to robot: " + self.robot_ip)
+            print(os.strerror(error))
+            self.close_connection()
+            return
+        self.connected = True
+        self.reconnect_wait = RECONNECT_MIN_WAIT
+        if self.clock_sync:
+            self.clock_sync.reset()
+            self.next_ping_time = 0
+        self.count("connects")
+        if self.metrics:
+            self.metrics.startup.mark("robot connected")
+        print("Control connection established with: " + self.robot_ip)
 
-    # Sends data to the robot via a socket
-    def send(self, data):
-        if not self.socket: return
+    # closes the socket and waits a bit longer each time before connecting again
+    def close_connection(self):
+        if self.socket is not None:
+            self.socket.close()
+        self.socket = None
+        self.connected = False
+        self.out_buffer = ""
+        self.in_buffer = ""
+        self.pending.clear()
+        self.next_connect_time = time.time() + self.reconnect_wait
+        self.reconnect_wait = min(self.reconnect_wait * 2, RECONNECT_MAX_WAIT)
+
+    # sends as much of the newest message as the socket will take, a message
+    # is always finished before the next one is started. Pings go before
+    # results, they are stamped as late as possible to keep the times exact.
+    def write(self):
+        if not self.out_buffer:
+            now = time.time()
+            if self.is_ping_due(now):
+                self.ping_id += 1
+                self.out_buffer = pack_ping(self.ping_id, now)
+                self.next_ping_time = now + CLOCK_SYNC_INTERVAL
+                self.count("pings")
+            else:
+                try:
+                    self.out_buffer = self.pending.popleft()
+                except IndexError:
+                    return
         try:
-            self.socket.send(data)
-            #print("Sent: " + data)
-        except Exception, e:
+            sent = self.socket.send(self.out_buffer)
+            self.out_buffer = self.out_buffer[sent:]
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
             print("Error sending data: " + str(e))
-            self.socket = None
+            self.close_connection()
 
-    # Recieves data from the robot via a socket
-    # To switch cameras the robot passes a string to the script through the socket
-    def updateDesiredCameraID(self):
+    # To switch cameras the robot passes a string to the script through the
+    # socket, mixed in with pongs if we are syncing clocks
+    def read(self):
         try:
-            if not self.socket: return
-            # Check for any messages received
-            self.socket.settimeout(0)
-            new_camera_id = self.socket.recv(10, socket.MSG_DONTWAIT)
-            self.socket.settimeout(None)
-            print("recieved: %s" % new_camera_id)
-            if new_camera_id:
-                new_camera_id = new_camera_id[-1]
-                if new_camera_id == "b" or new_camera_id == "g":
-                    if new_camera_id != self.camera_id:
-                        print("Changing to camera %s" % new_camera_id)
-                        self.camera_id = new_camera_id
-                else:
-                    print("unsupported camera id %s" % new_camera_id)
-        except Exception, e:
-            # A "[Errno 11] Resource temporarily unavailable"
-            # is expected here if there is nothing to read.
-            # print("Error reading data from control socket: " + str(e))
-            pass
+            received = self.socket.recv(RECV_SIZE)
+            receive_time = time.time()
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            print("Error reading data from control socket: " + str(e))
+            self.close_connection()
+            return
+        if not received:
+            print("Control connection closed by: " + self.robot_ip)
+            self.close_connection()
+            return
+        self.in_buffer += received
+        while self.in_buffer:
+            size = cal_message_size(self.in_buffer)
+            if size is None or len(self.in_buffer) < size:
+                break # wait for the rest of it
+            if size == 0:
+                self.read_camera_id(self.in_buffer[0])
+                self.in_buffer = self.in_buffer[1:]
+            else:
+                self.read_pong(self.in_buffer[:size], receive_time)
+                self.in_buffer = self.in_buffer[size:]
 
-    # returns which camera should be used
-    def wantedCameraID(self):
-        return self.camera_id
+    def read_camera_id(self, new_camera_id):
+        if new_camera_id in CAMERA_IDS:
+            if new_camera_id != self.camera_id:
+                print("Changing to camera %s" % new_camera_id)
+                self.camera_id_time = time.time()
+                self.camera_id = new_camera_id
+        elif not new_camera_id.isspace():
+            print("unsupported camera id %s" % new_camera_id)
 
-    def run(self):
-        while True:
-            if not self.socket:
-                self.open_connection()
-            time.sleep(1)
+    def read_pong(self, message, receive_time):
+        pong = unpack_pong(message)
+        if pong is None or self.clock_sync is None:
+            self.count("unexpected_messages")
+            return
+        ping_id, send_time, robot_receive_time, robot_send_time = pong
+        self.count("pongs")
+        self.clock_sync.add_sample(send_time, robot_receive_time, robot_send_time, receive_time)
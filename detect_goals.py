@@ -1,3 +1,5 @@
+import time
+STARTUP_TIME = time.time() # before the slow imports, for the startup timeline
 import cv2
 import os
 from screen_handler import *
@@ -5,7 +7,14 @@ from process_image import *
 from control_connection import *
 from camera_interfaces import *
 from image_saver import *
-from live_image_server import LiveImageServer
+from mask_engine import MaskEngine, MASK_STRATEGIES
+from metrics import Metrics
+from frame_pool import wrap_image
+from camera_worker import CameraWorkerPool
+from pipeline import Pipeline, PipelineSettings
+from live_image_server import LiveImageServer, LIVE_BANDWIDTH_KBITS
+from vision_protocol import PROTOCOL_FORMATS
+from clock_sync import ClockSync
 import time
 import optparse
 import sys
@@ -20,8 +29,26 @@ class Parser:
         parser.add_option("-d", "--use_debug", action = "store_true", dest = "use_debug", default = False, help = "show mask, all goals found and disables writing. script will try to connect to a local server instead") 
         parser.add_option("-v", "--verbose", action = "store_true", dest = "verbose", default = False, help = "be verbose") 
         parser.add_option("-c", "--use_single_camera", action = "store_true", dest = "use_single_camera", default = False, help = "use only one camera")
+        parser.add_option("-t", "--use_tracking", action = "store_true", dest = "use_tracking", default = False, help = "only search around the last target found, with a full image search on a miss")
+        parser.add_option("-e", "--use_prediction", action = "store_true", dest = "use_prediction", default = False, help = "filter aim, distance and skew with a tracker and send where the target will be when the robot gets the result")
+        parser.add_option("-p", "--pyramid_factor", type = "int", dest = "pyramid_factor", default = 1, help = "find candidate goals on a mask downscaled by this factor (2 or 4) before searching them at full resolution")
+        parser.add_option("-n", "--use_components", action = "store_true", dest = "use_components", default = False, help = "label the mask's connected components and only trace the ones which could be goals, quicker on noisy masks")
+        parser.add_option("-q", "--use_pipeline", action = "store_true", dest = "use_pipeline", default = False, help = "capture, mask and find goals in a pipeline of threads working on different frames at the same time")
+        parser.add_option("-k", "--live_kbits", type = "int", dest = "live_kbits", default = LIVE_BANDWIDTH_KBITS, help = "bandwidth budget of the live image stream in kbit/s")
+        parser.add_option("-f", "--save_format", type = "choice", choices = SAVE_FORMATS, dest = "save_format", default = "png", help = "png writes a file per saved image, %s record them into a ring file instead" % "/".join(SAVE_FORMATS[1:]))
+        parser.add_option("-S", "--save_rate", type = "float", dest = "save_rate", default = SAVE_RATE, help = "images to save per second")
+        parser.add_option("-j", "--save_workers", type = "int", dest = "save_workers", default = 0, help = "number of processes to encode and write saved PNGs with, 0 to write them in a thread")
+        parser.add_option("-b", "--protocol", type = "choice", choices = PROTOCOL_FORMATS, dest = "protocol", default = "text", help = "send results to the robot as text or binary (see vision_protocol.py)")
+        parser.add_option("-u", "--use_udp", action = "store_true", dest = "use_udp", default = False, help = "send results to the robot over udp, the tcp connection is only used to choose the camera")
+        parser.add_option("-y", "--use_clock_sync", action = "store_true", dest = "use_clock_sync", default = False, help = "ping the robot to sync clocks and send when each frame was captured in robot time (needs -b binary)")
+        parser.add_option("-Y", "--use_yuyv", action = "store_true", dest = "use_yuyv", default = False, help = "capture uncompressed yuyv frames instead of jpegs and mask them luma first (see mask_engine.py)")
+        parser.add_option("-m", "--mask_strategy", type = "choice", choices = MASK_STRATEGIES, dest = "mask_strategy", default = None, help = "how both cameras' frames are masked, one of %s (see mask_engine.py)" % ", ".join(MASK_STRATEGIES))
+        parser.add_option("-a", "--use_camera_workers", action = "store_true", dest = "use_camera_workers", default = False, help = "process all cameras at the same time, each in its own process")
 
         (options, args) = parser.parse_args()
+        if options.use_clock_sync and options.protocol != "binary":
+            # pings are binary messages, they would corrupt the text stream
+            parser.error("-y needs -b binary")
         use_screen = options.use_screen
         con_to_robot = options.con_to_robot
         use_local_file = options.use_local_file
@@ -29,8 +56,25 @@ class Parser:
         use_debug = options.use_debug
         verbose = options.verbose
         use_single_camera = options.use_single_camera
+        use_tracking = options.use_tracking
+        use_prediction = options.use_prediction
+        pyramid_factor = options.pyramid_factor
+        use_components = options.use_components
+        use_camera_workers = options.use_camera_workers
+        use_pipeline = options.use_pipeline
+        live_kbits = options.live_kbits
+        save_format = options.save_format
+        save_rate = options.save_rate
+        save_workers = options.save_workers
+        protocol = options.protocol
+        use_udp = options.use_udp
+        use_clock_sync = options.use_clock_sync
+        use_yuyv = options.use_yuyv
+        mask_strategy = options.mask_strategy
         print options
-        return use_screen, con_to_robot, use_local_file, write_file, use_debug, verbose, use_single_camera
+        return use_screen, con_to_robot, use_local_file, write_file, use_debug, verbose, use_single_camera, use_tracking,\
+            use_prediction, pyramid_factor, use_components, use_camera_workers, use_pipeline, live_kbits, save_format, save_rate,\
+            save_workers, protocol, use_udp, use_clock_sync, use_yuyv, mask_strategy
 
 IMAGE_NAME = "2016.png"
 IMAGE_NAME_2 = "lift_peg.png"
@@ -38,6 +82,7 @@ ERROR_IMAGE_NAME = "error_image.png"
 SAVE_DIR = "output"
 RIO_PORT = 5801
 IMAGE_SERVER_PORT = 5802
+MASK_VALUES = [32,209,66,115,255,255] # lower and upper hsv
 
 
 GOAL_AREA_THRESHOLD = 200
@@ -48,6 +93,7 @@ GOAL_ASPECT_THRESHOLD_UPPER = 14
 GOAL_TARGET_ASPECT_THRESHOLD_LOWER = 1
 GOAL_TARGET_ASPECT_THRESHOLD_UPPER = 3
 GOAL_TARGET_DISTANCE_FACTOR = 20000
+GOAL_MASK_STRATEGY = "hsv" # see mask_engine.py
    
 GOAL_SELECTION_VALUES = [GOAL_AREA_THRESHOLD,\
                         GOAL_FULLNESS_THRESHOLD_LOWER,\
@@ -66,6 +112,7 @@ GEAR_ASPECT_THRESHOLD_UPPER = 2
 GEAR_TARGET_ASPECT_THRESHOLD_LOWER = 1.5
 GEAR_TARGET_ASPECT_THRESHOLD_UPPER = 2.5
 GEAR_TARGET_DISTANCE_FACTOR = 3403
+GEAR_MASK_STRATEGY = "hsv" # see mask_engine.py
    
 GEAR_SELECTION_VALUES = [GEAR_AREA_THRESHOLD,\
                         GEAR_FULLNESS_THRESHOLD_LOWER,\
@@ -76,20 +123,148 @@ GEAR_SELECTION_VALUES = [GEAR_AREA_THRESHOLD,\
                         GEAR_TARGET_ASPECT_THRESHOLD_UPPER,\
                         GEAR_TARGET_DISTANCE_FACTOR]
 
+# the address of the robot, or a local server when debugging
+def get_robot_ip(use_debug):
+    if use_debug:
+        return "127.0.0.1"
+    return "roborio-3132-frc.local"
+
+# returns the capture profiles and mask strategies of the goal and gear cameras.
+# yuyv frames are masked raw with the "yuyv" strategy
+# mask_strategy (-m) is used for both cameras if it is given
+def get_camera_settings(use_yuyv, mask_strategy = None):
+    goal_mask_strategy = gear_mask_strategy = mask_strategy
+    if mask_strategy is None:
+        goal_mask_strategy = GOAL_MASK_STRATEGY
+        gear_mask_strategy = GEAR_MASK_STRATEGY
+    if use_yuyv:
+        if mask_strategy is None:
+            goal_mask_strategy = gear_mask_strategy = "yuyv"
+        return YUYV_CAPTURE_PROFILE, YUYV_CAPTURE_PROFILE, goal_mask_strategy, gear_mask_strategy
+    return GOAL_CAPTURE_PROFILE, GEAR_CAPTURE_PROFILE, goal_mask_strategy, gear_mask_strategy
+
+# returns the ClockSync for the connection or None if we aren't syncing clocks
+# (only with the binary protocol, Parser makes sure of that)
+def make_clock_sync(use_clock_sync, protocol, metrics):
+    if not use_clock_sync or protocol != "binary":
+        return None
+    return ClockSync(metrics)
+
+# Processes every camera at the same time, each in its own process (see camera_worker.py).
+# The camera the robot wants only chooses which result is sent.
+def run_camera_workers(use_screen, con_to_robot, use_local_file, write_file, use_debug, verbose,\
+        use_tracking, use_prediction, pyramid_factor, use_components, live_kbits, save_format, save_rate, save_workers,\
+        protocol, use_udp, use_clock_sync, use_yuyv, mask_strategy):
+    if use_screen:
+        print "The screen isn't supported with camera workers, ignoring it"
+    metrics = Metrics(STARTUP_TIME)
+    image_saver = ImageSaver(SAVE_DIR, False, metrics = metrics)
+    if write_file:
+        image_saver.set_aside_directory() # the workers each write to saved.0
+
+    if use_local_file:
+        goal_source = IMAGE_NAME
+        gear_source = IMAGE_NAME_2
+    else:
+        goal_source = 1
+        gear_source = 0
+    goal_profile, gear_profile, goal_mask_strategy, gear_mask_strategy = get_camera_settings(use_yuyv, mask_strategy)
+    workers = CameraWorkerPool()
+    workers.add_worker("b", goal_source, MASK_VALUES, goal_mask_strategy, False, GOAL_SELECTION_VALUES,\
+        use_tracking, use_prediction, pyramid_factor, use_components, SAVE_DIR, write_file, save_format, save_rate, save_workers, verbose,\
+        goal_profile)
+    workers.add_worker("g", gear_source, MASK_VALUES, gear_mask_strategy, True, GEAR_SELECTION_VALUES,\
+        use_tracking, use_prediction, pyramid_factor, use_components, SAVE_DIR, write_file, save_format, save_rate, save_workers, verbose,\
+        gear_profile)
+    workers.start() # must happen before we start any threads
+    metrics.startup.mark("camera workers started")
+    if write_file:
+        image_saver.start_rotating_directories()
+
+    live_image_server = LiveImageServer(IMAGE_SERVER_PORT, metrics, live_kbits)
+    connection = ControlConnection(get_robot_ip(use_debug), RIO_PORT, con_to_robot, protocol, use_udp, metrics,\
+        make_clock_sync(use_clock_sync, protocol, metrics))
+
+    print "\n________Finished setting up________\n"
+    metrics.startup.mark("setup done")
+    switch_timer = CameraSwitchTimer(metrics)
+
+    capture_timestamp = 1
+    while True:
+        frame_start = time.time()
+        camera_id = connection.wantedCameraID()
+        switch_timer.update(camera_id, connection.camera_id_time)
+        workers.set_image_wanted(camera_id, live_image_server.is_image_wanted() or use_debug)
+
+        workers.drain_results()
+        result = None
+        if workers.has_camera(camera_id):
+            result = workers.get_result(camera_id, capture_timestamp)
+        if result is None:
+            print "couldn't use a camera by the id of " + camera_id
+            # send a fail whale to the driverstation and default data to the Rio
+            connection.send("0,0,0,0\n")
+            image = cv2.imread(ERROR_IMAGE_NAME, 1)
+            if image is not None:
+                frame = wrap_image(image, time.time())
+                live_image_server.set_frame(frame)
+                frame.release()
+            time.sleep(1)
+            continue
+
+        capture_timestamp = result.capture_timestamp
+        for stage, seconds in result.stage_times.items():
+            metrics.record(camera_id + "_" + stage, seconds)
+        metrics.count_all(result.rejections, camera_id + "_rejected_")
+        if result.pair_score is not None:
+            metrics.set_gauge("pair_score", round(result.pair_score, 3))
+        start = time.time()
+        connection.send(result.data, result.vision_result)
+        start = metrics.time_since("send", start)
+        metrics.startup.mark("first result")
+        if result.vision_result is not None and result.vision_result.lock:
+            metrics.startup.mark("first lock")
+        switch_timer.got_result(camera_id, capture_timestamp, result.vision_result is not None and result.vision_result.lock)
+        if result.image is not None:
+            frame = wrap_image(result.image, capture_timestamp)
+            live_image_server.set_frame(frame)
+            frame.release()
+            metrics.time_since("live_handoff", start)
+        metrics.time_since("frame", frame_start)
+        metrics.record("age", time.time() - capture_timestamp)
+        sys.stdout.flush()
+
 def main():
     # create SAVE_DIR if it is missing
     if not os.path.exists(SAVE_DIR):
         os.makedirs(SAVE_DIR)
 
-    mask_values = [32,209,66,115,255,255]
+    mask_values = list(MASK_VALUES)
     parser = Parser()
     use_screen, con_to_robot, use_local_file, write_file, use_debug,\
-        verbose, use_single_camera = parser.parse()
-    goal = Goal()
-    goal_history = GoalHistory()
-    live_image_server = LiveImageServer(IMAGE_SERVER_PORT)
+        verbose, use_single_camera, use_tracking, use_prediction, pyramid_factor, use_components, use_camera_workers,\
+        use_pipeline, live_kbits,\
+        save_format, save_rate, save_workers, protocol, use_udp, use_clock_sync, use_yuyv, mask_strategy = parser.parse()
+    if use_camera_workers:
+        if use_single_camera:
+            print "Camera workers need a camera each, running without them"
+        else:
+            run_camera_workers(use_screen, con_to_robot, use_local_file, write_file, use_debug, verbose,\
+                use_tracking, use_prediction, pyramid_factor, use_components, live_kbits, save_format, save_rate, save_workers,\
+                protocol, use_udp, use_clock_sync, use_yuyv, mask_strategy)
+            return
+
+    goal = Goal(pyramid_factor, use_components)
+    goal_history = GoalHistory(use_tracking, use_prediction)
+    goal_profile, gear_profile, goal_mask_strategy, gear_mask_strategy = get_camera_settings(use_yuyv, mask_strategy)
+    goal_mask_engine = MaskEngine(goal_mask_strategy)
+    gear_mask_engine = MaskEngine(gear_mask_strategy)
+    metrics = Metrics(STARTUP_TIME)
+    # the image saver's workers must be started before any threads
+    image_saver = ImageSaver(SAVE_DIR, write_file, save_format = save_format, save_rate = save_rate,\
+        save_workers = save_workers, metrics = metrics)
+    live_image_server = LiveImageServer(IMAGE_SERVER_PORT, metrics, live_kbits)
     screen = ScreenHandler(mask_values, use_screen)
-    image_saver = ImageSaver(SAVE_DIR, write_file)
 
     camera_1 = camera_2 = None
 
@@ -98,27 +273,39 @@ def main():
         camera_1 = LocalFileCameraInterface(IMAGE_NAME)
         camera_2 = LocalFileCameraInterface(IMAGE_NAME_2)
     elif use_single_camera:
-        camera_1 = camera_2 = UsbCameraInterface(0)
+        camera_1 = camera_2 = UsbCameraInterface(0, goal_profile)
     else:
-        camera_1 = UsbCameraInterface(1)
-        camera_2 = UsbCameraInterface(0)
+        camera_1 = UsbCameraInterface(1, goal_profile)
+        camera_2 = UsbCameraInterface(0, gear_profile)
 
     # create a class for managing a socket conneciton between the robot and the jetson
-    if use_debug:
-        ip_address = "127.0.0.1"
-    else:
-        ip_address = "roborio-3132-frc.local"
-    connection = ControlConnection(ip_address, RIO_PORT, con_to_robot)
+    connection = ControlConnection(get_robot_ip(use_debug), RIO_PORT, con_to_robot, protocol, use_udp, metrics,\
+        make_clock_sync(use_clock_sync, protocol, metrics))
 
-    time.sleep(2) # wait a moment to allow the camera interfaces to find some images
-    camera_1.test_camera() # These set flags as to if the camera is returning images or should be given up on
+    # frames are captured, masked and searched by the pipeline's threads
+    # and only sent and handed on by this loop (see pipeline.py)
+    pipeline = None
+    if use_pipeline:
+        pipeline = Pipeline(goal, goal_history, metrics, verbose, image_saver)
+        pipeline.start()
+
+    # the cameras open at the same time, these wait for their first frames and
+    # set flags as to if the camera is returning images or should be given up on
+    camera_1.test_camera()
     camera_2.test_camera()
+    for camera_id, camera in (("b", camera_1), ("g", camera_2)):
+        if camera.first_frame_time is not None:
+            metrics.startup.mark("camera %s first frame" % camera_id, camera.first_frame_time)
 
     print "\n________Finished setting up________\n"
+    metrics.startup.mark("setup done")
 
 
+    switch_timer = CameraSwitchTimer(metrics)
     capture_timestamp = 1
     data = "0,0,0,0\n"
+    result = None # the same as data as a VisionResult, for the binary protocol
+    last_camera_id = None
 
     while True:
         #try:
@@ -126,59 +313,112 @@ def main():
             # if the live image server and we are not trying to debug we
             # only draw a dot at the center of each goal and fps/data on the image
             # this also improves performace
-            draw_extra = live_image_server.is_image_wanted() or use_debug
+            frame_start = time.time()
+            live_wanted = live_image_server.is_image_wanted() or use_debug
+            draw_extra = live_wanted
             mask_values = screen.update_mask_values(mask_values)
+            switch_timer.update(connection.wantedCameraID(), connection.camera_id_time)
            
             # use the camera the robot needs and the corresponting selection values
-            connection.updateDesiredCameraID()
+            if pipeline is None and connection.wantedCameraID() != last_camera_id:
+                # the last target was seen by the other camera
+                goal_history.reset_tracking()
+                last_camera_id = connection.wantedCameraID()
 
+            camera = None
             if connection.wantedCameraID() == "b" and not camera_1.is_broken():
                 print "searching for a boiler"
-                camera_2.disable()
+                if camera_2 is not camera_1: # with one camera it is never disabled
+                    camera_2.disable()
                 camera_1.enable()
-
-                image, capture_timestamp = camera_1.get_image(capture_timestamp)
-                image_mask = mask_image(image, mask_values)
-                data, image = goal.find_goal(image, image_mask, goal_history,\
-                    capture_timestamp, use_screen, draw_extra, verbose, False, GOAL_SELECTION_VALUES)
+                camera = camera_1
+                mask_engine = goal_mask_engine
+                duel_target = False
+                selection_values = GOAL_SELECTION_VALUES
             
             elif connection.wantedCameraID() == "g" and not camera_2.is_broken():
                 print "searching for a gear lift"
-                camera_1.disable()
+                if camera_1 is not camera_2:
+                    camera_1.disable()
                 camera_2.enable()
+                camera = camera_2
+                mask_engine = gear_mask_engine
+                duel_target = True
+                selection_values = GEAR_SELECTION_VALUES
+
+            # frames are shared with the camera, image saver and live image server by reference
+            # (see frame_pool.py), we must release it when we have finished with it
+            frame = None
+            if camera is not None and pipeline is not None:
+                pipeline.set_settings(PipelineSettings(connection.wantedCameraID(), camera, mask_engine, mask_values,\
+                    duel_target, selection_values, draw_extra))
+                wait_start = time.time()
+                item = pipeline.get_result(connection.wantedCameraID())
+                metrics.time_since("camera_wait", wait_start)
+                if item is not None:
+                    frame = item.frame
+                    capture_timestamp = item.capture_timestamp
+                    data, image, image_mask = item.data, item.image, item.image_mask
+                    result = item.result
+                    # the frame may have been masked and searched before draw_extra changed
+                    draw_extra = item.draw_extra
+                    metrics.record_stages(item.stage_times)
 
-                image, capture_timestamp = camera_2.get_image(capture_timestamp)
-                image_mask = mask_image(image, mask_values)
-                data, image = goal.find_goal(image, image_mask, goal_history,\
-                    capture_timestamp, use_screen, draw_extra, verbose, True, GEAR_SELECTION_VALUES)
+            elif camera is not None:
+                wait_start = time.time()
+                frame = camera.get_frame(capture_timestamp)
+                metrics.time_since("camera_wait", wait_start)
+                if frame is not None:
+                    capture_timestamp = frame.capture_timestamp
+                    # the image saver gets a clean frame every 1 / save_rate seconds even while someone is watching
+                    draw_extra = draw_extra and not image_saver.is_frame_due(capture_timestamp)
+                    data, image, image_mask = process_frame(frame.image, mask_engine, mask_values, goal, goal_history,\
+                        capture_timestamp, use_screen, draw_extra, verbose, duel_target, selection_values, metrics, frame.raw)
+                    result = goal_history.last_result
             
             else:
                 print "couldn't use a camera by the id of " + connection.wantedCameraID()
+                if pipeline is not None:
+                    pipeline.set_settings(None)
                 time.sleep(1)
                 # the chosen camera is broken or doesn't exist
                 # thus send a fail whale to the driverstation and default data to the Rio
                 image = image_mask = cv2.imread(ERROR_IMAGE_NAME, 1)
-                data = "0,0,0,0\n"                
+                data = "0,0,0,0\n"
+                result = None
+                if image is not None:
+                    frame = wrap_image(image, capture_timestamp)
 
-            if image is None:
+            if frame is None:
                 print "null image, continuing"
                 time.sleep(1)
                 continue
 
             screen.display_image(image, image_mask, use_debug)
-            connection.send(data)
-            
-            # if we have drawn extra on the image send it to the live image server
-            # we reduce the images resolution and convert it to grayscale due to the
+            start = time.time()
+            connection.send(data, result)
+            start = metrics.time_since("send", start)
+            metrics.startup.mark("first result")
+            if result is not None and result.lock:
+                metrics.startup.mark("first lock")
+            if camera is not None:
+                switch_timer.got_result(switch_timer.camera_id, capture_timestamp, result is not None and result.lock)
+
+            # if someone is watching send the image to the live image server
+            # it reduces the images resolution and converts it to grayscale due to the
             # low badwidth over the fms
-            if draw_extra:
-                image = resize_gray_image(image, 0.4)
-                live_image_server.set_image(image)
+            if live_wanted:
+                live_image_server.set_frame(frame)
+                start = metrics.time_since("live_handoff", start)
                 # print(ret) # print out if we were succesfull in writing an image
-            else:
-                image_saver.give_image(image, capture_timestamp)
+            if not draw_extra:
+                image_saver.give_frame(frame, connection.wantedCameraID(), data)
+                metrics.time_since("saver_handoff", start)
                 # make sure the image doesn't have any extra drawing on it
                 # we want clean images to be able to rerun the script after a match
+            frame.release()
+            metrics.time_since("frame", frame_start)
+            metrics.record("age", time.time() - capture_timestamp)
             sys.stdout.flush()
 
        # except Exception, e:
@@ -1,54 +1,146 @@
 '''
 Pretends to be the robot by sending and revieving data from a vision script
 Use numberkeys to change cameras
-Need to do:
-  sudo pip install readchar
+
+It answers clock sync pings (detect_goals.py -y) from a pretend robot clock
+which is --skew seconds ahead of ours and runs --drift ppm fast, with up to
+--jitter ms added to each way of the trip. As both run on this computer it
+can print how far out the robot time sent with each result is:
+    python echo_server.py --skew 1234.5 --drift 50 --jitter 5
+    python detect_goals.py -d -b binary -y
 '''
 
-import socket 
-import readchar
+import optparse
+import random
+import socket
 import threading
 import time
 import sys
+from vision_protocol import RESULT_MESSAGE, PING_MESSAGE, cal_message_size, get_message_type, unpack_result,\
+    unpack_ping, pack_pong
+
+# The robot's clock
+class RobotClock():
+    def __init__(self, skew, drift_ppm):
+        self.start = time.time()
+        self.skew = skew
+        self.drift = drift_ppm * 1e-6
+
+    # converts a time from time.time() to the robot's clock
+    def to_robot_time(self, local_time):
+        return local_time + self.skew + self.drift * (local_time - self.start)
+
+    def now(self):
+        return self.to_robot_time(time.time())
 
 class Sender(threading.Thread):
-    def __init__(self):
+    def __init__(self, server_socket, clock, jitter):
         threading.Thread.__init__(self)
         self.daemon = True # Don't wait for this thread on exit
         self.client = None
+        self.server_socket = server_socket
+        self.clock = clock
+        self.jitter = jitter
+        self.send_lock = threading.Lock()
+        self.buffer = ""
         self.start()
 
     def update_client(self, new):
-    	print "new client"
-    	self.client = new
+        print "new client"
+        self.buffer = ""
+        self.client = new
+
+    def send(self, data):
+        self.send_lock.acquire()
+        try:
+            self.client.sendall(data)
+        finally:
+            self.send_lock.release()
+
+    # a random extra delay for one way of a trip
+    def delay(self):
+        if self.jitter:
+            time.sleep(random.uniform(0, self.jitter))
 
     def run(self):
-    	while True:
-    	    if self.client:
-                data = client.recv(size)
-                print(data)
-                print
+        while True:
+            if not self.client:
+                client, address = self.server_socket.accept()
+                self.update_client(client)
+                print("accepted")
+            try:
+                data = self.client.recv(size)
+            except socket.error, e:
+                print "error reading from client: " + str(e)
+                data = ""
+            if not data:
+                print "client closed the connection"
+                self.client = None
+                continue
+            self.buffer += data
+            self.handle_messages()
+
+    # handles every whole message in the buffer, text results end with a new line
+    def handle_messages(self):
+        while self.buffer:
+            message_size = cal_message_size(self.buffer)
+            if message_size is None or len(self.buffer) < message_size:
+                return
+            if message_size == 0:
+                end = self.buffer.find("\n")
+                if end < 0:
+                    return
+                print(self.buffer[:end])
+                self.buffer = self.buffer[end + 1:]
+                continue
+            message = self.buffer[:message_size]
+            self.buffer = self.buffer[message_size:]
+            message_type = get_message_type(message)
+            if message_type == PING_MESSAGE:
+                self.answer_ping(message)
+            elif message_type == RESULT_MESSAGE:
+                self.print_result(unpack_result(message))
             else:
-                time.sleep(1)
+                print "unknown message"
 
-client = 0
-backlog = 5 
+    def answer_ping(self, message):
+        ping_id, send_time = unpack_ping(message)
+        self.delay() # the ping took longer to get here
+        receive_time = self.clock.now()
+        send_time_robot = self.clock.now()
+        self.delay() # and the pong takes longer to get back
+        self.send(pack_pong(ping_id, send_time, receive_time, send_time_robot))
+
+    def print_result(self, result):
+        if result.robot_timestamp:
+            error = result.robot_timestamp - self.clock.to_robot_time(result.capture_timestamp)
+            print "%r, robot time out by %.3f ms" % (result, error * 1000)
+        else:
+            print "%r, no robot time" % result
+
+parser = optparse.OptionParser()
+parser.add_option("-p", "--port", type = "int", dest = "port", default = 5801, help = "port to listen on")
+parser.add_option("--skew", type = "float", dest = "skew", default = 0, help = "seconds the robot's clock is ahead of ours")
+parser.add_option("--drift", type = "float", dest = "drift", default = 0, help = "parts per million the robot's clock runs fast")
+parser.add_option("--jitter", type = "float", dest = "jitter", default = 0, help = "up to this many ms are added to each way of a ping's trip")
+(options, args) = parser.parse_args()
+
+backlog = 5
 size = 2048
 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-s.bind(('127.0.0.1',5801))
+s.bind(('127.0.0.1', options.port))
 s.listen(backlog)
-sender = Sender()
-
 print("bound and listening")
-while True:
-    while not client:
-        client, address = s.accept()
-        sender.update_client(client)
-        print("accepted")
+sender = Sender(s, RobotClock(options.skew, options.drift), options.jitter / 1000.0)
 
+while True:
     key = sys.stdin.readline()
+    if not key:
+        time.sleep(1) # no stdin, just answer pings
+        continue
     key = key[0]
     if key == "q":
         sys.exit(0)
-    client.send(key)
+    if sender.client:
+        sender.send(key)
@@ -0,0 +1,96 @@
+'''
+Preallocated image buffers shared between the camera thread and everything
+that uses its images (the main processing loop, the image saver and the
+live image server).
+
+Instead of each of them allocating or copying a new 640x480 image every
+frame they share one Frame by reference. Each user calls retain() when it
+starts using a frame and release() when it is finished. Once nobody is
+using the frame its buffer goes back to the pool to be filled again by the
+camera.
+
+A frame must not be written to once it has been given to someone else,
+other than by the main loop drawing on it before it hands it on.
+'''
+
+import numpy as np
+import threading
+
+FRAME_POOL_SIZE = 9 # camera, main loop, image saver (waiting and writing), live image server
+                    # and the pipeline stages and queues (see pipeline.py)
+
+class Frame():
+    def __init__(self, pool, image):
+        self.pool = pool
+        self.image = image
+        self.raw = None # the camera's undecoded image when it gives us one (see CaptureProfile.raw_yuyv)
+        self.raw_buffer = None # what the camera reads raw images into, kept when the frame is recycled
+        self.capture_timestamp = None
+        self.references = 0
+        if pool is None:
+            self.lock = threading.Lock()
+        else:
+            self.lock = pool.lock
+
+    # called by each new user of the frame
+    def retain(self):
+        self.lock.acquire()
+        self.references += 1
+        self.lock.release()
+        return self
+
+    # called when a user has finished with the frame
+    def release(self):
+        self.lock.acquire()
+        self.references -= 1
+        references = self.references
+        if references == 0 and self.pool is not None:
+            self.pool.recycle(self)
+        self.lock.release()
+        if references < 0:
+            raise ValueError("Frame released more times than it was retained")
+
+# Makes a frame for an image which isn't from a pool (eg. the error image)
+def wrap_image(image, capture_timestamp = None):
+    frame = Frame(None, image)
+    frame.capture_timestamp = capture_timestamp
+    frame.references = 1
+    return frame
+
+class FramePool():
+    def __init__(self, size = FRAME_POOL_SIZE, shape = None, dtype = np.uint8):
+        self.lock = threading.Lock()
+        self.size = size
+        self.free = []
+        self.allocations = 0
+        if shape is not None:
+            for i in range(size):
+                self.free.append(Frame(self, np.empty(shape, dtype)))
+                self.allocations += 1
+
+    # returns a frame with a buffer of the given shape which the caller holds
+    # the only reference to. A new buffer is only allocated if all of the
+    # buffers of that shape are in use.
+    def acquire(self, shape, dtype = np.uint8):
+        self.lock.acquire()
+        frame = None
+        while self.free:
+            frame = self.free.pop()
+            if frame.image.shape == shape and frame.image.dtype == dtype:
+                break
+            frame = None # wrong size, let it be garbage collected
+        if frame is None:
+            frame = Frame(self, np.empty(shape, dtype))
+            self.allocations += 1
+        frame.references = 1
+        frame.capture_timestamp = None
+        self.lock.release()
+        return frame
+
+    # called by Frame.release with the lock held
+    def recycle(self, frame):
+        if len(self.free) < self.size:
+            self.free.append(frame)
+
+    def stats(self):
+        return {"free": len(self.free), "allocations": self.allocations}
@@ -4,11 +4,15 @@ Write sample images to disk.
 As the robot will sometimes sit on the field for up to 20 minutes before
 the match starts we need to be careful how many images we keep.
 
-We are currently saving one image per second.
+We save SAVE_RATE images per second by default (one), this can be changed
+with the save_rate. Frames we are about to save (is_frame_due) are
+processed without the extra drawing for the live image, even while
+someone is watching it.
 
 Hence we write files of the format saved.0/capture_goal_%d.png where
-%d is a number from 0 to 300, will give us five minutes before it
-starts overwriting the first images.
+%d is a number from 0 to MIN_TO_SAVE minutes of images (300 at one per
+second), which gives us five minutes before it starts overwriting the
+first images.
 
 This way we only keep the last five minutes of images, so we shouldn't
 loose anything if we get to the robot within two minutes of the match
@@ -18,97 +22,292 @@ Then to prevent the next boot up from overwriting them again, on
 startup we move the "saved.0" directory to saved.1, but before we do
 that we move saved.1 to saved.2 and so on for 5 directories.
 
+Moving and deleting up to NUM_DIRS_TO_KEEP directories on an SD card can
+take a while, so on startup saved.0 is only renamed out of the way
+(saved.rotating.TIME, one quick rename) and a new saved.0 is made. Moving
+everything up happens in a background thread while we start saving.
+
 This way we can wait for four starts before losing images. Ideally
 we would copy images off after every match.
 
 Even better would be to write them to a USB key, but this didn't happen
 in time for Sydney
 
+Instead of a PNG per image the images can be recorded into a single ring
+file in saved.0 (see ring_recorder.py) which is much cheaper to write and
+also keeps which camera each image came from and what we sent the robot.
+
+PNGs can also be encoded and written by a few save worker processes (with
+save_workers) so that encoding doesn't compete with the main loop for the
+interpreter. Images wait for a worker in a queue of SAVE_QUEUE_SIZE, any
+given to us when it is full are dropped. How many images were enqueued,
+written, dropped and failed to write and how long they took to encode are
+counted in metrics so we can tell if we are keeping up with save_rate.
+Only images which are written or given to a worker use up a file number.
+
 '''
 
 import cv2
+import multiprocessing
 import numpy as np
 import os
+import Queue
 import threading
 import time
 import shutil
+import glob
+from ring_recorder import RingRecorder, RING_COMPRESSIONS
 
 
 
 MIN_TO_SAVE = 5
-IMAGES_PER_SEC = 60
+SAVE_RATE = 1 # images saved per second by default
 NUM_DIRS_TO_KEEP = 30 # Number of restarts to keep files around.
-NUM_FILES_TO_KEEP = MIN_TO_SAVE * IMAGES_PER_SEC
+SAVE_QUEUE_SIZE = 8 # images waiting for a save worker process
+SAVE_FORMATS = ["png"] + RING_COMPRESSIONS # png writes a file per image, the others use a ring file
 
 class ImageSaver(threading.Thread):
-    def __init__(self, save_dir, present):
+    # prefix is the start of each file name, each camera worker process uses its own
+    # rotate is False if the directories have already been renamed (by another process)
+    # save_format is one of SAVE_FORMATS
+    # save_rate is how many images to save per second
+    # save_workers is the number of processes to write PNGs with, 0 writes them in this thread
+    # must be created before any other threads if there are save workers
+    def __init__(self, save_dir, present, prefix = "capture_goal", rotate = True, save_format = "png",\
+            save_rate = SAVE_RATE, save_workers = 0, metrics = None):
         threading.Thread.__init__(self)
         self.condition = threading.Condition()
         self.daemon = True
         self.save_dir = save_dir
-        self.image = None
-        self.capture_timestamp = 0
-        self.written_timestamp = 0
+        self.prefix = prefix
+        self.save_format = save_format
+        self.save_interval = 1.0 / save_rate
+        self.files_to_keep = max(int(MIN_TO_SAVE * 60 * save_rate), 1)
+        self.metrics = metrics
+        self.recorder = None # created once we know the size of the images
+        self.frame = None
+        self.camera_id = None
+        self.data = None
+        self.saved_timestamp = 0 # capture timestamp of the last image we took
         self.file_number = 0
+        self.counters = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0}
+        self.encode_time = 0
+        self.workers = []
+        self.present = present
         if present:
-            self.rename_directories()
+            if rotate:
+                self.set_aside_directory()
+            if save_workers > 0:
+                if save_format == "png":
+                    self.start_workers(save_workers)
+                else:
+                    print("Save workers only write PNGs, recording %s in a thread instead" % save_format)
+            # the workers are forked first, before we start any threads
+            if rotate:
+                self.start_rotating_directories()
             self.start()
 
-    # called by the main processing thread to give it images
-    def give_image(self, image, capture_timestamp):
-        if not capture_timestamp - IMAGES_PER_SEC/60 > self.written_timestamp:
+    def start_workers(self, save_workers):
+        self.save_queue = multiprocessing.Queue(SAVE_QUEUE_SIZE)
+        self.results = multiprocessing.Queue()
+        for i in range(save_workers):
+            worker = multiprocessing.Process(target = save_images, args = (self.save_queue, self.results))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    # counters are only changed by one thread each, give_frame changes
+    # enqueued and dropped and this thread changes written and failed
+    def count(self, name):
+        self.counters[name] += 1
+        if self.metrics:
+            self.metrics.count("saver_" + name)
+
+    def record_encode_time(self, seconds):
+        self.encode_time += seconds
+        if self.metrics:
+            self.metrics.record("saver_encode", seconds)
+
+    # returns the counters and the mean time to encode an image which was written in milliseconds
+    def stats(self):
+        stats = dict(self.counters)
+        stats["encode_ms"] = 0
+        if self.counters["written"]:
+            stats["encode_ms"] = self.encode_time * 1000 / self.counters["written"]
+        return stats
+
+    # returns True if a frame captured at capture_timestamp would be saved, so
+    # whoever processes it can leave the extra drawing for the live image off
+    def is_frame_due(self, capture_timestamp):
+        return self.present and capture_timestamp - self.saved_timestamp >= self.save_interval
+
+    # called by the main processing thread to give it frames (see frame_pool.py)
+    # the frame is kept by reference until it has been written
+    # camera_id and data (what was sent to the robot) are recorded with it by the ring recorder
+    def give_frame(self, frame, camera_id = None, data = None):
+        capture_timestamp = frame.capture_timestamp
+        if not self.is_frame_due(capture_timestamp):
             return
+        self.saved_timestamp = capture_timestamp
+        self.count("enqueued")
+        if self.workers:
+            self.queue_image(frame)
+            return
+        frame.retain()
         self.condition.acquire()
-        self.image = np.copy(image)
-        self.capture_timestamp = capture_timestamp
+        old_frame = self.frame
+        self.frame = frame
+        self.camera_id = camera_id
+        self.data = data
         self.condition.notify()
         self.condition.release()
+        if old_frame is not None:
+            # it was replaced before it could be written
+            old_frame.release()
+            self.count("dropped")
+
+    # gives a copy of the image to the save workers, the frame can be
+    # reused as soon as this returns
+    def queue_image(self, frame):
+        try:
+            self.save_queue.put_nowait((self.get_filename(), frame.image.tostring(), frame.image.shape,\
+                frame.image.dtype.str))
+        except Queue.Full:
+            self.count("dropped")
+            return
+        self.advance_file_number()
+
+    # the file the next image will be written to
+    def get_filename(self):
+        return os.path.join(self.get_dir_path(0), "%s_%03d.png" % (self.prefix, self.file_number))
+
+    # called once an image has been taken to be written to get_filename
+    def advance_file_number(self):
+        self.file_number += 1
+        self.file_number %= self.files_to_keep
+
+    def get_next_filename(self):
+        filename = self.get_filename()
+        self.advance_file_number()
+        return filename
 
-    # Saves image to a specified directory making sure they are at least 1 second appart
+    # Saves the newest image we have been given to a specified directory
+    # (give_frame makes sure they are at least 1 / save_rate seconds appart)
     def maybe_write_image(self):
         self.condition.acquire()
         # block until we are given a new image
-        self.condition.wait()
-        image = self.image
-        self.written_timestamp = self.capture_timestamp
+        while self.frame is None:
+            self.condition.wait()
+        frame = self.frame
+        camera_id = self.camera_id
+        data = self.data
+        self.frame = None
         self.condition.release()
-        
-        filename = os.path.join(self.get_dir_path(0), "capture_goal_%03d.png" % self.file_number)
-        cv2.imwrite(filename, image)
-        self.file_number += 1
-        self.file_number %= NUM_FILES_TO_KEEP
+
+        start = time.time()
+        if self.save_format == "png":
+            written = cv2.imwrite(self.get_next_filename(), frame.image)
+        else:
+            written = self.record_image(frame, camera_id, data)
+        frame.release()
+        self.count_result(written, time.time() - start)
+
+    # counts an image as written (and how long it took) or as failed
+    def count_result(self, written, encode_time):
+        if not written:
+            self.count("failed")
+            return
+        self.record_encode_time(encode_time)
+        self.count("written")
+
+    # counts the images written by the save workers
+    def collect_results(self):
+        written, encode_time = self.results.get()
+        self.count_result(written, encode_time)
+        if self.metrics:
+            self.metrics.set_gauge("saver_queued", self.save_queue.qsize())
+
+    # writes the image into the ring file, images which aren't the size of
+    # the first one (eg. the error image) are skipped, returns False if it was
+    def record_image(self, frame, camera_id, data):
+        if self.recorder is None:
+            path = os.path.join(self.get_dir_path(0), "%s.ring" % self.prefix)
+            self.recorder = RingRecorder(path, frame.image.shape, self.files_to_keep, self.save_format)
+        return self.recorder.write(frame.image, frame.capture_timestamp, camera_id, data)
 
     def run(self):
         while True:
+            if self.workers:
+                self.collect_results()
+            else:
                 self.maybe_write_image()
 
     def get_dir_path(self, dir_num):
         return os.path.join(self.save_dir, "saved.%d" % dir_num)
 
+    # Makes a new saved.0 straight away and moves the old directories up in
+    # the background (see set_aside_directory and rotate_directories)
+    def rename_directories(self):
+        self.set_aside_directory()
+        self.start_rotating_directories()
+
+    # Renames saved.0 out of the way to be rotated and makes a new one
+    def set_aside_directory(self):
+        first_dir = self.get_dir_path(0)
+        if os.path.exists(first_dir):
+            os.rename(first_dir, os.path.join(self.save_dir, "saved.rotating.%.3f" % time.time()))
+        # Make the first directory
+        os.mkdir(first_dir)
+
+    def start_rotating_directories(self):
+        thread = threading.Thread(target = self.rotate_directories)
+        thread.daemon = True
+        thread.start()
+
     """
-    Rename saved.(N) to saved.(N+1) while only keeping NUM_DIRS_TO_KEEP.
+    Rename saved.(N) to saved.(N+1) while only keeping NUM_DIRS_TO_KEEP,
+    then the directory set aside becomes saved.1. If we were stopped part
+    way through last time there can be more than one set aside, they are
+    rotated in, oldest first.
     If NUM_DIRS_TO_KEEP=5, the first directory is saved.0 and the last directory
      is saved.4
     """
-    def rename_directories(self):
-        # Remove the oldest.
-        try:
-            shutil.rmtree(self.get_dir_path(NUM_DIRS_TO_KEEP - 1))
-        except OSError, e:
-            # This is likely fine.
-            print("Possibly expected error when deleting old directory: %s" % e)
-        # Move everyone else up a directory.
-        dir_num = NUM_DIRS_TO_KEEP - 1
-        while dir_num > 0:
-            source = self.get_dir_path(dir_num - 1)
-            destination = self.get_dir_path(dir_num)
-            print("Renaming directory %s to %s" % (source, destination))
-            dir_num -= 1
+    def rotate_directories(self):
+        start = time.time()
+        set_aside = sorted(glob.glob(os.path.join(self.save_dir, "saved.rotating.*")),\
+            key = lambda path: float(path.split("saved.rotating.")[-1]))
+        for rotating_dir in set_aside:
+            # Remove the oldest.
             try:
-                shutil.move(source, destination)
-            except IOError, e:
-                print("Possibly expected error when renaming directory: %s" % e)
-                # Try the next directory
-        print
-        # Make the first directory
-        os.mkdir(self.get_dir_path(0))
+                shutil.rmtree(self.get_dir_path(NUM_DIRS_TO_KEEP - 1))
+            except OSError, e:
+                # This is likely fine.
+                print("Possibly expected error when deleting old directory: %s" % e)
+            # Move everyone else up a directory, saved.0 is the one we are writing to now
+            dir_num = NUM_DIRS_TO_KEEP - 1
+            while dir_num > 1:
+                source = self.get_dir_path(dir_num - 1)
+                destination = self.get_dir_path(dir_num)
+                dir_num -= 1
+                if not os.path.exists(source):
+                    continue
+                try:
+                    shutil.move(source, destination)
+                except IOError, e:
+                    print("Possibly expected error when renaming directory: %s" % e)
+                    # Try the next directory
+            print("Renaming directory %s to %s" % (rotating_dir, self.get_dir_path(1)))
+            shutil.move(rotating_dir, self.get_dir_path(1))
+        print("Rotated directories in %.3f s" % (time.time() - start))
+        if self.metrics:
+            self.metrics.startup.mark("directories rotated")
+
+# Runs in each save worker process, writes the images it is given and
+# sends back whether each was written and how long it took
+def save_images(save_queue, results):
+    while True:
+        filename, image_bytes, shape, dtype = save_queue.get()
+        start = time.time()
+        image = np.frombuffer(image_bytes, dtype).reshape(shape)
+        written = cv2.imwrite(filename, image)
+        results.put((written, time.time() - start))
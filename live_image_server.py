@@ -3,13 +3,30 @@
 # and supplies them from memory.
 
 import SimpleHTTPServer
+import json
 import SocketServer
+import socket
 import threading
 import numpy as np
 import cv2
 import time
+from frame_pool import wrap_image
+from process_image import resize_gray_image, cal_image_size, cal_resized_size
 
 PORT = 5802
+LIVE_IMAGE_SCALE = 0.4 # the live image is made smaller and grayscale due to the low bandwidth over the fms
+LIVE_JPEG_QUALITY = 70
+MJPEG_BOUNDARY = "liveimageframe"
+MJPEG_RESEND_AFTER = 1 # seconds without a new frame before the last one is sent again
+
+# the live stream is kept under a bandwidth budget by making it worse one step at a time,
+# first the jpeg quality, then the size of the image and only then the frame rate
+LIVE_BANDWIDTH_KBITS = 1000 # default budget, the fms allows 4000 kbit/s for the whole robot
+LIVE_JPEG_QUALITIES = [LIVE_JPEG_QUALITY, 55, 40, 30, 20]
+LIVE_IMAGE_SCALES = [LIVE_IMAGE_SCALE, 0.3, 0.2]
+LIVE_FPS_LIMITS = [30, 15, 10, 5, 2]
+RATE_PERIOD = 1 # seconds between adjustments of the stream
+RATE_STEP_UP_FRACTION = 0.6 # the stream is only made better when using less than this much of the budget
 
 '''
 Handles communication between the thread that is generating images
@@ -17,24 +34,68 @@ and the thread that is serving them.
 We normally don't want to draw in the images where the goals are,
 but if someone is waiting for an image, then draw on the next one
 and supply it.
+The main thread gives us a reference to its frame (see frame_pool.py), it is
+made smaller and grayscale here so the main thread doesn't have to.
 '''
 class ImageSource(object):
     def __init__(self):
         self.condition = threading.Condition()
         self.waiting_for_image = False
-        self.img = None
+        self.frame = None
+        self.sequence = 0 # counts the frames we have been given
+        # reused between images instead of allocating new ones
+        self.resized = None
+        self.gray = None
+        self.encode_lock = threading.Lock() # the buffers are shared by every request
 
-    # waits for the main processing thread to give us an image
-    def wait_for_image(self):
+    # waits for the main processing thread to give us a frame
+    # the caller must release() it when it has finished with it
+    def wait_for_frame(self):
         self.condition.acquire()
         self.waiting_for_image = True
-        while self.img is None:
+        while self.frame is None:
             # Block waiting for an image to be given to us.
             self.condition.wait()
         # there is an image available.
-        image = self.img
+        frame = self.frame.retain()
+        self.condition.release()
+        return frame
+
+    # waits up to timeout seconds for a frame other than old_sequence and
+    # returns it and its sequence number. If there isn't a new one the last
+    # frame is returned again, or None if we have never had one.
+    # the caller must release() the frame when it has finished with it
+    def wait_for_new_frame(self, old_sequence, timeout):
+        give_up_time = time.time() + timeout
+        self.condition.acquire()
+        self.waiting_for_image = True
+        while self.frame is None or self.sequence == old_sequence:
+            wait_time = give_up_time - time.time()
+            if wait_time <= 0:
+                break
+            self.condition.wait(wait_time)
+        frame = None
+        if self.frame is not None:
+            frame = self.frame.retain()
+        sequence = self.sequence
         self.condition.release()
-        return image
+        return frame, sequence
+
+    # makes the live image from frame and encodes it as extension (".png" or ".jpg")
+    def encode_frame(self, frame, extension, params = [], scale = LIVE_IMAGE_SCALE):
+        self.encode_lock.acquire()
+        img = self.make_live_image(frame.image, scale)
+        retval, buf = cv2.imencode(extension, img, params)
+        self.encode_lock.release()
+        return buf.tostring()
+
+    # makes the image smaller and grayscale, reusing the same buffers each time
+    def make_live_image(self, image, scale = LIVE_IMAGE_SCALE):
+        width, height = cal_resized_size(cal_image_size(image), scale)
+        if self.gray is None or self.gray.shape != (height, width):
+            self.resized = np.empty((height, width, 3), np.uint8)
+            self.gray = np.empty((height, width), np.uint8)
+        return resize_gray_image(image, scale, self.resized, self.gray)
 
     # called by the main processing thread to determine if it should give
     # us an image. We draw all information on the images we give to the live
@@ -46,54 +107,297 @@ class ImageSource(object):
         self.condition.release()
         return image_required
 
-    # recieves an image from the main processing thread
-    def set_image(self, img):
+    # recieves a frame from the main processing thread
+    def set_frame(self, frame):
+        frame.retain()
         self.condition.acquire()
-        self.img = img
+        old_frame = self.frame
+        self.frame = frame
+        self.sequence += 1
         self.waiting_for_image = False
-        self.condition.notify()
+        self.condition.notify_all()
+        self.condition.release()
+        if old_frame is not None:
+            old_frame.release()
+
+# every (quality, scale, fps) the live stream can use from best to worst,
+# each one is one step worse than the last
+def cal_rate_levels():
+    levels = []
+    for quality in LIVE_JPEG_QUALITIES:
+        levels.append((quality, LIVE_IMAGE_SCALES[0], LIVE_FPS_LIMITS[0]))
+    for scale in LIVE_IMAGE_SCALES[1:]:
+        levels.append((LIVE_JPEG_QUALITIES[-1], scale, LIVE_FPS_LIMITS[0]))
+    for fps in LIVE_FPS_LIMITS[1:]:
+        levels.append((LIVE_JPEG_QUALITIES[-1], LIVE_IMAGE_SCALES[-1], fps))
+    return levels
+
+'''
+Keeps the live stream under budget_kbits. The bytes of each JPEG encoded
+and the bytes actually sent to all of the clients are counted, once every
+RATE_PERIOD the stream is made one step worse if we sent more than the
+budget or one step better if we used much less.
+'''
+class RateController():
+    def __init__(self, budget_kbits = LIVE_BANDWIDTH_KBITS, metrics = None):
+        self.budget_kbits = budget_kbits
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.levels = cal_rate_levels()
+        self.level = 0
+        self.period_start = time.time()
+        self.sent_bytes = 0
+        self.encoded_bytes = 0
+        self.encoded_frames = 0
+        # measured over the last period
+        self.send_kbits = 0
+        self.frame_bytes = 0
+        self.encode_fps = 0
+
+    # returns the jpeg quality, image scale and most frames per second to use
+    def get_settings(self):
+        return self.levels[self.level]
+
+    def record_encoded(self, num_bytes):
+        self.lock.acquire()
+        self.encoded_bytes += num_bytes
+        self.encoded_frames += 1
+        self.lock.release()
+
+    # called by every client after it sends a JPEG
+    def record_sent(self, num_bytes):
+        self.lock.acquire()
+        self.sent_bytes += num_bytes
+        self.lock.release()
+
+    # called often by the encoder, adjusts the stream once every RATE_PERIOD
+    def update(self):
+        now = time.time()
+        elapsed = now - self.period_start
+        if elapsed < RATE_PERIOD:
+            return
+        self.lock.acquire()
+        self.send_kbits = self.sent_bytes * 8 / 1000.0 / elapsed
+        if self.encoded_frames:
+            self.frame_bytes = self.encoded_bytes / self.encoded_frames
+        self.encode_fps = self.encoded_frames / elapsed
+        self.sent_bytes = self.encoded_bytes = self.encoded_frames = 0
+        self.period_start = now
+        self.lock.release()
+
+        if self.send_kbits > self.budget_kbits and self.level < len(self.levels) - 1:
+            self.level += 1
+        elif self.send_kbits < self.budget_kbits * RATE_STEP_UP_FRACTION and self.level > 0:
+            self.level -= 1
+        if self.metrics:
+            self.metrics.set_gauge("live_send_kbits", round(self.send_kbits, 1))
+            self.metrics.set_gauge("live_level", self.level)
+
+    # what the stream is doing, served on /stream
+    def status(self):
+        quality, scale, fps = self.get_settings()
+        return {"budget_kbits": self.budget_kbits, "send_kbits": self.send_kbits, "frame_bytes": self.frame_bytes,\
+            "encode_fps": self.encode_fps, "quality": quality, "scale": scale, "max_fps": fps,\
+            "level": self.level, "worst_level": len(self.levels) - 1}
+
+'''
+Encodes each new live image as a JPEG once, in its own thread, and keeps
+the bytes for every live.mjpg client to send. Each client sends the newest
+JPEG whenever it is ready for another, so a slow client (eg. over the fms)
+skips frames instead of holding up the encoder or the other clients.
+Nothing is encoded, or asked of the main thread, while there are no clients.
+The quality, size and frame rate come from the RateController.
+'''
+class LiveImageBroadcaster(threading.Thread):
+    def __init__(self, img_src, metrics=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.img_src = img_src
+        self.metrics = metrics
+        self.rate_controller = RateController()
+        self.condition = threading.Condition()
+        self.clients = 0
+        self.jpeg = None
+        self.sequence = 0 # counts the JPEGs encoded
+
+    def add_client(self):
+        self.condition.acquire()
+        self.clients += 1
+        self.condition.notify_all()
+        self.condition.release()
+        self.set_client_gauge()
+
+    def remove_client(self):
+        self.condition.acquire()
+        self.clients -= 1
         self.condition.release()
+        self.set_client_gauge()
+
+    def set_client_gauge(self):
+        if self.metrics:
+            self.metrics.set_gauge("live_clients", self.clients)
+
+    def run(self):
+        frame_sequence = None
+        next_encode_time = 0
+        while True:
+            self.condition.acquire()
+            while self.clients == 0:
+                self.condition.wait()
+            self.condition.release()
+
+            self.rate_controller.update()
+            quality, scale, fps = self.rate_controller.get_settings()
+            # wait before asking for a frame so we encode the newest one
+            wait_time = next_encode_time - time.time()
+            if wait_time > 0:
+                time.sleep(wait_time)
+            frame, new_sequence = self.img_src.wait_for_new_frame(frame_sequence, MJPEG_RESEND_AFTER)
+            if frame is None:
+                continue
+            if new_sequence == frame_sequence:
+                # nothing new, the clients send the last JPEG again
+                frame.release()
+                continue
+            frame_sequence = new_sequence
+            start = time.time()
+            next_encode_time = start + 1.0 / fps
+            jpeg = self.img_src.encode_frame(frame, ".jpg", [cv2.IMWRITE_JPEG_QUALITY, quality], scale)
+            frame.release()
+            self.rate_controller.record_encoded(len(jpeg))
+            if self.metrics:
+                self.metrics.time_since("live_encode", start)
+
+            self.condition.acquire()
+            self.jpeg = jpeg
+            self.sequence += 1
+            self.condition.notify_all()
+            self.condition.release()
+
+    # waits up to timeout seconds for a JPEG newer than old_sequence and
+    # returns the newest JPEG (None if there hasn't been one) and its sequence
+    # number. Frames encoded since old_sequence but never sent are counted as skipped.
+    def wait_for_jpeg(self, old_sequence, timeout):
+        give_up_time = time.time() + timeout
+        self.condition.acquire()
+        while self.jpeg is None or self.sequence == old_sequence:
+            wait_time = give_up_time - time.time()
+            if wait_time <= 0:
+                break
+            self.condition.wait(wait_time)
+        jpeg = self.jpeg
+        sequence = self.sequence
+        if self.metrics and old_sequence and sequence > old_sequence + 1:
+            self.metrics.count("live_frames_skipped", sequence - old_sequence - 1)
+        self.condition.release()
+        return jpeg, sequence
 
 
 '''
 Handles HTTP GET requests, supplying live.png from the ImageSource instead of
-the file system.
+the file system. live.mjpg streams every new image as a JPEG over one
+connection (multipart/x-mixed-replace) so the browser doesn't have to keep
+asking for them. /stream reports the bandwidth the stream is using and the
+quality chosen to stay under its budget. /metrics and /metrics.json report
+how long each stage of the main loop is taking.
 '''
 class GetHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     img_src = ImageSource()
+    broadcaster = LiveImageBroadcaster(img_src)
+    metrics = None
 
     def do_GET(self):
+        if self.path.startswith("/metrics") and self.metrics:
+            if self.path.startswith("/metrics.json"):
+                self.send_text(self.metrics.to_json(), "application/json")
+            else:
+                self.send_text(self.metrics.to_text(), "text/plain")
+            return
+
+        if self.path.startswith("/stream"):
+            status = self.broadcaster.rate_controller.status()
+            status["clients"] = self.broadcaster.clients
+            self.send_text(json.dumps(status, sort_keys=True), "application/json")
+            return
+
+        if "/live.mjpg" in self.path:
+            self.send_mjpeg()
+            return
+
         if "/live.png" in self.path:
-            img = self.img_src.wait_for_image()
+            frame = self.img_src.wait_for_frame()
+            start = time.time()
+            buf = self.img_src.encode_frame(frame, ".png")
+            frame.release()
             #print("Sending live camera image")
-            retval,buf = cv2.imencode(".png", img)
-            buf = np.array(buf)
-            length = len(buf)
+            if self.metrics:
+                self.metrics.time_since("live_resize_encode", start)
             self.send_response(200)
             self.send_header("Content-type", 'image/png')
             self.send_header("Last-Modified", self.date_time_string(time.time()))
             self.end_headers()
-            self.wfile.write(buf.tostring())
+            self.wfile.write(buf)
             return
 
         return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
 
+    # sends each new JPEG from the broadcaster as a part of a multipart
+    # response until the client goes away
+    def send_mjpeg(self):
+        self.send_response(200)
+        self.send_header("Content-type", "multipart/x-mixed-replace; boundary=" + MJPEG_BOUNDARY)
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        # the frames are sent straight to the socket so nothing is left
+        # buffered in wfile if the client goes away
+        self.wfile.flush()
+        sequence = None
+        self.broadcaster.add_client()
+        try:
+            while True:
+                jpeg, sequence = self.broadcaster.wait_for_jpeg(sequence, MJPEG_RESEND_AFTER)
+                if jpeg is None:
+                    continue
+                part = "--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n%s\r\n" %\
+                    (MJPEG_BOUNDARY, len(jpeg), jpeg)
+                self.connection.sendall(part)
+                self.broadcaster.rate_controller.record_sent(len(part))
+        except socket.error:
+            print("live.mjpg client disconnected")
+        finally:
+            self.broadcaster.remove_client()
+
+    def send_text(self, text, content_type):
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(text)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(text)
+
 '''
 Listens on the supplied port and runs a GetHandler for the live.png requests.
+Each request gets its own thread so a live.mjpg stream doesn't stop anyone
+else from being served.
 '''
 class LiveImageServer(threading.Thread):
-    def __init__(self, port):
+    def __init__(self, port, metrics=None, bandwidth_kbits=LIVE_BANDWIDTH_KBITS):
         threading.Thread.__init__(self)
         self.daemon = True
         self.port = port
+        GetHandler.metrics = metrics
+        GetHandler.broadcaster.metrics = metrics
+        GetHandler.broadcaster.rate_controller = RateController(bandwidth_kbits, metrics)
+        GetHandler.broadcaster.start()
         self.start_time = time.time()
         self.frame = 0
         self.fps = 0
         self.start()
 
     def run(self):
-        SocketServer.TCPServer.allow_reuse_address = True
-        self.httpd = SocketServer.TCPServer(("", self.port), GetHandler)
+        SocketServer.ThreadingTCPServer.allow_reuse_address = True
+        SocketServer.ThreadingTCPServer.daemon_threads = True
+        self.httpd = SocketServer.ThreadingTCPServer(("", self.port), GetHandler)
         print "LiveImageServer serving web requests on port", self.port
         print
         self.httpd.serve_forever()
@@ -102,10 +406,10 @@ class LiveImageServer(threading.Thread):
     def is_image_wanted(self):
         return GetHandler.img_src.is_image_wanted()
 
-    # Call to supply the image.
-    def set_image(self, img):
+    # Call to supply the frame, it is kept by reference until the next one
+    def set_frame(self, frame):
         #print("setting image")
-        GetHandler.img_src.set_image(img)
+        GetHandler.img_src.set_frame(frame)
 
     # calculates the frequency of where it is called
     def track_fps(self):
@@ -123,6 +427,8 @@ if __name__ == "__main__":
         if GetHandler.img_src.is_image_wanted():
             # Normally we'd write on the image here...
             # ...and then make it available to who asked for it.
-            GetHandler.img_src.set_image(frame)
+            frame = wrap_image(frame, time.time())
+            GetHandler.img_src.set_frame(frame)
+            frame.release()
         else:
             time.sleep(0.01)
@@ -0,0 +1,253 @@
+'''
+Different ways of turning a BGR image into a mask of the vision targets.
+
+"hsv" is the original mask_image(): convert the whole image to HSV and
+then check each pixel is inside mask_values.
+
+"lut" skips the HSV image. Each pixel's three bytes are copied into a
+zeroed 4 byte pixel and read as one 24 bit number, which indexes a table
+of every BGR colour (16MB) saying if it is inside mask_values. So masking
+is a single lookup per pixel and matches "hsv" exactly. The table takes
+about 170ms to build and is only rebuilt when mask_values change (eg.
+when a trackbar is moved).
+
+"green_minus_red" and "green" are cheaper approximations which work because
+the LED ring and low exposure mean the targets are about the only bright
+green things in the image. They use mask_values[2] (lower V) as the
+brightness threshold.
+
+"yuyv" masks the raw YUYV image a camera gives us with a raw_yuyv capture
+profile, without decoding it to BGR or converting it to HSV. The same LED
+ring and exposure mean almost every pixel is dark, so it thresholds the Y
+(luma) plane first at the lowest luma any colour inside mask_values can
+have, then only the few pixels left have their chroma (U and V, shared by
+each pair of pixels) checked in a table indexed by Y and the top LUT_BITS
+bits of U and V, built by putting every entry through the same YUYV to BGR
+to HSV conversion the frame would have gone through. The table is only
+rebuilt when mask_values change (eg. when a trackbar is moved). Given a BGR image (eg. a
+local file) it falls back to "hsv".
+
+Run this file directly to compare their speed and how closely they match
+"hsv":
+    python mask_engine.py [-n 100] [image.png ...]
+"yuyv" is given each image converted to YUYV by bgr_to_yuyv.
+'''
+
+import cv2
+import numpy as np
+import optparse
+import time
+from process_image import mask_image, crop_image
+
+MASK_STRATEGIES = ["hsv", "lut", "green_minus_red", "green", "yuyv"]
+LUT_BITS = 6 # bits of U and V kept by the "yuyv" table
+GREEN_MINUS_RED_THRESHOLD = 40 # how much greener than red a pixel has to be
+YUYV_SPARSE_FRACTION = 0.05 # of the pixels, above this many bright ones "yuyv" decodes the whole image
+
+class MaskEngine():
+    def __init__(self, strategy = "hsv"):
+        if strategy not in MASK_STRATEGIES:
+            raise ValueError("unknown mask strategy %s, expected one of %s" % (strategy, MASK_STRATEGIES))
+        self.strategy = strategy
+        self.lut_values = None
+        self.lut = None
+        self.lut_builds = 0
+        self.packed = None # 4 byte pixels reused by "lut", the 4th byte stays 0
+        self.yuyv_lut = None
+        self.min_luma = 0
+
+    # masks the part of image inside roi (the whole image if it is None),
+    # raw is the frame's raw yuyv image if the camera gave us one
+    def mask_roi(self, image, roi, mask_values, raw = None):
+        if self.strategy == "yuyv" and raw is not None:
+            return self.mask_yuyv(raw, roi, mask_values)
+        return self.mask(crop_image(image, roi), mask_values)
+
+    # returns a mask of image which is 255 where the targets are and 0 elsewhere
+    def mask(self, image, mask_values):
+        if image is None:
+            print("Trying to mask a null image")
+        if self.strategy == "hsv" or self.strategy == "yuyv":
+            return mask_image(image, mask_values)
+        if self.strategy == "lut":
+            return self.mask_lut(image, mask_values)
+        if self.strategy == "green_minus_red":
+            return mask_green_minus_red(image, mask_values)
+        return mask_green(image, mask_values)
+
+    def mask_lut(self, image, mask_values):
+        if self.lut is None or tuple(mask_values) != self.lut_values:
+            self.lut = cal_colour_lut(mask_values)
+            self.lut_values = tuple(mask_values)
+            self.lut_builds += 1
+        if self.packed is None or self.packed.shape[:2] != image.shape[:2]:
+            self.packed = np.zeros(image.shape[:2] + (4,), np.uint8)
+        # blue, green and red become the low 3 bytes of a little endian uint32
+        cv2.mixChannels([image], [self.packed], [0,0, 1,1, 2,2])
+        index = self.packed.view("<u4")[:, :, 0]
+        return self.lut.take(index, mode = "clip") # always in range, clip skips the check
+
+    def mask_yuyv(self, raw, roi, mask_values):
+        if self.yuyv_lut is None or tuple(mask_values) != self.lut_values:
+            self.yuyv_lut, self.min_luma = cal_yuyv_lut(mask_values, LUT_BITS)
+            self.lut_values = tuple(mask_values)
+            self.lut_builds += 1
+        x, y, w, h = 0, 0, raw.shape[1], raw.shape[0]
+        if roi is not None:
+            x, y, w, h = roi
+        luma = cv2.extractChannel(crop_image(raw, roi), 0)
+        image_mask = np.zeros(luma.shape, np.uint8)
+        if self.min_luma > 255:
+            return image_mask # nothing can be inside mask_values
+        ret, bright = cv2.threshold(luma, self.min_luma - 1, 255, cv2.THRESH_BINARY)
+        bright_count = cv2.countNonZero(bright)
+        if bright_count == 0:
+            return image_mask
+        if bright_count > YUYV_SPARSE_FRACTION * luma.size:
+            # too many to check one by one, decoding the whole image is quicker
+            # from the pair roi starts in
+            pair_x = x & ~1
+            pairs = raw[y:y+h, pair_x:(x + w + 1) & ~1]
+            colours = cv2.cvtColor(pairs, cv2.COLOR_YUV2BGR_YUYV)
+            return mask_image(colours[:, x - pair_x:x - pair_x + w], mask_values)
+        candidates = cv2.findNonZero(bright)
+        columns = candidates[:, 0, 0]
+        rows = candidates[:, 0, 1]
+        # U is in the even pixel of each pair and V in the odd one, the pairs
+        # start on even columns of the full image
+        raw_pixels = (rows + y) * raw.shape[1] + ((columns + x) & ~1)
+        raw_values = raw.reshape(-1)
+        u = raw_values.take(raw_pixels * 2 + 1)
+        v = raw_values.take(raw_pixels * 2 + 3)
+        pixels = rows * luma.shape[1] + columns
+        index = (luma.reshape(-1).take(pixels).astype(np.int32) << (2 * LUT_BITS)) |\
+            ((u >> (8 - LUT_BITS)).astype(np.int32) << LUT_BITS) | (v >> (8 - LUT_BITS))
+        image_mask.reshape(-1).put(pixels, self.yuyv_lut.take(index))
+        return image_mask
+
+# creates a table of 255 or 0 for every Y (all 8 bits) and U and V (the top
+# bits of each) depending on if that colour is inside mask_values once a
+# YUYV image is converted to BGR and then HSV, and returns it with the
+# lowest Y of any colour inside mask_values
+def cal_yuyv_lut(mask_values, bits):
+    size = 1 << bits
+    center = (np.arange(size) << (8 - bits)) + (1 << (7 - bits))
+    luma, u, v = np.meshgrid(np.arange(256), center, center, indexing="ij")
+    # each entry becomes a pair of pixels, Y U and Y V
+    pairs = np.empty((luma.size, 2, 2), np.uint8)
+    pairs[:, 0, 0] = pairs[:, 1, 0] = luma.ravel()
+    pairs[:, 0, 1] = u.ravel()
+    pairs[:, 1, 1] = v.ravel()
+    yuyv = pairs.reshape(size * 16, -1, 2) # any shape with an even width
+    colours = cv2.cvtColor(yuyv, cv2.COLOR_YUV2BGR_YUYV)
+    lut = mask_image(colours, mask_values).reshape(-1, 2)[:, 0].copy()
+    return lut, cal_min_luma(mask_values, bits)
+
+# returns the lowest Y any BGR colour inside mask_values can have. Some of
+# the YUV colours outside of what BGR can show (which a camera doesn't give
+# us) would pass with less, they are ignored.
+def cal_min_luma(mask_values, bits):
+    colours_lut = cal_mask_lut(mask_values, bits)
+    inside = np.flatnonzero(colours_lut)
+    if len(inside) == 0:
+        return 256
+    size = 1 << bits
+    center = (np.arange(size) << (8 - bits)) + (1 << (7 - bits))
+    blue = center[inside >> (2 * bits)]
+    green = center[(inside >> bits) & (size - 1)]
+    red = center[inside & (size - 1)]
+    luma = 16 + 0.257 * red + 0.504 * green + 0.098 * blue
+    # a colour inside mask_values can be up to half a bucket darker than the center tested
+    margin = (1 << (7 - bits)) * (0.257 + 0.504 + 0.098) + 1
+    return max(int(np.floor(luma.min() - margin)), 0)
+
+# the YUYV image a camera would give us for a BGR image, the inverse of
+# cv2.COLOR_YUV2BGR_YUYV (BT.601 limited range), used to test "yuyv" on
+# saved images
+def bgr_to_yuyv(image):
+    bgr = image.astype(np.float32)
+    blue, green, red = bgr[:, :, 0], bgr[:, :, 1], bgr[:, :, 2]
+    luma = 16 + 0.257 * red + 0.504 * green + 0.098 * blue
+    u = 128 - 0.148 * red - 0.291 * green + 0.439 * blue
+    v = 128 + 0.439 * red - 0.368 * green - 0.071 * blue
+    yuyv = np.empty(image.shape[:2] + (2,), np.uint8)
+    yuyv[:, :, 0] = np.clip(np.round(luma), 0, 255)
+    # each pair of pixels shares the average of their chroma
+    yuyv[:, 0::2, 1] = np.clip(np.round((u[:, 0::2] + u[:, 1::2]) / 2), 0, 255)
+    yuyv[:, 1::2, 1] = np.clip(np.round((v[:, 0::2] + v[:, 1::2]) / 2), 0, 255)
+    return yuyv
+
+# creates a table of 255 or 0 for every BGR colour, indexed by
+# blue | green << 8 | red << 16, depending on if it is inside mask_values
+def cal_colour_lut(mask_values):
+    colours = np.arange(1 << 24, dtype = "<u4").view(np.uint8).reshape(4096, 4096, 4)
+    return mask_image(np.ascontiguousarray(colours[:, :, :3]), mask_values).ravel()
+
+# creates a table of 255 or 0 for every colour reduced to the top bits of
+# each channel (blue, green then red from the highest bits down) depending
+# on if the colour is inside mask_values. Each packed colour is tested at the center
+# of the range of BGR values that it covers
+def cal_mask_lut(mask_values, bits):
+    size = 1 << bits
+    center = (np.arange(size) << (8 - bits)) + (1 << (7 - bits))
+    blue, green, red = np.meshgrid(center, center, center, indexing="ij")
+    colours = np.dstack((blue.ravel(), green.ravel(), red.ravel())).astype(np.uint8)
+    return mask_image(colours, mask_values).ravel()
+
+# keeps pixels which are bright and much greener than they are red
+def mask_green_minus_red(image, mask_values):
+    green = cv2.extractChannel(image, 1)
+    red = cv2.extractChannel(image, 2)
+    difference = cv2.subtract(green, red)
+    ret, greener = cv2.threshold(difference, GREEN_MINUS_RED_THRESHOLD, 255, cv2.THRESH_BINARY)
+    ret, bright = cv2.threshold(green, mask_values[2] - 1, 255, cv2.THRESH_BINARY)
+    return cv2.bitwise_and(greener, bright)
+
+# keeps pixels which have a bright green channel
+def mask_green(image, mask_values):
+    green = cv2.extractChannel(image, 1)
+    ret, image_mask = cv2.threshold(green, mask_values[2] - 1, 255, cv2.THRESH_BINARY)
+    return image_mask
+
+# Benchmark, times each strategy and compares its mask with the hsv mask
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage = "usage: %prog [options] [image.png ...]")
+    parser.add_option("-n", "--repeat", type = "int", dest = "repeat", default = 100, help = "number of times to mask each image")
+    (options, args) = parser.parse_args()
+    image_names = args or ["2016.png", "lift_peg.png"]
+    mask_values = [32,209,66,115,255,255]
+
+    images = []
+    for image_name in image_names:
+        image = cv2.imread(image_name, 1)
+        if image is None:
+            print("Unable to read %s" % image_name)
+            continue
+        images.append(image)
+
+    # yuyv images need an even width
+    images = [image[:, :image.shape[1] // 2 * 2] for image in images]
+    raw_images = [bgr_to_yuyv(image) for image in images]
+    reference = [mask_image(image, mask_values) for image in images]
+    for strategy in MASK_STRATEGIES:
+        engine = MaskEngine(strategy)
+        raws = [None] * len(images)
+        if strategy == "yuyv":
+            raws = raw_images
+        start = time.time()
+        engine.mask_roi(images[0], None, mask_values, raws[0]) # builds the lut
+        setup_time = time.time() - start
+
+        start = time.time()
+        for i in range(options.repeat):
+            for image, raw in zip(images, raws):
+                engine.mask_roi(image, None, mask_values, raw)
+        per_frame = (time.time() - start) / (options.repeat * len(images))
+
+        different = 0
+        total = 0
+        for image, raw, image_mask in zip(images, raws, reference):
+            different += np.count_nonzero(engine.mask_roi(image, None, mask_values, raw) != image_mask)
+            total += image_mask.size
+        print("%-16s %6.2f ms/frame  first call %6.1f ms  %.3f%% pixels differ from hsv" %\
+            (strategy, per_frame * 1000, setup_time * 1000, 100.0 * different / total))
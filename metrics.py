@@ -0,0 +1,170 @@
+'''
+Low overhead timing of each stage of the main processing loop.
+
+Each stage keeps the last HISTOGRAM_SIZE times in a fixed size ring buffer
+so recording a time is just storing a number. Percentiles are only worked
+out when someone asks for them, which is the live image server's /metrics
+(text) and /metrics.json pages.
+
+Usage in the main loop:
+    start = time.time()
+    ...do some work...
+    start = metrics.time_since("work", start)
+
+Metrics also keeps a StartupTimeline of when each step of starting up
+finished (the cameras giving their first frame, the first lock...) so we
+can see what is holding us up after the robot is turned on.
+'''
+
+import json
+import numpy as np
+import threading
+import time
+
+HISTOGRAM_SIZE = 256 # number of recent times kept for each stage
+METRICS_PERCENTILES = [50, 90, 99]
+
+# The most recent times recorded for a stage
+class LatencyHistogram():
+    def __init__(self, size=HISTOGRAM_SIZE):
+        self.samples = np.zeros(size)
+        self.index = 0
+        self.count = 0 # number of times ever recorded
+        self.last = 0
+
+    def record(self, seconds):
+        self.samples[self.index] = seconds
+        self.index = (self.index + 1) % len(self.samples)
+        self.count += 1
+        self.last = seconds
+
+    # returns the statistics of the recent times in milliseconds
+    def summary(self):
+        recent = self.samples[:min(self.count, len(self.samples))] * 1000
+        summary = {"count": self.count, "last": self.last * 1000}
+        if len(recent) == 0:
+            return summary
+        summary["mean"] = float(np.mean(recent))
+        summary["max"] = float(np.max(recent))
+        for percentile, value in zip(METRICS_PERCENTILES, np.percentile(recent, METRICS_PERCENTILES)):
+            summary["p%d" % percentile] = float(value)
+        return summary
+
+# When each step of starting up happened, in seconds since start_time
+class StartupTimeline():
+    def __init__(self, start_time=None):
+        self.start_time = start_time or time.time()
+        self.lock = threading.Lock()
+        self.events = [] # (name, seconds) in the order they happened
+        self.marked = set()
+
+    # records name happening at when (now by default), only the first time
+    # is kept so this can be called every frame
+    def mark(self, name, when=None):
+        if name in self.marked:
+            return
+        self.lock.acquire()
+        if name not in self.marked:
+            self.marked.add(name)
+            seconds = (when or time.time()) - self.start_time
+            self.events.append((name, seconds))
+            self.events.sort(key=lambda event: event[1])
+            print("startup: %-28s %7.3f s" % (name, seconds))
+        self.lock.release()
+
+    def get_events(self):
+        self.lock.acquire()
+        events = list(self.events)
+        self.lock.release()
+        return events
+
+# Shared between the main loop, which records times, and the live image
+# server, which reports them. Recording doesn't take a lock, the worst that
+# can happen is a report which is one time out of date.
+class Metrics():
+    # start_time is when the program started, for the startup timeline
+    def __init__(self, start_time=None):
+        self.start_time = time.time()
+        self.startup = StartupTimeline(start_time)
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def get_histogram(self, stage):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            self.lock.acquire()
+            histogram = self.histograms.setdefault(stage, LatencyHistogram())
+            self.lock.release()
+        return histogram
+
+    # records how long a stage took in seconds
+    def record(self, stage, seconds):
+        self.get_histogram(stage).record(seconds)
+
+    # records the time since start for a stage and returns the current time
+    # so it can be used as the start of the next stage
+    def time_since(self, stage, start):
+        now = time.time()
+        self.get_histogram(stage).record(now - start)
+        return now
+
+    # records the times Goal.find_goal measured for its own stages
+    def record_stages(self, stage_times):
+        for stage, seconds in stage_times.items():
+            self.record(stage, seconds)
+
+    # counts how often something happens
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    # counts each of counts (name: amount), eg. the contours each selection
+    # value rejected (Goal.rejections)
+    def count_all(self, counts, prefix=""):
+        for name, amount in counts.items():
+            self.count(prefix + name, amount)
+
+    # remembers the current value of something
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        self.lock.acquire()
+        histograms = list(self.histograms.items())
+        self.lock.release()
+        return {
+            "uptime": time.time() - self.start_time,
+            "stages": dict((stage, histogram.summary()) for stage, histogram in histograms),
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "startup": self.startup.get_events(),
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    # a table which is easy to read in a browser
+    def to_text(self):
+        snapshot = self.snapshot()
+        columns = ["last", "mean"] + ["p%d" % percentile for percentile in METRICS_PERCENTILES] + ["max"]
+        lines = ["uptime %.1f s" % snapshot["uptime"], "",
+            "%-16s %8s" % ("stage (ms)", "count") + "".join("%9s" % column for column in columns)]
+        for stage in sorted(snapshot["stages"]):
+            summary = snapshot["stages"][stage]
+            lines.append("%-16s %8d" % (stage, summary["count"]) +\
+                "".join("%9.2f" % summary.get(column, 0) for column in columns))
+        if snapshot["counters"]:
+            lines.append("")
+            for name in sorted(snapshot["counters"]):
+                lines.append("%-24s %d" % (name, snapshot["counters"][name]))
+        if snapshot["gauges"]:
+            lines.append("")
+            for name in sorted(snapshot["gauges"]):
+                lines.append("%-24s %s" % (name, snapshot["gauges"][name]))
+        if snapshot["startup"]:
+            lines.append("")
+            lines.append("startup (s)")
+            for name, seconds in snapshot["startup"]:
+                lines.append("%-28s %7.3f" % (name, seconds))
+        return "\n".join(lines) + "\n"
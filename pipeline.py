@@ -0,0 +1,253 @@
+'''
+Processes frames as a pipeline of threads so that a new frame can be
+captured and masked while the contours of the last one are still being
+found and the one before that is being sent to the robot:
+
+    capture -> mask -> contours/selection -> publish (the main loop)
+
+Most of the slow cv2 calls release the GIL so the stages really do run at
+the same time, a frame takes as long as before but we process more of them.
+
+The stages are joined by LatestQueues which only keep the newest
+PIPELINE_QUEUE_SIZE items. If a stage falls behind the oldest item is
+dropped (and its frame released) instead of letting the latency build up.
+
+GoalHistory relies on getting frames in the order they were captured and
+only from the camera it is tracking, so:
+  - only the contour stage adds results to the GoalHistory
+  - the contour stage drops any frame older than the last one it processed
+  - get_result drops results from a camera the robot no longer wants
+The mask stage takes the search roi from the GoalHistory, so when tracking
+it is based on a frame or two before the one being masked. The roi is
+padded and a target touching its edge forces a full search so this only
+costs the odd extra full search.
+
+How busy each stage is (the fraction of time spent working rather than
+waiting), how full each queue is and how many items each dropped are
+reported in metrics (/metrics on the live image server).
+'''
+
+import collections
+import threading
+import time
+from camera_interfaces import FRAME_TIMEOUT
+from process_image import cal_image_size
+
+PIPELINE_QUEUE_SIZE = 1 # items kept between stages, more only adds latency
+OCCUPANCY_PERIOD = 1 # seconds between updates of the occupancy gauges
+IDLE_WAIT = 0.1 # seconds a stage waits when it has nothing to do
+
+# What the main loop wants the pipeline to do, replaced as a whole (never
+# changed) when the main loop changes its mind so each frame is processed
+# with the settings it was captured with
+class PipelineSettings():
+    def __init__(self, camera_id, camera, mask_engine, mask_values, duel_target, selection_values, draw_extra):
+        self.camera_id = camera_id
+        self.camera = camera
+        self.mask_engine = mask_engine
+        self.mask_values = list(mask_values)
+        self.duel_target = duel_target
+        self.selection_values = selection_values
+        self.draw_extra = draw_extra
+
+# A frame and everything worked out about it so far
+class PipelineItem():
+    def __init__(self, frame, settings):
+        self.frame = frame
+        self.capture_timestamp = frame.capture_timestamp
+        self.settings = settings
+        self.image = frame.image
+        self.draw_extra = settings.draw_extra # off if the image saver wants the frame
+        self.roi = None
+        self.image_mask = None
+        self.data = None
+        self.result = None # VisionResult
+        self.stage_times = {}
+
+    def release(self):
+        self.frame.release()
+
+# A bounded queue where the newest item wins, items which are pushed out
+# are released
+class LatestQueue():
+    def __init__(self, name, metrics, size = PIPELINE_QUEUE_SIZE):
+        self.name = name
+        self.metrics = metrics
+        self.size = size
+        self.condition = threading.Condition()
+        self.items = collections.deque()
+
+    def put(self, item):
+        dropped = None
+        self.condition.acquire()
+        self.items.append(item)
+        if len(self.items) > self.size:
+            dropped = self.items.popleft()
+        self.condition.notify()
+        self.condition.release()
+        if dropped is not None:
+            dropped.release()
+            self.metrics.count("pipeline_%s_dropped" % self.name)
+
+    # returns the oldest item or None if there isn't one within timeout seconds
+    def get(self, timeout):
+        give_up_time = time.time() + timeout
+        self.condition.acquire()
+        while not self.items:
+            wait_time = give_up_time - time.time()
+            if wait_time <= 0:
+                break
+            self.condition.wait(wait_time)
+        item = None
+        if self.items:
+            item = self.items.popleft()
+        self.condition.release()
+        return item
+
+    def __len__(self):
+        return len(self.items)
+
+# A thread which takes items from input_queue, processes them and puts them on output_queue
+class PipelineStage(threading.Thread):
+    def __init__(self, name, pipeline, input_queue, output_queue):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = name
+        self.pipeline = pipeline
+        self.metrics = pipeline.metrics
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.busy_time = 0
+        self.period_start = time.time()
+
+    # waiting for an item isn't counted as being busy
+    def get_item(self):
+        return self.input_queue.get(IDLE_WAIT)
+
+    # returns the item to pass on or None if it was dropped
+    def process(self, item):
+        return item
+
+    def run(self):
+        while True:
+            item = self.get_item()
+            start = time.time()
+            if item is not None:
+                item = self.process(item)
+                if item is not None:
+                    self.output_queue.put(item)
+                end = time.time()
+                self.busy_time += end - start
+                self.metrics.record("pipeline_" + self.name, end - start)
+                start = end
+            self.update_occupancy(start)
+
+    def update_occupancy(self, now):
+        if now - self.period_start < OCCUPANCY_PERIOD:
+            return
+        self.metrics.set_gauge("pipeline_%s_occupancy" % self.name, round(self.busy_time / (now - self.period_start), 3))
+        self.metrics.set_gauge("pipeline_%s_queued" % self.name, len(self.output_queue))
+        self.busy_time = 0
+        self.period_start = now
+
+# Waits for new frames from the camera the main loop wants
+class CaptureStage(PipelineStage):
+    def __init__(self, pipeline, output_queue):
+        PipelineStage.__init__(self, "capture", pipeline, None, output_queue)
+        self.capture_timestamp = 1
+
+    def get_item(self):
+        settings = self.pipeline.settings
+        if settings is None or settings.camera is None:
+            time.sleep(IDLE_WAIT)
+            return None
+        frame = settings.camera.get_frame(self.capture_timestamp)
+        if frame is None:
+            return None
+        self.capture_timestamp = frame.capture_timestamp
+        return PipelineItem(frame, settings)
+
+class MaskStage(PipelineStage):
+    def __init__(self, pipeline, input_queue, output_queue):
+        PipelineStage.__init__(self, "mask", pipeline, input_queue, output_queue)
+
+    def process(self, item):
+        settings = item.settings
+        start = time.time()
+        # the goal history may be tracking a target seen by the other camera
+        if settings.camera_id == self.pipeline.tracked_camera_id:
+            item.roi = self.pipeline.goal_history.get_search_roi(cal_image_size(item.image))
+        item.image_mask = settings.mask_engine.mask_roi(item.image, item.roi, settings.mask_values, item.frame.raw)
+        item.stage_times["mask"] = time.time() - start
+        return item
+
+# The only stage which uses the Goal and GoalHistory
+class ContourStage(PipelineStage):
+    def __init__(self, pipeline, input_queue, output_queue):
+        PipelineStage.__init__(self, "contours", pipeline, input_queue, output_queue)
+        self.last_timestamp = 0
+
+    def process(self, item):
+        if item.capture_timestamp <= self.last_timestamp:
+            item.release()
+            self.metrics.count("pipeline_out_of_order")
+            return None
+        self.last_timestamp = item.capture_timestamp
+
+        settings = item.settings
+        goal_history = self.pipeline.goal_history
+        if settings.camera_id != self.pipeline.tracked_camera_id:
+            # the last target was seen by the other camera
+            goal_history.reset_tracking()
+            self.pipeline.tracked_camera_id = settings.camera_id
+        goal = self.pipeline.goal
+        if self.pipeline.image_saver is not None and self.pipeline.image_saver.is_frame_due(item.capture_timestamp):
+            item.draw_extra = False # saved images are kept clean
+        item.data, item.image = goal.find_goal(item.image, item.image_mask, goal_history, item.capture_timestamp,\
+            False, item.draw_extra, self.pipeline.verbose, settings.duel_target, settings.selection_values, item.roi)
+        item.result = goal_history.last_result
+        item.stage_times.update(goal.stage_times)
+        self.metrics.count_all(goal.rejections, "rejected_")
+        if settings.duel_target:
+            self.metrics.set_gauge("pair_score", round(goal.pair_score, 3))
+        return item
+
+class Pipeline():
+    # image_saver is only asked which frames it will save
+    def __init__(self, goal, goal_history, metrics, verbose, image_saver = None):
+        self.goal = goal
+        self.goal_history = goal_history
+        self.metrics = metrics
+        self.verbose = verbose
+        self.image_saver = image_saver
+        self.settings = None
+        self.tracked_camera_id = None # the camera the goal history has results from
+
+        captured = LatestQueue("capture", metrics)
+        masked = LatestQueue("mask", metrics)
+        self.results = LatestQueue("contours", metrics)
+        self.stages = [
+            CaptureStage(self, captured),
+            MaskStage(self, captured, masked),
+            ContourStage(self, masked, self.results),
+        ]
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    # called by the main loop before each get_result, None stops capturing
+    def set_settings(self, settings):
+        self.settings = settings
+
+    # returns the next processed item from camera_id or None if there isn't
+    # one in time. The caller must release() the item.
+    def get_result(self, camera_id, timeout = FRAME_TIMEOUT):
+        give_up_time = time.time() + timeout
+        while True:
+            item = self.results.get(max(give_up_time - time.time(), 0))
+            if item is None or item.settings.camera_id == camera_id:
+                return item
+            # captured before the robot changed cameras
+            item.release()
+            self.metrics.count("pipeline_other_camera")
@@ -2,6 +2,7 @@ import cv2
 import numpy as np
 import math
 import time
+from vision_protocol import VisionResult
 
 
 """""""""""""""""""""
@@ -23,18 +24,46 @@ def mask_image(image, mask_values):
     image_mask = cv2.inRange(image_hsv, lc, hc)
     return image_mask
     
+# returns the part of an image inside roi (x, y, width, height)
+# the whole image is returned if roi is None
+def crop_image(image, roi):
+    if roi is None:
+        return image
+    x, y, w, h = roi
+    return image[y:y+h, x:x+w]
+
 # changes the resolution of an image and converts it to grayscale
 # used to improve framerate when streaming back to the driver station
-def resize_gray_image(image, factor):
-    image = cv2.resize(image, (0,0), fx=factor, fy=factor)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+# resized and gray are optional images of the right size to write into instead
+# of allocating new ones
+def resize_gray_image(image, factor, resized=None, gray=None):
+    size = cal_resized_size(cal_image_size(image), factor)
+    image = cv2.resize(image, size, dst=resized)
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=gray)
     return image
 
+# calculates the (width, height) of an image resized by factor
+def cal_resized_size(image_size, factor):
+    return (int(round(image_size[0] * factor)), int(round(image_size[1] * factor)))
+
 """""""""""""""""""""
 GOAL HISTORY
 """""""""""""""""""""
 # This class remembers information from previous goals and allows for
 # the averaging of dist, aim, age, lock and thresholding of lock.
+# When tracking it also remembers where the last locked target was so
+# the next frame only needs to search a small region of interest (ROI)
+# around it.
+#
+# The last values are kept in one numpy ring buffer, a row per frame, with
+# a running sum of each column over its window so averaging costs the same
+# however long the window is.
+#
+# Averaging adds lag, so instead of a long window the aim, distance and
+# skew can go through an alpha-beta tracker (use_prediction) which follows
+# how fast each is changing and sends where the target should be by the
+# time the robot gets the result (age after capture) rather than where it
+# was when the frame was captured.
 
 AVERAGE_DIST_OVER = 1 # Currently don't do any averaging
 AVERAGE_AIM_OVER = 1 # Currently don't do any averaging
@@ -42,23 +71,43 @@ AVERAGE_LOCK_OVER = 1 # Currently don't do any averaging
 AVERAGE_AGE_OVER = 1 # Currently don't do any averaging
 AVERAGE_SKEW_OVER = 1 # Currently don't do any averaging
 LOCK_THRESHOLD = 50 # as a percentage 0-100
+HISTORY_COLUMNS = ["lock", "aim", "dist", "age", "skew"]
+HISTORY_RESUM_EVERY = 1000 # frames between adding the sums up again so rounding errors can't build up
+TRACKER_COLUMNS = [1, 2, 4] # aim, dist and skew
+TRACKER_ALPHA = 0.6 # how much of the difference between a measurement and the prediction is taken
+TRACKER_BETA = 0.2 # how much of it changes the rate
+TRACKER_MAX_GAP = 0.5 # seconds without a lock before the tracker starts again
+TRACKER_MAX_PREDICT = 0.2 # seconds, never predict further ahead than this
+ROI_PADDING = 40 # pixels added on each side of the last target when tracking
+ROI_PADDING_FRACTION = 0.5 # extra padding as a fraction of the target size, close targets move more pixels
+ROI_FULL_SEARCH_EVERY = 15 # search the full image at least this often (in frames) when tracking
 
 class GoalHistory():
-    def __init__(self):
+    # average_over is the number of frames each of HISTORY_COLUMNS is averaged over
+    def __init__(self, tracking=False, use_prediction=False, average_over=None):
         self.frame_num = 0
         self.start_time = time.time()
         self.oldest = 0
-
-        self.lock_history = [0]*AVERAGE_LOCK_OVER
-        self.lock_index = 0
-        self.aim_history = [0]*AVERAGE_AIM_OVER
-        self.aim_index = 0
-        self.dist_history = [0]*AVERAGE_DIST_OVER
-        self.dist_index = 0
-        self.age_history = [0]*AVERAGE_AGE_OVER
-        self.age_index = 0
-        self.skew_history = [0]*AVERAGE_SKEW_OVER
-        self.skew_index = 0
+        self.last_result = None # VisionResult of the last frame
+
+        self.tracking = tracking
+        self.target_rect = None # bounding box of the last locked target (x, y, width, height)
+        self.frames_since_full_search = 0
+        self.used_roi = False # if the last frame only searched a ROI
+
+        if average_over is None:
+            average_over = [AVERAGE_LOCK_OVER, AVERAGE_AIM_OVER, AVERAGE_DIST_OVER, AVERAGE_AGE_OVER, AVERAGE_SKEW_OVER]
+        self.windows = np.array(average_over, np.int64)
+        self.history = np.zeros((int(self.windows.max()), len(HISTORY_COLUMNS)))
+        self.history_index = 0
+        self.history_count = 0
+        self.sums = np.zeros(len(HISTORY_COLUMNS))
+        self.columns = np.arange(len(HISTORY_COLUMNS))
+
+        self.use_prediction = use_prediction
+        self.tracker_state = np.zeros(len(TRACKER_COLUMNS)) # filtered aim, dist and skew
+        self.tracker_rate = np.zeros(len(TRACKER_COLUMNS)) # how fast each is changing per second
+        self.tracker_timestamp = None # capture time of the last measurement, None when starting again
 
     # calculates the:
     # age: how long since the image was taken
@@ -73,50 +122,108 @@ class GoalHistory():
             self.oldest = age
         return age, fps, self.oldest
 
-    def cal_data(self, lock, aim, dist, age, skew):
+    # returns the text sent to the robot, the same result is kept in last_result
+    def cal_data(self, lock, aim, dist, age, skew, capture_timestamp = 0):
         l = 0
         if lock: l = 100
+        if self.use_prediction:
+            if lock:
+                aim, dist, skew = self.update_tracker(np.array([aim, dist, skew], np.float64), age, capture_timestamp)
+            elif self.tracker_timestamp is not None and capture_timestamp - self.tracker_timestamp > TRACKER_MAX_GAP:
+                self.tracker_timestamp = None
 
-        self.lock_history[self.lock_index] = l
-        self.aim_history[self.aim_index] = aim
-        self.dist_history[self.dist_index] = dist
-        self.age_history[self.age_index] = age
-        self.skew_history[self.skew_index] = skew
-
-        self.lock_index += 1
-        self.aim_index += 1
-        self.dist_index += 1
-        self.age_index += 1
-        self.skew_index += 1
-        
-        self.lock_index %= AVERAGE_LOCK_OVER
-        self.aim_index %= AVERAGE_AIM_OVER
-        self.dist_index %= AVERAGE_DIST_OVER
-        self.age_index %= AVERAGE_AGE_OVER
-        self.skew_index %= AVERAGE_SKEW_OVER
+        averages = self.add_to_history([l, aim, dist, age, skew])
 
         data_lock = 0
         data_aim = 0
         data_dist = 0
-        data_skew = 0 
-        if (sum(self.lock_history) / AVERAGE_LOCK_OVER > LOCK_THRESHOLD):
+        data_skew = 0
+        if averages[0] > LOCK_THRESHOLD:
             data_lock = 1
-            data_aim = sum(self.aim_history) / AVERAGE_AIM_OVER
-            data_dist = sum(self.dist_history) / AVERAGE_DIST_OVER
-            data_skew = sum(self.skew_history) / AVERAGE_SKEW_OVER
-        data_age = sum(self.age_history) / AVERAGE_AGE_OVER
-        return "%d,%f,%f,%f,%f\n" % (data_lock, data_aim, data_dist, data_skew, data_age)
-
-# Tracks score and xy coordinate
-class Corner():
-    def __init__(self):
-        self.xy = []
-        self.score = -10000
-    def update_score(self, X, Y, score):
-        if score > self.score:
-            self.xy = [X,Y]
-            self.score = score
-
+            data_aim = averages[1]
+            data_dist = averages[2]
+            data_skew = averages[4]
+        data_age = averages[3]
+        self.last_result = VisionResult(capture_timestamp, data_lock, data_aim, data_dist, data_skew, data_age)
+        return self.last_result.to_text()
+
+    # adds a row of HISTORY_COLUMNS and returns the average of each column over its window
+    def add_to_history(self, values):
+        values = np.array(values, np.float64)
+        # the values pushed out of each window, read before the row is written as they can be in it
+        leaving = self.history[(self.history_index - self.windows) % len(self.history), self.columns]
+        self.sums += values - leaving
+        self.history[self.history_index] = values
+        self.history_index = (self.history_index + 1) % len(self.history)
+        self.history_count += 1
+        if self.history_count % HISTORY_RESUM_EVERY == 0:
+            self.resum_history()
+        return self.sums / self.windows
+
+    # works the sums out from scratch
+    def resum_history(self):
+        for column, window in enumerate(self.windows):
+            rows = (self.history_index - 1 - np.arange(window)) % len(self.history)
+            self.sums[column] = self.history[rows, column].sum()
+
+    # alpha-beta filters a measurement of aim, dist and skew taken at
+    # capture_timestamp and returns them predicted age seconds later
+    def update_tracker(self, measurement, age, capture_timestamp):
+        dt = 0
+        if self.tracker_timestamp is not None:
+            dt = capture_timestamp - self.tracker_timestamp
+        if self.tracker_timestamp is None or dt > TRACKER_MAX_GAP:
+            self.tracker_state = measurement
+            self.tracker_rate = np.zeros(len(TRACKER_COLUMNS))
+        elif dt > 0:
+            predicted = self.tracker_state + self.tracker_rate * dt
+            residual = measurement - predicted
+            self.tracker_state = predicted + TRACKER_ALPHA * residual
+            self.tracker_rate = self.tracker_rate + (TRACKER_BETA / dt) * residual
+        self.tracker_timestamp = capture_timestamp
+        return self.tracker_state + self.tracker_rate * min(max(age, 0), TRACKER_MAX_PREDICT)
+
+    # returns the region of the image (x, y, width, height) that should be
+    # searched for the next frame or None if the full image should be searched
+    def get_search_roi(self, image_size):
+        if not self.tracking or self.target_rect is None:
+            return None
+        if self.frames_since_full_search >= ROI_FULL_SEARCH_EVERY - 1:
+            return None
+        x, y, w, h = self.target_rect
+        pad = ROI_PADDING + int(ROI_PADDING_FRACTION * max(w, h))
+        x1 = max(x - pad, 0)
+        y1 = max(y - pad, 0)
+        x2 = min(x + w + pad, image_size[0])
+        y2 = min(y + h + pad, image_size[1])
+        if x2 <= x1 or y2 <= y1:
+            return None
+        return (x1, y1, x2 - x1, y2 - y1)
+
+    # remembers where the target was found so the next frame can search around it
+    # a miss, or a target touching the edge of the ROI, causes a full search next frame
+    def update_tracking(self, lock, target_rect, roi):
+        self.used_roi = roi is not None
+        if self.used_roi:
+            self.frames_since_full_search += 1
+        else:
+            self.frames_since_full_search = 0
+        if not lock or target_rect is None or rect_touches_roi_edge(target_rect, roi):
+            self.target_rect = None
+        else:
+            self.target_rect = target_rect
+
+    # forget the last target, used when we change cameras
+    def reset_tracking(self):
+        self.target_rect = None
+        self.frames_since_full_search = 0
+        self.tracker_timestamp = None
+
+# splits the data string sent to the robot (see GoalHistory.cal_data) into
+# its lock, aim, distance and skew (the default data has no age)
+def parse_data(data):
+    values = data.strip().split(",")
+    return int(values[0]), float(values[1]), float(values[2]), float(values[3])
 
 """""""""""""""""""""
 GOAL PROCESSING
@@ -129,14 +236,35 @@ GOAL_HEIGHT_RELATIVE = 84 - 19.4 # virtical distance between the camera and the
 CAMERA_ANGLE_OF_ELEVATION = 30 * (math.pi / 180)
 PIXELS_PER_DEGREE = 0.171/1.8
 AIM_CORRECTION_DEGREES = 0 # 7 # The camera maybe off-centred with the robot
+COMPONENT_SLACK = 0.5 # how much looser the aspect ratio and fill thresholds are on a component's bounding box
+CONTOUR_SCORES_MIN_BATCH = 6 # contours passing the size check below which ContourScores checks them one by one, the arrays cost more
+PAIR_MAX_CANDIDATES = 50 # only the largest goals are paired up for dual targets, the score matrix grows with the square
+PAIR_WEIGHTS = [1, 1, 1, 1] # how much the target aspect ratio, height similarity, vertical alignment and spacing count in a pair's score
 
 class Goal():
+    # pyramid_factor > 1 drops blobs too small to be goals on a mask downscaled
+    # by that factor first, then only traces the rest at full resolution
+    # use_components finds candidates as connected components instead and
+    # only traces the ones which could pass the selection values
+    def __init__(self, pyramid_factor=1, use_components=False):
+        self.pyramid_factor = pyramid_factor
+        self.use_components = use_components
+        self.stage_times = {} # seconds spent in each stage of the last find_goal
+        self.rejections = {} # how many contours each selection value rejected in the last find_goal
+        self.pair_score = 0 # how well the two goals chosen for a dual target match (0-1), 0 if there wasn't a pair
+
+    # roi is the (x, y, width, height) region image_mask was made from, None if it
+    # covers the full image
     def find_goal(self, image, image_mask, goal_history, capture_timestamp,\
-    	    use_screen, draw_extra, verbose, duel_target, selection_values):
+    	    use_screen, draw_extra, verbose, duel_target, selection_values, roi=None):
         self.area1 = 0
         self.area2 = 0
         self.corners1 = [[0,0],[0,0],[0,0],[0,0]]
         self.corners2 = [[0,0],[0,0],[0,0],[0,0]]
+        self.rect1 = None
+        self.rect2 = None
+        self.pair_score = 0
+        target_rect = None
 
         lock = False
         data = '0,0,0,0\n'
@@ -145,62 +273,81 @@ class Goal():
         skew = 0
 
         image_size = cal_image_size(image)
+        start_time = time.time()
 
         # find any contours (edges between the white and black on the masked image)
-        contours = find_contours(image_mask)
-        for contour in contours:
-
-            # If the contour is too small then ignore it
-            area = cal_contour_area(contour)
-            if area < selection_values[0]:
-            	if verbose:
-                    print("bad size %.1f" %area)
-                continue
-
-            # If there isn't a significant portion of the area of the contour's corners then it cant be a U shape
-            corners = cal_corners(contour) # narrows down a contour to a the coordinates of four corners
-            corner_area = cal_corner_area(corners)
-            
-            # make sure corner_area is not 0 to avoid a division by zero error
-            if (corner_area == 0):
-                if verbose:
-                    print("corner_area == 0")
-                continue    
-
-            if area/corner_area < selection_values[1] or area/corner_area > selection_values[2]:
-                if verbose:
-                    print "bad fullness %.1f" %(area/corner_area)
-                continue
-
-            # If it has a completly incorrect aspect ratio then ignore it
-            avg_width, avg_height = cal_avg_height_width(corners)
-            aspect_ratio = cal_aspect_ratio(avg_width, avg_height)
-            if aspect_ratio < selection_values[3] or aspect_ratio > selection_values[4]:
-                if verbose:
-                    print("bad aspect ratio %.1f" %aspect_ratio)
-                continue
-
+        offset = (0,0)
+        if roi is not None:
+            offset = (roi[0], roi[1])
+        if self.use_components:
+            contours = find_contours_components(image_mask, selection_values, offset)
+        elif self.pyramid_factor > 1:
+            contours = find_contours_pyramid(image_mask, self.pyramid_factor, selection_values, offset)
+        else:
+            contours = find_contours(image_mask, offset)
+        contours_time = time.time()
+        drawing_time = 0
+        # the selection values of every contour are worked out at once, only
+        # the goals which pass them are looked at one by one
+        scores = ContourScores(contours, selection_values)
+        self.rejections = scores.rejections
+        rects = []
+        for i in scores.survivors:
+            contour = contours[i]
+            area = scores.area[i]
+            corners = scores.corners[i]
+            corner_area = scores.corner_area[i]
+            avg_width = scores.width[i]
+            avg_height = scores.height[i]
+            aspect_ratio = scores.aspect_ratio[i]
 
             # Save the two largest vision targets found
+            rect = cv2.boundingRect(contour)
+            rects.append(rect)
             if area > self.area1:
                 self.area1 = self.area2
                 self.corners1 = self.corners2
+                self.rect1 = self.rect2
                 self.area2 = area
                 self.corners2 = corners
+                self.rect2 = rect
             elif area > self.area2:
                 self.area2 = area
                 self.corners2 = corners
+                self.rect2 = rect
 
             goal_center = cal_goal_center(corners[0], avg_width, avg_height)
+            # remember the last goal found for single targets
+            goal_corners = corners
+            goal_width = avg_width
+            goal_rect = rect
+            draw_start = time.time()
             draw_goal_center(image, goal_center) # we draw the centers of all goals so we can see which ones we found after the match (on the saved images)
             if draw_extra == True: # draw more information if this image will be sent back to the driverstation
                 draw_areas(image, contour, area, corner_area, corners)
                 draw_aspect_ratio(image, aspect_ratio, goal_center)
+            drawing_time += time.time() - draw_start
+
+        # a dual target is made of the pair of goals which look most like it,
+        # not just the two largest which may be a reflection and a real one
+        if duel_target and len(scores.survivors) >= 2:
+            pair = select_pair(scores, rects, selection_values)
+            if pair is None:
+                self.rejections["target_pair"] = 1
+                self.area1 = self.area2 = 0
+            else:
+                first, second, self.pair_score = pair
+                i, j = scores.survivors[first], scores.survivors[second]
+                self.area1, self.corners1, self.rect1 = scores.area[i], scores.corners[i], rects[first]
+                self.area2, self.corners2, self.rect2 = scores.area[j], scores.corners[j], rects[second]
 
         age, fps, oldest = goal_history.cal_goal_history(capture_timestamp)
+        draw_start = time.time()
         draw_age_fps(image, age, fps, oldest)
+        if goal_history.tracking: draw_search_roi(image, roi, draw_extra)
 
         if draw_extra: draw_image_center(image, image_size) # we usually don't want to draw too much information on the images otherwise they become unusable as debug after a match
+        drawing_time += time.time() - draw_start
 
         # If we have found two correctly sized vision targets combine them and find useful data to send back to te robot
         if self.area1 > 0 and self.area2 > 0 and duel_target:
@@ -224,56 +371,400 @@ class Goal():
                 else:
                     distance = cal_distance_position(image_size, target_goal_center)
                 
+                draw_start = time.time()
                 if draw_extra: draw_rectangle_offset(image, target_corners, 5) # we usually don't want to draw too much information on the images otherwise they become unusable as debug after a match
 
                 draw_goal_center(image, target_goal_center, (0,255,255), 15)
                 draw_aim_distance(image, aim, distance)
+                drawing_time += time.time() - draw_start
                 lock = True
-            elif verbose: print("bad target aspect ratio %.1f" %target_aspect_ratio)
+                target_rect = cal_union_rect(self.rect1, self.rect2)
+            else:
+                self.rejections["target_pair"] = 1
 
         # For singular targets
         if (self.area1 > 0 or self.area2 > 0) and not duel_target:
-            distance = cal_distance(avg_width, selection_values[7])
+            distance = cal_distance(goal_width, selection_values[7])
             aim = cal_aim(image_size, goal_center)
-            if draw_extra: draw_rectangle_offset(image, corners, 5) # we usually don't want to draw too much information on the images otherwise they become unusable as debug after a match
+            draw_start = time.time()
+            if draw_extra: draw_rectangle_offset(image, goal_corners, 5) # we usually don't want to draw too much information on the images otherwise they become unusable as debug after a match
             draw_goal_center(image, goal_center, (0,255,255), 15)
             draw_aim_distance(image, aim, distance)
+            drawing_time += time.time() - draw_start
             lock = True
+            target_rect = goal_rect
 
-        data = goal_history.cal_data(lock, aim, distance, age, skew)    
+        goal_history.update_tracking(lock, target_rect, roi)
+        data = goal_history.cal_data(lock, aim, distance, age, skew, capture_timestamp)
+        self.stage_times["contours"] = contours_time - start_time
+        self.stage_times["selection"] = time.time() - contours_time - drawing_time
+        self.stage_times["drawing"] = drawing_time
         if verbose:
+            if roi is None: print("full image search")
+            else: print("roi search %s" % (roi,))
+            print("rejected %s" % self.rejections)
+            if duel_target: print("pair score %.3f" % self.pair_score)
             print(data)
 
         print("fps: %.1f" %fps)
         return data, image
 
+# masks an image and searches it for a goal
+# when tracking only the region around the last target found is masked and searched
+# raw is the frame's raw yuyv image if the camera gave us one (see mask_engine.py)
+def process_frame(image, mask_engine, mask_values, goal, goal_history, capture_timestamp,\
+        use_screen, draw_extra, verbose, duel_target, selection_values, metrics, raw = None):
+    start = time.time()
+    roi = goal_history.get_search_roi(cal_image_size(image))
+    image_mask = mask_engine.mask_roi(image, roi, mask_values, raw)
+    mask_time = time.time() - start
+    data, image = goal.find_goal(image, image_mask, goal_history,\
+        capture_timestamp, use_screen, draw_extra, verbose, duel_target, selection_values, roi)
+    goal.stage_times["mask"] = mask_time
+    metrics.record_stages(goal.stage_times)
+    metrics.count_all(goal.rejections, "rejected_")
+    if duel_target:
+        metrics.set_gauge("pair_score", round(goal.pair_score, 3))
+    return data, image, image_mask
+
 # Finds outermost contours (edges between black and white on a masked image)
-def find_contours(image_mask):
-    ret, thresh = cv2.threshold(image_mask, 0, 255, 0)
-    _, contours, hierarchy = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+# offset is added to every point, used when the mask is only part of the image
+# image_mask isn't changed, findContours hasn't modified its input since opencv 3.2
+def find_contours(image_mask, offset=(0,0)):
+    _, contours, hierarchy = cv2.findContours(image_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
     # Change cv2.RETR_EXTERNAL to cv2.RETR_TREE to find all contours
     return contours
 
+# Finds the same outermost contours as find_contours, apart from ones too small
+# to pass the area selection value, by only tracing the full resolution mask
+# where a mask downscaled by factor says a big enough blob could be.
+# A block of the downscaled mask is lit if any of its pixels are, so every
+# blob is inside the lit blocks of a single downscaled blob (8 connected, like
+# findContours). Each downscaled blob is kept unless a contour through the
+# centers of the edge pixels of any blob inside its bounding box couldn't
+# enclose enough to pass the area check, which drops most of the specks of
+# noise, and the kept blocks are searched at full resolution so the contours
+# are exactly the ones find_contours gives. Its shape isn't checked as a
+# downscaled blob may be several full resolution blobs joined together.
+# A dropped blob can't hold a goal or be around one, a blob around another
+# one has a bounding box at least as big.
+def find_contours_pyramid(image_mask, factor, selection_values, offset=(0,0)):
+    height, width = image_mask.shape[:2]
+    # pad the mask (usually a roi) so it divides evenly into blocks
+    pad_bottom = -height % factor
+    pad_right = -width % factor
+    padded_mask = image_mask
+    if pad_bottom or pad_right:
+        padded_mask = cv2.copyMakeBorder(image_mask, 0, pad_bottom, 0, pad_right, cv2.BORDER_CONSTANT, value=0)
+    # INTER_AREA averages each block, a single lit pixel makes it more than 0
+    small_mask = cv2.resize(padded_mask, ((width + pad_right) // factor, (height + pad_bottom) // factor), interpolation=cv2.INTER_AREA)
+    ret, small_mask = cv2.threshold(small_mask, 0, 255, cv2.THRESH_BINARY)
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(small_mask, connectivity=8)
+    w = stats[:, cv2.CC_STAT_WIDTH] * factor
+    h = stats[:, cv2.CC_STAT_HEIGHT] * factor
+    kept = (w - 1) * (h - 1) >= selection_values[0]
+    kept[0] = False # the background
+    if not kept.any():
+        return []
+    if kept[1:].all():
+        return find_contours(image_mask, offset)
+    keep_mask = np.where(kept, 255, 0).astype(np.uint8).take(labels)
+    keep_mask = cv2.resize(keep_mask, (width + pad_right, height + pad_bottom), interpolation=cv2.INTER_NEAREST)
+    return find_contours(cv2.bitwise_and(image_mask, keep_mask[:height, :width]), offset)
+
+# Finds the same outermost contours as find_contours that could pass the
+# selection values, without tracing the rest. Each blob (8 connected, like
+# findContours) is labelled by connectedComponentsWithStats and rejected from
+# its bounding box where possible:
+#   area   a contour through the centers of the blob's edge pixels can't
+#          enclose more than (w-1)*(h-1), so this never drops a goal
+#   aspect w/h against the aspect ratio thresholds, this only approximates
+#          the aspect ratio of the corners so it has COMPONENT_SLACK like the
+#          pyramid search
+# The fraction of the box lit isn't used, a blob with holes (eg. the outline
+# of a rectangle) lights little of its box but its contour area includes them.
+# Only the survivors are traced, each inside its own bounding box.
+def find_contours_components(image_mask, selection_values, offset=(0,0)):
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(image_mask, connectivity=8)
+    x = stats[1:, cv2.CC_STAT_LEFT]
+    y = stats[1:, cv2.CC_STAT_TOP]
+    w = stats[1:, cv2.CC_STAT_WIDTH]
+    h = stats[1:, cv2.CC_STAT_HEIGHT]
+    aspect = w / h.astype(np.float64)
+    possible = ((w - 1) * (h - 1) >= selection_values[0]) &\
+        (aspect >= selection_values[3] * COMPONENT_SLACK) & (aspect <= selection_values[4] / COMPONENT_SLACK)
+    contours = []
+    for i in np.flatnonzero(possible):
+        x1, y1, x2, y2 = x[i], y[i], x[i] + w[i], y[i] + h[i]
+        component = (labels[y1:y2, x1:x2] == i + 1).view(np.uint8)
+        contour = find_contours(component, (x1, y1))[0]
+        if is_inside_hole(contour, i, labels, x, y, w, h):
+            continue
+        contour += offset
+        contours.append(contour)
+    # the labels aren't quite in the order findContours would find the blobs,
+    # sort them the same way as find_contours_pyramid does
+    contours.sort(key=lambda contour: (contour[0][0][1], contour[0][0][0]), reverse=True)
+    return contours
+
+# checks if component i (with contour) sits in a hole of another component,
+# findContours only returns outermost contours so it wouldn't find it
+def is_inside_hole(contour, i, labels, x, y, w, h):
+    around = np.flatnonzero((x < x[i]) & (y < y[i]) & (x + w > x[i] + w[i]) & (y + h > y[i] + h[i]))
+    first_point = (int(contour[0][0][0]), int(contour[0][0][1]))
+    for j in around:
+        component = (labels[y[j]:y[j]+h[j], x[j]:x[j]+w[j]] == j + 1).view(np.uint8)
+        outline = find_contours(component, (x[j], y[j]))[0]
+        if cv2.pointPolygonTest(outline, first_point, False) > 0:
+            return True
+    return False
+
+# The values the selection values are checked against for many contours at
+# once, each is a numpy array with a value for every contour (a struct of
+# arrays). The contours are checked against each selection value in turn
+# like find_goal always has and rejections counts how many each one
+# rejected (by name, only ones which rejected any), survivors are the
+# indexes of the contours which passed all of them in their original order.
+# Values the contour never got to are left at 0.
+# With fewer than min_batch contours passing the size check the rest of the
+# checks are done one contour at a time, which gives the same values.
+class ContourScores():
+    def __init__(self, contours, selection_values, min_batch=CONTOUR_SCORES_MIN_BATCH):
+        count = len(contours)
+        self.rejections = {}
+        self.area = cal_contour_areas(contours)
+        self.corners = np.zeros((count, 4, 2), dtype=np.int32)
+        self.corner_area = np.zeros(count)
+        self.width = np.zeros(count)
+        self.height = np.zeros(count)
+        self.aspect_ratio = np.zeros(count)
+
+        # If the contour is too small then ignore it
+        passed = self.area >= selection_values[0]
+        self.reject("size", passed)
+        candidates = np.flatnonzero(passed)
+        if len(candidates) < min_batch:
+            self.score_one_by_one(contours, candidates, selection_values, passed)
+            self.survivors = np.flatnonzero(passed)
+            return
+        # If there isn't a significant portion of the area of the contour's corners then it cant be a U shape
+        self.corners[candidates] = cal_corners_batch([contours[i] for i in candidates])
+        self.corner_area[candidates] = cal_corner_areas(self.corners[candidates])
+        passed &= self.corner_area != 0
+        self.reject("corner_area", passed)
+        fullness = np.zeros(count)
+        fullness[passed] = self.area[passed] / self.corner_area[passed]
+        passed &= (fullness >= selection_values[1]) & (fullness <= selection_values[2])
+        self.reject("fullness", passed)
+        # If it has a completly incorrect aspect ratio then ignore it
+        candidates = np.flatnonzero(passed)
+        self.width[candidates], self.height[candidates] = cal_avg_height_width_batch(self.corners[candidates])
+        self.aspect_ratio[candidates] = self.width[candidates] / self.height[candidates]
+        passed &= (self.aspect_ratio >= selection_values[3]) & (self.aspect_ratio <= selection_values[4])
+        self.reject("aspect", passed)
+        self.survivors = np.flatnonzero(passed)
+
+    # counts the contours which were still in until this check
+    def reject(self, name, passed):
+        rejected = len(passed) - np.count_nonzero(passed) - sum(self.rejections.values())
+        if rejected:
+            self.rejections[name] = rejected
+
+    # the checks after the size check for each of candidates in turn
+    def score_one_by_one(self, contours, candidates, selection_values, passed):
+        rejections = {"corner_area": 0, "fullness": 0, "aspect": 0}
+        for i in candidates:
+            corners = cal_corners(contours[i])
+            corner_area = cal_corner_area(corners)
+            self.corners[i] = corners
+            self.corner_area[i] = corner_area
+            if corner_area == 0:
+                rejections["corner_area"] += 1
+                passed[i] = False
+                continue
+            fullness = self.area[i] / corner_area
+            if fullness < selection_values[1] or fullness > selection_values[2]:
+                rejections["fullness"] += 1
+                passed[i] = False
+                continue
+            self.width[i], self.height[i] = cal_avg_height_width(corners)
+            self.aspect_ratio[i] = cal_aspect_ratio(self.width[i], self.height[i])
+            if self.aspect_ratio[i] < selection_values[3] or self.aspect_ratio[i] > selection_values[4]:
+                rejections["aspect"] += 1
+                passed[i] = False
+        for name, rejected in rejections.items():
+            if rejected:
+                self.rejections[name] = rejected
+
+# calculates the area inside many contours at once with the shoelace formula,
+# the same as cv2.contourArea gives for each
+def cal_contour_areas(contours):
+    if len(contours) == 0:
+        return np.zeros(0)
+    lengths = np.fromiter(map(len, contours), np.int64, len(contours))
+    # contours from findContours are all (points, 1, 2) so they join without reshaping each one
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.int64)
+    starts = np.cumsum(lengths) - lengths
+    # the point after the last point of a contour is its first one
+    following = np.arange(1, len(points) + 1)
+    following[starts + lengths - 1] = starts
+    x = points[:, 0]
+    y = points[:, 1]
+    cross = x * y[following] - x[following] * y
+    return np.abs(np.add.reduceat(cross, starts)) / 2.0
+
+# calculates the area inside many sets of four corners (TL, TR, BL, BR) at
+# once, the same as cal_corner_area gives for each
+def cal_corner_areas(corners):
+    # walk round the corners in order, TL BL BR TR
+    quads = corners[:, [0, 2, 3, 1]].astype(np.int64)
+    x = quads[:, :, 0]
+    y = quads[:, :, 1]
+    cross = x * np.roll(y, -1, axis=1) - np.roll(x, -1, axis=1) * y
+    return np.abs(cross.sum(axis=1)) / 2.0
+
+# calculates the average width and height of many sets of four corners at
+# once (any shape ending in 4 corners by 2), the same as cal_avg_height_width
+# gives for each
+def cal_avg_height_width_batch(corners):
+    corners = corners.astype(np.float64)
+    TL = corners[..., 0, :]
+    TR = corners[..., 1, :]
+    BL = corners[..., 2, :]
+    BR = corners[..., 3, :]
+    top_side_length = cal_point_distances(TL, TR)
+    bot_side_length = cal_point_distances(BL, BR)
+    left_side_length = cal_point_distances(TL, BL)
+    right_side_length = cal_point_distances(TR, BR)
+    avg_height = (left_side_length + right_side_length)/2
+    avg_width = (top_side_length + bot_side_length)/2
+    return avg_width, avg_height
+
+# calculates the distance between each pair of points, like cal_point_distance.
+# np.hypot can differ from math.sqrt in the last bit, this doesn't
+def cal_point_distances(p, q):
+    difference = p - q
+    return np.sqrt((difference * difference).sum(axis=-1))
+
+# Chooses the two goals (of scores.survivors, rects are their bounding
+# rectangles) which make the best dual target. Every pair of the
+# PAIR_MAX_CANDIDATES largest is scored at once in a matrix. A pair has to
+# pass the target aspect ratio thresholds, like the two largest always had
+# to, and be side by side (not overlapping left to right). Its score (0-1)
+# is the PAIR_WEIGHTS weighted average of how close the target aspect ratio
+# is to the middle of its thresholds, how similar the goals' heights are,
+# how level they are and how far apart they are compared to their widths
+# (a goal width or more apart scores fully).
+# Returns (first, second, score) with first and second indexes into
+# survivors, first the larger goal, or None if no pair passes.
+def select_pair(scores, rects, selection_values):
+    survivors = scores.survivors
+    candidates = np.argsort(-scores.area[survivors], kind="mergesort")[:PAIR_MAX_CANDIDATES]
+    indexes = survivors[candidates]
+    corners = scores.corners[indexes].astype(np.int64)
+    width = scores.width[indexes]
+    height = scores.height[indexes]
+    count = len(indexes)
+
+    # the four outermost corners of the two goals together, like cal_corners
+    # finds them for the eight corners (the first goal's wins a tie)
+    x = corners[:, :, 0]
+    y = corners[:, :, 1]
+    corner_scores = np.stack([-x[:, 0] - y[:, 0], x[:, 1] - y[:, 1], -x[:, 2] + y[:, 2], x[:, 3] + y[:, 3]], axis=1)
+    first_wins = corner_scores[:, None, :] >= corner_scores[None, :, :]
+    target_corners = np.where(first_wins[..., None], corners[:, None], corners[None, :])
+    target_width, target_height = cal_avg_height_width_batch(target_corners)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        target_aspect = target_width / target_height
+    lower, upper = selection_values[5], selection_values[6]
+
+    box = np.array([rects[i] for i in candidates], dtype=np.float64)
+    left = box[:, 0]
+    right = box[:, 0] + box[:, 2]
+    gap = np.maximum(left[None, :] - right[:, None], left[:, None] - right[None, :])
+    center_y = corners[:, 0, 1] + height / 2
+    mean_height = (height[:, None] + height[None, :]) / 2
+    mean_width = (width[:, None] + width[None, :]) / 2
+
+    possible = (target_aspect > lower) & (target_aspect < upper) & (gap >= 0)
+    possible &= np.triu(np.ones((count, count), dtype=bool), 1) # each pair once
+    if not possible.any():
+        return None
+    aspect_score = 1 - np.abs(target_aspect - (lower + upper) / 2.0) / ((upper - lower) / 2.0)
+    height_score = np.minimum(height[:, None], height[None, :]) / np.maximum(height[:, None], height[None, :])
+    level_score = np.clip(1 - np.abs(center_y[:, None] - center_y[None, :]) / mean_height, 0, 1)
+    spacing_score = np.clip(gap / mean_width, 0, 1)
+    pair_scores = (PAIR_WEIGHTS[0] * aspect_score + PAIR_WEIGHTS[1] * height_score + PAIR_WEIGHTS[2] * level_score +\
+        PAIR_WEIGHTS[3] * spacing_score) / float(sum(PAIR_WEIGHTS))
+    pair_scores[~possible] = -1
+    first, second = np.unravel_index(np.argmax(pair_scores), pair_scores.shape)
+    return candidates[first], candidates[second], float(pair_scores[first, second])
+
 # takes a contour and finds the four outermost corners
 # returns their coordinates in an array
+# The corners are the points with the best score of -x-y (TL), +x-y (TR),
+# -x+y (BL) and +x+y (BR). argmax returns the first point with the best
+# score so ties are broken the same way as walking the points in order.
 def cal_corners(contour):
-    TL_corner = Corner()
-    TR_corner = Corner()
-    BL_corner = Corner()
-    BR_corner = Corner()
-    # go through each point and see if it is a better corner then the last
-    for point in contour:
-        x = point[0][0] # +ve is more right.
-        y = point[0][1] # +ve is more down
-        TL_corner.update_score(x, y, -x -y)
-        TR_corner.update_score(x, y, +x -y)
-        BL_corner.update_score(x, y, -x +y)
-        BR_corner.update_score(x, y, +x +y)
-    TL = TL_corner.xy
-    TR = TR_corner.xy
-    BL = BL_corner.xy
-    BR = BR_corner.xy
-    return [TL, TR, BL, BR]
+    points = np.asarray(contour).reshape(-1, 2)
+    if len(points) == 0:
+        return [[], [], [], []]
+    x = points[:, 0].astype(np.int64) # +ve is more right.
+    y = points[:, 1].astype(np.int64) # +ve is more down
+    diff = x - y
+    total = x + y
+    TL = points[np.argmin(total)]
+    TR = points[np.argmax(diff)]
+    BL = points[np.argmin(diff)]
+    BR = points[np.argmax(total)]
+    return [[TL[0], TL[1]], [TR[0], TR[1]], [BL[0], BL[1]], [BR[0], BR[1]]]
+
+# finds the four outermost corners of many contours at once
+# returns an array of shape (number of contours, 4, 2) ordered TL, TR, BL, BR
+def cal_corners_batch(contours):
+    corners = np.zeros((len(contours), 4, 2), dtype=np.int32)
+    if len(contours) == 0:
+        return corners
+    lengths = np.array([len(contour) for contour in contours])
+    if lengths.min() == 0:
+        raise ValueError("cal_corners_batch() given an empty contour")
+    points = np.concatenate([np.asarray(contour).reshape(-1, 2) for contour in contours])
+    # pad every contour out to the longest one so the corners can be found
+    # with a single argmax along each row. Padding is given the worst
+    # possible score so it is never chosen.
+    width = lengths.max()
+    rows = np.repeat(np.arange(len(contours)), lengths)
+    cols = np.arange(len(points)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    x = points[:, 0].astype(np.int64)
+    y = points[:, 1].astype(np.int64)
+    worst = np.iinfo(np.int64).min
+    scores = np.full((4, len(contours), width), worst, dtype=np.int64)
+    scores[0, rows, cols] = -x - y
+    scores[1, rows, cols] = x - y
+    scores[2, rows, cols] = -x + y
+    scores[3, rows, cols] = x + y
+    best = np.argmax(scores, axis=2) # first index of the best score for each corner
+    starts = np.cumsum(lengths) - lengths
+    for i in range(4):
+        corners[:, i] = points[starts + best[i]]
+    return corners
+
+# calculates the smallest rectangle (x, y, width, height) containing two rectangles
+def cal_union_rect(rect1, rect2):
+    x1 = min(rect1[0], rect2[0])
+    y1 = min(rect1[1], rect2[1])
+    x2 = max(rect1[0] + rect1[2], rect2[0] + rect2[2])
+    y2 = max(rect1[1] + rect1[3], rect2[1] + rect2[3])
+    return (x1, y1, x2 - x1, y2 - y1)
+
+# checks if a rectangle touches an edge of the roi
+# the target may continue outside of the roi so we can't keep tracking it
+def rect_touches_roi_edge(rect, roi):
+    if roi is None:
+        return False
+    x, y, w, h = rect
+    roi_x, roi_y, roi_w, roi_h = roi
+    return x <= roi_x or y <= roi_y or x + w >= roi_x + roi_w or y + h >= roi_y + roi_h
 
 # calculates the area inside a contour
 def cal_contour_area(contour):
@@ -443,6 +934,16 @@ def draw_age_fps(image, age, fps, oldest):
         "  Oldest: ~" + "%01.2f" %oldest
     cv2.putText(image, text, (0,50), cv2.FONT_HERSHEY_SIMPLEX, .75, (255,255,255), 2)
 
+# draws if the full image or only a roi was searched and the outline of the roi
+def draw_search_roi(image, roi, draw_extra):
+    if roi is None:
+        draw_text(image, "Search: Full", (0,75), (255,255,255))
+        return
+    draw_text(image, "Search: ROI", (0,75), (255,255,255))
+    if draw_extra:
+        x, y, w, h = roi
+        cv2.rectangle(image, (x,y), (x+w-1,y+h-1), (255,255,0), 1)
+
 # draws text (called by other draw functions)
 def draw_text(image, text, xy, colour=(0,0,255)):
     cv2.putText(image, text, (xy[0],xy[1]), cv2.FONT_HERSHEY_SIMPLEX, .75, colour, 2)
@@ -0,0 +1,86 @@
+#!/usr/bin/python
+'''
+Checks find_contours_pyramid (process_image.py) keeps the same goals as
+searching the whole mask at full resolution with find_contours. Run it
+after changing the pyramid search:
+
+    python pyramid_check.py [-n 400] [-s 1] [image.png ...]
+
+The masks are the ones selection_check.py uses (each image masked with
+MASK_VALUES, a crop of it searched like a tracking roi and -n random
+masks) and a goal sized strip and a gear sized strip drawn at every pixel
+alignment within a block. Every mask is searched with a pyramid factor of
+2 and 4 and the contours which pass ContourScores are compared with the
+goal (boiler) and gear selection values. Prints the masks which differ and
+how long each search took per mask, exits with 1 if any differ.
+'''
+
+import cv2
+import numpy as np
+import optparse
+import sys
+import time
+from process_image import *
+from selection_check import make_image_masks, make_random_masks, PROFILES, RANDOM_MASK_SIZE
+
+PYRAMID_FACTORS = [2, 4]
+# name: (width, height) of a strip the size of a real target
+STRIPS = [("goal strip", (60, 6)), ("gear strip", (9, 28))]
+STRIP_POSITION = (101, 57) # x, y of the first strip drawn, moved by up to a block
+
+# returns (name, mask, offset) for each strip at every alignment within a block of factor
+def make_strip_masks(factor):
+    masks = []
+    for name, (w, h) in STRIPS:
+        for dy in range(factor):
+            for dx in range(factor):
+                image_mask = np.zeros(RANDOM_MASK_SIZE, np.uint8)
+                x, y = STRIP_POSITION[0] + dx, STRIP_POSITION[1] + dy
+                cv2.rectangle(image_mask, (x, y), (x + w - 1, y + h - 1), 255, -1)
+                masks.append(("%s at +%d+%d" % (name, dx, dy), image_mask, (0, 0)))
+    return masks
+
+# the points of each contour which passes selection_values, in order
+def select(contours, selection_values):
+    scores = ContourScores(contours, selection_values)
+    return [contours[i].reshape(-1).tolist() for i in scores.survivors]
+
+# compares the goals kept from both searches on every mask, returns how many differed
+def compare(masks, factor, profile, selection_values):
+    different = 0
+    full_time = 0
+    pyramid_time = 0
+    for name, image_mask, offset in masks:
+        start = time.time()
+        full_contours = find_contours(image_mask, offset)
+        full_time += time.time() - start
+        start = time.time()
+        pyramid_contours = find_contours_pyramid(image_mask, factor, selection_values, offset)
+        pyramid_time += time.time() - start
+        expected = select(full_contours, selection_values)
+        got = select(pyramid_contours, selection_values)
+        if got != expected:
+            different += 1
+            print("x%d %s %s: full search kept %d goals, pyramid kept %d (%d of them the same)" % (factor, profile,\
+                name, len(expected), len(got), len([contour for contour in got if contour in expected])))
+    print("x%d %s: %d masks, %d different, full search %.2f ms, pyramid %.2f ms per mask" % (factor, profile,\
+        len(masks), different, full_time * 1000 / len(masks), pyramid_time * 1000 / len(masks)))
+    return different
+
+def main():
+    parser = optparse.OptionParser(usage = "usage: %prog [options] [image.png ...]")
+    parser.add_option("-n", "--random_masks", type = "int", dest = "random_masks", default = 400, help = "number of random masks to compare")
+    parser.add_option("-s", "--seed", type = "int", dest = "seed", default = 1, help = "seed for the random masks")
+    (options, args) = parser.parse_args()
+    image_names = args or ["2016.png", "lift_peg.png", "boiler.png", "Image_screenshot_21.04.2020.png"]
+
+    masks = make_image_masks(image_names) + make_random_masks(options.random_masks, options.seed)
+    different = 0
+    for factor in PYRAMID_FACTORS:
+        for profile, selection_values in PROFILES:
+            different += compare(masks + make_strip_masks(factor), factor, profile, selection_values)
+    if different:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
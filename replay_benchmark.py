@@ -0,0 +1,205 @@
+#!/usr/bin/python
+'''
+Replays images saved by ImageSaver (output/saved.N/capture_goal_%03d.png)
+through mask_image and Goal.find_goal without cameras, a screen or the robot.
+Every frame is run with both the goal (boiler) and gear selection values.
+
+Reports how long each stage took (percentiles in milliseconds), throughput,
+how often we had a lock and what was found in each frame. The report is
+written as JSON so runs from different versions can be compared:
+
+    python replay_benchmark.py -o before.json output/saved.0 output/saved.1
+    ... change some code ...
+    python replay_benchmark.py -o after.json --compare before.json output/saved.0 output/saved.1
+
+Frames are read from disk one at a time (not timed) so long recordings
+don't have to fit in memory. Without -o the comparison is printed to
+stderr so stdout is only the JSON report.
+'''
+
+import cv2
+import glob
+import json
+import numpy as np
+import optparse
+import os
+import sys
+import time
+from process_image import *
+from mask_engine import MaskEngine, MASK_STRATEGIES
+from detect_goals import GOAL_SELECTION_VALUES, GEAR_SELECTION_VALUES, MASK_VALUES
+
+REPORT_VERSION = 1
+PERCENTILES = [50, 90, 99]
+# name: (duel_target, selection_values)
+PROFILES = {
+    "goal": (False, GOAL_SELECTION_VALUES),
+    "gear": (True, GEAR_SELECTION_VALUES),
+}
+# results further apart than this are reported as different by --compare
+COMPARE_TOLERANCE = 0.01
+
+# find_goal prints every frame, this hides it while replaying
+class NullWriter(object):
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+# returns the saved images in the order they were written
+# The file numbers wrap around so the modification time is used instead
+def find_frames(directories):
+    frames = []
+    for directory in directories:
+        names = glob.glob(os.path.join(directory, "capture_*.png"))
+        names.sort(key=lambda name: (os.path.getmtime(name), name))
+        frames.extend(names)
+    return frames
+
+# summarises a list of times in seconds as milliseconds
+def cal_latency_stats(times):
+    times = np.array(times) * 1000
+    if len(times) == 0:
+        return {}
+    stats = {"mean": float(np.mean(times)), "max": float(np.max(times))}
+    for percentile in PERCENTILES:
+        stats["p%d" % percentile] = float(np.percentile(times, percentile))
+    return stats
+
+# runs every frame through one profile and returns its report, frames
+# which can't be read are skipped
+def replay_profile(frames, duel_target, selection_values, options):
+    mask_engine = MaskEngine(options.mask_strategy)
+    goal = Goal(options.pyramid_factor, options.use_components)
+    goal_history = GoalHistory(options.use_tracking)
+    stage_times = {"mask": [], "contours": [], "selection": [], "drawing": [], "total": []}
+    results = []
+    locks = 0
+    roi_frames = 0
+    unreadable = 0
+
+    stdout = sys.stdout
+    sys.stdout = NullWriter()
+    try:
+        for name in frames:
+            image = cv2.imread(name, 1)
+            if image is None:
+                unreadable += 1
+                continue
+            capture_timestamp = time.time()
+            roi = goal_history.get_search_roi(cal_image_size(image))
+            image_mask = mask_engine.mask(crop_image(image, roi), MASK_VALUES)
+            mask_time = time.time()
+            data, image = goal.find_goal(image, image_mask, goal_history, capture_timestamp,\
+                False, options.draw_extra, False, duel_target, selection_values, roi)
+            end_time = time.time()
+
+            stage_times["mask"].append(mask_time - capture_timestamp)
+            stage_times["contours"].append(goal.stage_times["contours"])
+            stage_times["selection"].append(goal.stage_times["selection"])
+            stage_times["drawing"].append(goal.stage_times["drawing"])
+            stage_times["total"].append(end_time - capture_timestamp)
+            lock, aim, distance, skew = parse_data(data)
+            locks += lock
+            roi_frames += roi is not None
+            results.append({"file": name, "lock": lock, "aim": aim, "distance": distance,\
+                "skew": skew, "roi": roi is not None})
+    finally:
+        sys.stdout = stdout
+
+    total_time = sum(stage_times["total"])
+    report = {
+        "stages": dict((stage, cal_latency_stats(times)) for stage, times in stage_times.items()),
+        "throughput_fps": len(results) / total_time if total_time > 0 else 0,
+        "lock_rate": float(locks) / len(results) if results else 0,
+        "roi_rate": float(roi_frames) / len(results) if results else 0,
+        "unreadable": unreadable,
+        "results": results,
+    }
+    return report
+
+# writes how a new report differs from an old one to out
+def compare_reports(old, new, out):
+    for profile in sorted(new["profiles"]):
+        if profile not in old["profiles"]:
+            continue
+        old_profile = old["profiles"][profile]
+        new_profile = new["profiles"][profile]
+        out.write("%s:\n" % profile)
+        for stage in sorted(new_profile["stages"]):
+            old_stats = old_profile["stages"].get(stage)
+            new_stats = new_profile["stages"][stage]
+            if not old_stats or not new_stats:
+                continue
+            out.write("  %-10s p50 %7.2f -> %7.2f ms  p90 %7.2f -> %7.2f ms\n" % (stage,\
+                old_stats["p50"], new_stats["p50"], old_stats["p90"], new_stats["p90"]))
+        out.write("  throughput %.1f -> %.1f fps  lock rate %.3f -> %.3f\n" % (old_profile["throughput_fps"],\
+            new_profile["throughput_fps"], old_profile["lock_rate"], new_profile["lock_rate"]))
+
+        old_results = dict((result["file"], result) for result in old_profile["results"])
+        different = 0
+        for result in new_profile["results"]:
+            old_result = old_results.get(result["file"])
+            if old_result is None:
+                continue
+            if old_result["lock"] != result["lock"] or\
+                    abs(old_result["aim"] - result["aim"]) > COMPARE_TOLERANCE or\
+                    abs(old_result["distance"] - result["distance"]) > COMPARE_TOLERANCE or\
+                    abs(old_result["skew"] - result["skew"]) > COMPARE_TOLERANCE:
+                different += 1
+                out.write("  different result for %s: %s -> %s\n" % (result["file"],\
+                    (old_result["lock"], old_result["aim"], old_result["distance"], old_result["skew"]),\
+                    (result["lock"], result["aim"], result["distance"], result["skew"])))
+        out.write("  %d frames with different results\n" % different)
+
+def main():
+    parser = optparse.OptionParser(usage = "usage: %prog [options] saved_dir [saved_dir ...]")
+    parser.add_option("-o", "--output", dest = "output", default = None, help = "write the JSON report to this file instead of stdout")
+    parser.add_option("-c", "--compare", dest = "compare", default = None, help = "JSON report from an earlier run to compare against")
+    parser.add_option("-P", "--profiles", dest = "profiles", default = "goal,gear", help = "comma separated profiles to run (goal, gear)")
+    parser.add_option("-t", "--use_tracking", action = "store_true", dest = "use_tracking", default = False, help = "replay with roi tracking")
+    parser.add_option("-p", "--pyramid_factor", type = "int", dest = "pyramid_factor", default = 1, help = "replay with a pyramid search")
+    parser.add_option("-n", "--use_components", action = "store_true", dest = "use_components", default = False, help = "replay with the connected components search")
+    parser.add_option("-m", "--mask_strategy", dest = "mask_strategy", default = "hsv", help = "one of %s" % ", ".join(MASK_STRATEGIES))
+    parser.add_option("-e", "--draw_extra", action = "store_true", dest = "draw_extra", default = False, help = "draw everything as if the live image was wanted")
+    (options, args) = parser.parse_args()
+    if not args:
+        parser.error("give at least one saved directory")
+
+    frames = find_frames(args)
+    if not frames:
+        parser.error("no capture_*.png images found in %s" % ", ".join(args))
+
+    report = {
+        "version": REPORT_VERSION,
+        "directories": args,
+        "frames": len(frames),
+        "options": {"use_tracking": options.use_tracking, "pyramid_factor": options.pyramid_factor,\
+            "use_components": options.use_components,\
+            "mask_strategy": options.mask_strategy, "draw_extra": options.draw_extra},
+        "profiles": {},
+    }
+    for profile in options.profiles.split(","):
+        duel_target, selection_values = PROFILES[profile]
+        report["profiles"][profile] = replay_profile(frames, duel_target, selection_values, options)
+
+    text = json.dumps(report, indent=1, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as output:
+            output.write(text)
+        for profile in sorted(report["profiles"]):
+            profile_report = report["profiles"][profile]
+            print("%s: %.1f fps, lock rate %.3f, total p50 %.2f ms p99 %.2f ms" % (profile,\
+                profile_report["throughput_fps"], profile_report["lock_rate"],\
+                profile_report["stages"]["total"]["p50"], profile_report["stages"]["total"]["p99"]))
+    else:
+        print(text)
+
+    if options.compare:
+        with open(options.compare) as old_report:
+            # keep stdout valid JSON when the report went there
+            compare_reports(json.load(old_report), report, sys.stdout if options.output else sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+#!/usr/bin/python
+'''
+Records frames into one preallocated, memory mapped ring file instead of
+writing a PNG file for every saved image (see image_saver.py). Encoding a
+640x480 PNG takes a long time on a pi and writing hundreds of small files
+is hard on the SD card. Writing a frame into the ring is a copy into
+memory, the kernel writes it out to the file in the background.
+
+Each frame can be kept raw (fastest, the most bytes to write), as a JPEG
+(lossy but small) or zlib compressed at its fastest level (lossless).
+
+The file is laid out as:
+    header     HEADER_DTYPE padded to HEADER_SIZE bytes
+    index      one INDEX_DTYPE entry per slot, when each frame was captured,
+               the camera it came from and the result we sent the robot
+    slots      slot_size bytes per frame, each starting on a page boundary
+Once all of the slots have been used the oldest one is written over.
+
+An entry's sequence is zeroed while its slot is being written, so a ring
+which was cut off part way through a write still reads back correctly.
+
+Run this file to turn a ring back into PNGs (which replay_benchmark.py can
+use) or a video after a match:
+    python ring_recorder.py -o output/exported output/saved.1/capture_goal.ring
+    python ring_recorder.py -v match.avi output/saved.1/capture_goal.ring
+'''
+
+import cv2
+import numpy as np
+import optparse
+import os
+import zlib
+from process_image import parse_data
+
+RING_MAGIC = "VRNG"
+RING_VERSION = 1
+RING_COMPRESSIONS = ["raw", "jpg", "zlib"]
+RING_JPEG_QUALITY = 95
+RING_ZLIB_LEVEL = 1 # fastest
+RING_FLUSH_EVERY = 30 # frames between asking the kernel to write the file out
+PAGE_SIZE = 4096
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([("magic", "S4"), ("version", "<u4"), ("slots", "<u4"), ("slot_size", "<u4"),\
+    ("height", "<u4"), ("width", "<u4"), ("channels", "<u4"), ("compression", "<u4"),\
+    ("next_slot", "<u4"), ("sequence", "<u8")])
+INDEX_DTYPE = np.dtype([("sequence", "<u8"), ("capture_timestamp", "<f8"), ("camera_id", "S8"),\
+    ("compression", "<u4"), ("length", "<u4"), ("lock", "<i4"), ("aim", "<f4"), ("distance", "<f4"),\
+    ("skew", "<f4")])
+EXPORT_VIDEO_FPS = 10 # used when the ring doesn't have enough frames to work it out
+
+# rounds size up to a whole number of pages
+def cal_page_size(size):
+    return (size + PAGE_SIZE - 1) // PAGE_SIZE * PAGE_SIZE
+
+class RingRecorder():
+    # creates a new ring for images of shape, or opens an existing one to
+    # read if shape is None
+    def __init__(self, path, shape = None, slots = 300, compression = "raw"):
+        self.path = path
+        self.writes = 0
+        if shape is not None:
+            self.create(path, shape, slots, compression)
+        else:
+            self.open(path)
+
+    def create(self, path, shape, slots, compression):
+        if compression not in RING_COMPRESSIONS:
+            raise ValueError("unknown compression %s, expected one of %s" % (compression, RING_COMPRESSIONS))
+        height, width, channels = shape
+        slot_size = cal_page_size(height * width * channels)
+        data_offset = cal_page_size(HEADER_SIZE + slots * INDEX_DTYPE.itemsize)
+        # the file is made its full size up front, it is never resized
+        with open(path, "wb") as ring_file:
+            ring_file.truncate(data_offset + slots * slot_size)
+        self.map_file(path, "r+", slots, slot_size, data_offset)
+        header = self.header
+        header["magic"] = RING_MAGIC
+        header["version"] = RING_VERSION
+        header["slots"] = slots
+        header["slot_size"] = slot_size
+        header["height"] = height
+        header["width"] = width
+        header["channels"] = channels
+        header["compression"] = RING_COMPRESSIONS.index(compression)
+
+    def open(self, path):
+        header = np.fromfile(path, HEADER_DTYPE, 1)[0]
+        if header["magic"] != RING_MAGIC or header["version"] != RING_VERSION:
+            raise ValueError("%s is not a version %d ring" % (path, RING_VERSION))
+        slots = int(header["slots"])
+        data_offset = cal_page_size(HEADER_SIZE + slots * INDEX_DTYPE.itemsize)
+        self.map_file(path, "r", slots, int(header["slot_size"]), data_offset)
+
+    def map_file(self, path, mode, slots, slot_size, data_offset):
+        self.memory = np.memmap(path, np.uint8, mode)
+        self.header = self.memory[:HEADER_DTYPE.itemsize].view(HEADER_DTYPE)[0]
+        self.index = self.memory[HEADER_SIZE:HEADER_SIZE + slots * INDEX_DTYPE.itemsize].view(INDEX_DTYPE)
+        self.slots = self.memory[data_offset:data_offset + slots * slot_size].reshape(slots, slot_size)
+
+    def get_shape(self):
+        return (int(self.header["height"]), int(self.header["width"]), int(self.header["channels"]))
+
+    # writes image into the oldest slot, data is the text we sent the robot
+    # returns False if the image isn't the size the ring was made for
+    def write(self, image, capture_timestamp, camera_id, data):
+        if image.shape != self.get_shape():
+            return False
+        header = self.header
+        slot = int(header["next_slot"])
+        entry = self.index[slot]
+        entry["sequence"] = 0 # the slot is being written
+
+        compression = int(header["compression"])
+        encoded = None
+        if RING_COMPRESSIONS[compression] == "jpg":
+            retval, encoded = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, RING_JPEG_QUALITY])
+        elif RING_COMPRESSIONS[compression] == "zlib":
+            encoded = np.frombuffer(zlib.compress(np.ascontiguousarray(image).data, RING_ZLIB_LEVEL), np.uint8)
+        if encoded is None or encoded.size > self.slots.shape[1]:
+            compression = RING_COMPRESSIONS.index("raw")
+            encoded = image
+        length = encoded.size
+        self.slots[slot, :length] = encoded.reshape(-1)
+
+        if data:
+            entry["lock"], entry["aim"], entry["distance"], entry["skew"] = parse_data(data)
+        else:
+            entry["lock"] = entry["aim"] = entry["distance"] = entry["skew"] = 0
+        entry["capture_timestamp"] = capture_timestamp or 0
+        entry["camera_id"] = camera_id or ""
+        entry["compression"] = compression
+        entry["length"] = length
+        header["sequence"] += 1
+        entry["sequence"] = header["sequence"]
+        header["next_slot"] = (slot + 1) % len(self.index)
+
+        self.writes += 1
+        if self.writes % RING_FLUSH_EVERY == 0:
+            self.memory.flush()
+        return True
+
+    # returns the slots which have been written, oldest first
+    def get_slots_in_order(self):
+        written = np.flatnonzero(self.index["sequence"])
+        return written[np.argsort(self.index["sequence"][written])]
+
+    # returns the index entry and image stored in slot
+    def read(self, slot):
+        entry = self.index[slot]
+        data = self.slots[slot, :int(entry["length"])]
+        compression = RING_COMPRESSIONS[int(entry["compression"])]
+        if compression == "jpg":
+            image = cv2.imdecode(data, 1)
+        elif compression == "zlib":
+            image = np.frombuffer(zlib.decompress(data.tostring()), np.uint8).reshape(self.get_shape())
+        else:
+            image = data.reshape(self.get_shape()).copy()
+        return entry, image
+
+    def close(self):
+        self.memory.flush()
+        del self.memory
+
+# writes every frame in the ring as a PNG named like the ones ImageSaver
+# writes, oldest first so replay_benchmark.py reads them in order
+def export_pngs(ring, out_dir):
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    for number, slot in enumerate(ring.get_slots_in_order()):
+        entry, image = ring.read(slot)
+        filename = os.path.join(out_dir, "capture_%s_%06d.png" % (entry["camera_id"] or "ring", number))
+        cv2.imwrite(filename, image)
+        print("%s %.3f lock %d aim %f distance %f skew %f" % (filename, entry["capture_timestamp"],\
+            entry["lock"], entry["aim"], entry["distance"], entry["skew"]))
+
+# writes every frame in the ring to a video at the rate they were captured
+def export_video(ring, filename):
+    slots = ring.get_slots_in_order()
+    timestamps = ring.index["capture_timestamp"][slots]
+    fps = EXPORT_VIDEO_FPS
+    if len(timestamps) > 1 and np.median(np.diff(timestamps)) > 0:
+        fps = 1.0 / np.median(np.diff(timestamps))
+    height, width, channels = ring.get_shape()
+    video = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*"MJPG"), fps, (width, height))
+    for slot in slots:
+        entry, image = ring.read(slot)
+        video.write(image)
+    video.release()
+    print("Wrote %d frames to %s at %.1f fps" % (len(slots), filename, fps))
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage = "usage: %prog [options] ring_file")
+    parser.add_option("-o", "--out_dir", dest = "out_dir", default = None, help = "write each frame as a PNG into this directory")
+    parser.add_option("-v", "--video", dest = "video", default = None, help = "write the frames to this video file (.avi)")
+    (options, args) = parser.parse_args()
+    if len(args) != 1 or not (options.out_dir or options.video):
+        parser.error("give one ring file and -o and/or -v")
+    ring = RingRecorder(args[0])
+    print("%s: %d of %d slots written, %s" % (args[0], len(ring.get_slots_in_order()), len(ring.index),\
+        RING_COMPRESSIONS[int(ring.header["compression"])]))
+    if options.out_dir:
+        export_pngs(ring, options.out_dir)
+    if options.video:
+        export_video(ring, options.video)
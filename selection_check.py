@@ -0,0 +1,238 @@
+#!/usr/bin/python
+'''
+Checks ContourScores (process_image.py) picks the same contours with the
+same values as the loop find_goal used to check each contour with one by
+one, a copy of which is kept here as select_one_by_one along with the
+cal_corners it used (baseline_cal_corners), so the check doesn't depend
+on the code it checks. ContourScores is checked with its arrays and with
+its one by one fallback for a few contours. Run it after changing
+ContourScores or the cal_*_batch functions:
+
+    python selection_check.py [-n 300] [-s 1] [image.png ...]
+
+The masks compared are each image masked with MASK_VALUES, a crop of it
+searched like a tracking roi, and -n random masks of filled and hollow
+rectangles, circles, polygons and speckle. Every mask is checked with both
+the goal (boiler) and gear selection values. Prints the masks which differ
+and exits with 1 if any do.
+
+With -b it times the old loop and ContourScores on frames with a growing
+number of goal sized blobs and specks instead, to choose
+CONTOUR_SCORES_MIN_BATCH.
+'''
+
+import cv2
+import numpy as np
+import optparse
+import sys
+import time
+from process_image import *
+from detect_goals import GOAL_SELECTION_VALUES, GEAR_SELECTION_VALUES, MASK_VALUES
+
+RANDOM_MASK_SIZE = (240, 320) # rows, columns
+ROI = (101, 37, 399, 263) # x, y, width, height of the crop searched like a tracking roi
+SPECKLE_FRACTION = 0.01 # of the pixels of a random mask, set to look like noise
+# name: selection_values
+PROFILES = [("goal", GOAL_SELECTION_VALUES), ("gear", GEAR_SELECTION_VALUES)]
+# name: min_batch, ContourScores always uses its arrays or never does
+CONTOUR_SCORES_PATHS = [("ContourScores", 0), ("ContourScores one by one", sys.maxint)]
+BENCHMARK_BLOBS = [0, 1, 2, 4, 8, 16, 32, 64] # goal sized blobs in each benchmark frame
+BENCHMARK_SPECKS = [0, 50, 500] # single pixels of noise in each benchmark frame
+BENCHMARK_SIZE = (480, 640) # rows, columns
+
+# one of the corners of a contour as cal_corners found them before ContourScores
+class Corner():
+    def __init__(self):
+        self.xy = []
+        self.score = -10000
+    def update_score(self, X, Y, score):
+        if score > self.score:
+            self.xy = [X,Y]
+            self.score = score
+
+# cal_corners as it was before ContourScores
+def baseline_cal_corners(contour):
+    TL_corner = Corner()
+    TR_corner = Corner()
+    BL_corner = Corner()
+    BR_corner = Corner()
+    # go through each point and see if it is a better corner then the last
+    for point in contour:
+        x = point[0][0] # +ve is more right.
+        y = point[0][1] # +ve is more down
+        TL_corner.update_score(x, y, -x -y)
+        TR_corner.update_score(x, y, +x -y)
+        BL_corner.update_score(x, y, -x +y)
+        BR_corner.update_score(x, y, +x +y)
+    return [TL_corner.xy, TR_corner.xy, BL_corner.xy, BR_corner.xy]
+
+# the selection find_goal did before ContourScores, returns the indexes of
+# the contours which pass, their (area, corners, corner_area, width,
+# height, aspect_ratio) and how many each check rejected
+def select_one_by_one(contours, selection_values):
+    survivors = []
+    values = []
+    rejections = {}
+    for i, contour in enumerate(contours):
+        # If the contour is too small then ignore it
+        area = cal_contour_area(contour)
+        if area < selection_values[0]:
+            rejections["size"] = rejections.get("size", 0) + 1
+            continue
+
+        # If there isn't a significant portion of the area of the contour's corners then it cant be a U shape
+        corners = baseline_cal_corners(contour)
+        corner_area = cal_corner_area(corners)
+        if corner_area == 0:
+            rejections["corner_area"] = rejections.get("corner_area", 0) + 1
+            continue
+        if area/corner_area < selection_values[1] or area/corner_area > selection_values[2]:
+            rejections["fullness"] = rejections.get("fullness", 0) + 1
+            continue
+
+        # If it has a completly incorrect aspect ratio then ignore it
+        avg_width, avg_height = cal_avg_height_width(corners)
+        aspect_ratio = cal_aspect_ratio(avg_width, avg_height)
+        if aspect_ratio < selection_values[3] or aspect_ratio > selection_values[4]:
+            rejections["aspect"] = rejections.get("aspect", 0) + 1
+            continue
+
+        survivors.append(i)
+        values.append((area, np.asarray(corners).tolist(), corner_area, avg_width, avg_height, aspect_ratio))
+    return survivors, values, rejections
+
+# the same as select_one_by_one using ContourScores
+def select_at_once(contours, selection_values, min_batch = CONTOUR_SCORES_MIN_BATCH):
+    scores = ContourScores(contours, selection_values, min_batch)
+    values = []
+    for i in scores.survivors:
+        values.append((scores.area[i], scores.corners[i].tolist(), scores.corner_area[i], scores.width[i],\
+            scores.height[i], scores.aspect_ratio[i]))
+    return list(scores.survivors), values, scores.rejections
+
+# returns (name, mask, offset) for each image and a crop of it
+def make_image_masks(image_names):
+    masks = []
+    for image_name in image_names:
+        image = cv2.imread(image_name, 1)
+        if image is None:
+            print("Unable to read %s" % image_name)
+            continue
+        image_mask = mask_image(image, MASK_VALUES)
+        masks.append((image_name, image_mask, (0, 0)))
+        x, y, w, h = ROI
+        masks.append(("%s roi" % image_name, crop_image(image_mask, ROI), (x, y)))
+    return masks
+
+# returns (name, mask, offset) for count random masks
+def make_random_masks(count, seed):
+    random = np.random.RandomState(seed)
+    rows, columns = RANDOM_MASK_SIZE
+    masks = []
+    for n in range(count):
+        image_mask = np.zeros(RANDOM_MASK_SIZE, np.uint8)
+        for k in range(random.randint(1, 40)):
+            x, y = random.randint(0, columns), random.randint(0, rows)
+            shape = random.randint(4)
+            if shape == 0:
+                cv2.rectangle(image_mask, (x, y), (x + random.randint(1, 120), y + random.randint(1, 60)), 255, -1)
+            elif shape == 1:
+                cv2.rectangle(image_mask, (x, y), (x + random.randint(3, 120), y + random.randint(3, 60)), 255,\
+                    random.randint(1, 6))
+            elif shape == 2:
+                cv2.circle(image_mask, (x, y), random.randint(1, 40), 255, random.choice([-1, 1, 3]))
+            else:
+                points = random.randint(-60, 60, (random.randint(3, 7), 2)) + (x, y)
+                cv2.fillPoly(image_mask, [points.astype(np.int32)], 255)
+        image_mask[random.rand(rows, columns) < SPECKLE_FRACTION] = 255
+        masks.append(("random %d" % n, image_mask, (0, 0)))
+    return masks
+
+# compares the old selection with both ContourScores paths on every mask,
+# returns how many differed
+def compare(masks, profile, selection_values):
+    different = 0
+    for name, image_mask, offset in masks:
+        contours = find_contours(image_mask, offset)
+        expected = select_one_by_one(contours, selection_values)
+        for path, min_batch in CONTOUR_SCORES_PATHS:
+            got = select_at_once(contours, selection_values, min_batch)
+            if got[0] != expected[0]:
+                different += 1
+                print("%s %s: the old loop kept %s, %s kept %s" % (profile, name, expected[0], path, got[0]))
+            elif got[1] != expected[1]:
+                different += 1
+                wrong = [i for i, a, b in zip(got[0], expected[1], got[1]) if a != b]
+                print("%s %s: %s gave different values for contours %s" % (profile, name, path, wrong))
+            elif got[2] != expected[2]:
+                different += 1
+                print("%s %s: the old loop rejected %s, %s rejected %s" % (profile, name, expected[2], path, got[2]))
+    print("%s: %d masks, %d different" % (profile, len(masks), different))
+    return different
+
+# returns the mean time of calling function in milliseconds
+def time_calls(function, repeat):
+    function()
+    start = time.time()
+    for i in range(repeat):
+        function()
+    return (time.time() - start) * 1000 / repeat
+
+# the old loop as find_goal would run it now, with the current cal_corners
+def select_old_loop(contours, selection_values):
+    for contour in contours:
+        area = cal_contour_area(contour)
+        if area < selection_values[0]:
+            continue
+        corners = cal_corners(contour)
+        corner_area = cal_corner_area(corners)
+        if corner_area == 0:
+            continue
+        if area/corner_area < selection_values[1] or area/corner_area > selection_values[2]:
+            continue
+        avg_width, avg_height = cal_avg_height_width(corners)
+        aspect_ratio = cal_aspect_ratio(avg_width, avg_height)
+
+# times the old loop and ContourScores on frames with more and more blobs
+def benchmark(seed, repeat):
+    random = np.random.RandomState(seed)
+    rows, columns = BENCHMARK_SIZE
+    selection_values = GOAL_SELECTION_VALUES
+    print("blobs specks contours  passing size  old loop  ContourScores  arrays only")
+    for blobs in BENCHMARK_BLOBS:
+        for specks in BENCHMARK_SPECKS:
+            image_mask = np.zeros(BENCHMARK_SIZE, np.uint8)
+            for k in range(blobs):
+                x, y = random.randint(0, columns - 40), random.randint(0, rows - 30)
+                cv2.rectangle(image_mask, (x, y), (x + random.randint(15, 40), y + random.randint(8, 30)), 255, -1)
+            image_mask[random.randint(0, rows, specks), random.randint(0, columns, specks)] = 255
+            contours = find_contours(image_mask)
+            passing = np.count_nonzero(cal_contour_areas(contours) >= selection_values[0])
+            old_time = time_calls(lambda: select_old_loop(contours, selection_values), repeat)
+            scores_time = time_calls(lambda: ContourScores(contours, selection_values), repeat)
+            arrays_time = time_calls(lambda: ContourScores(contours, selection_values, 0), repeat)
+            print("%5d %6d %8d %13d %8.3f ms %11.3f ms %9.3f ms" % (blobs, specks, len(contours), passing,\
+                old_time, scores_time, arrays_time))
+
+def main():
+    parser = optparse.OptionParser(usage = "usage: %prog [options] [image.png ...]")
+    parser.add_option("-n", "--random_masks", type = "int", dest = "random_masks", default = 300, help = "number of random masks to compare")
+    parser.add_option("-s", "--seed", type = "int", dest = "seed", default = 1, help = "seed for the random masks")
+    parser.add_option("-b", "--benchmark", action = "store_true", dest = "benchmark", default = False, help = "time the old loop and ContourScores instead")
+    (options, args) = parser.parse_args()
+    if options.benchmark:
+        benchmark(options.seed, 200)
+        return
+    image_names = args or ["2016.png", "lift_peg.png", "boiler.png", "Image_screenshot_21.04.2020.png"]
+
+    masks = make_image_masks(image_names) + make_random_masks(options.random_masks, options.seed)
+    if not masks:
+        parser.error("nothing to compare")
+    different = 0
+    for profile, selection_values in PROFILES:
+        different += compare(masks, profile, selection_values)
+    if different:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
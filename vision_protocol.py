@@ -0,0 +1,160 @@
+#!/usr/bin/python
+'''
+A fixed size binary message for sending results to the robot, instead of
+the "lock,aim,distance,skew,age\n" text GoalHistory.cal_data makes, so the
+robot doesn't have to parse floats out of text and knows which frame each
+result came from.
+
+Every message starts with:
+    magic               2 bytes "VR"
+    version             1 byte  PROTOCOL_VERSION
+    type                1 byte  RESULT_MESSAGE, PING_MESSAGE or PONG_MESSAGE
+and is in network byte order. A result is RESULT_STRUCT.size bytes:
+    header
+    sequence            uint32  counts up by one for every message sent
+    capture_timestamp   double  seconds, our clock, when the frame was captured
+    robot_timestamp     double  seconds, the robot's clock, when the frame was
+                                captured. 0 until our clock is synced with the
+                                robot's (see clock_sync.py)
+    lock                uint8   1 if we can see the target
+    aim                 float
+    distance            float
+    skew                float
+    age                 float   seconds between capture and sending
+
+To sync the clocks we send a ping (PING_STRUCT) over the TCP connection:
+    header
+    ping_id             uint32
+    send_time           double  our clock when the ping was sent
+and the robot answers straight away with a pong (PONG_STRUCT):
+    header
+    ping_id             uint32  copied from the ping
+    send_time           double  copied from the ping
+    robot_receive_time  double  the robot's clock when the ping arrived
+    robot_send_time     double  the robot's clock when the pong was sent
+Camera ids the robot sends are single characters which never start with
+the magic, so both can be sent over the same connection.
+
+The robot should ignore any message with a sequence no newer than the last
+one it used, over UDP (see ControlConnection) this means the newest result
+always wins even if packets arrive out of order.
+
+Run this file to listen for results over UDP like the robot would:
+    python vision_protocol.py [port]
+'''
+
+import socket
+import struct
+import sys
+import time
+
+PROTOCOL_FORMATS = ["text", "binary"]
+PROTOCOL_MAGIC = "VR"
+PROTOCOL_VERSION = 2
+RESULT_MESSAGE = 1
+PING_MESSAGE = 2
+PONG_MESSAGE = 3
+HEADER_SIZE = 4
+RESULT_STRUCT = struct.Struct("!2sBBIddBffff")
+PING_STRUCT = struct.Struct("!2sBBId")
+PONG_STRUCT = struct.Struct("!2sBBIddd")
+MESSAGE_STRUCTS = {RESULT_MESSAGE: RESULT_STRUCT, PING_MESSAGE: PING_STRUCT, PONG_MESSAGE: PONG_STRUCT}
+
+# The result of processing one frame
+class VisionResult():
+    def __init__(self, capture_timestamp = 0, lock = 0, aim = 0, distance = 0, skew = 0, age = 0, sequence = 0,\
+            robot_timestamp = 0):
+        self.sequence = sequence
+        self.capture_timestamp = capture_timestamp
+        self.robot_timestamp = robot_timestamp
+        self.lock = lock
+        self.aim = aim
+        self.distance = distance
+        self.skew = skew
+        self.age = age
+
+    def pack(self):
+        return RESULT_STRUCT.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, RESULT_MESSAGE, self.sequence,\
+            self.capture_timestamp, self.robot_timestamp, self.lock, self.aim, self.distance, self.skew, self.age)
+
+    # the text format the robot has always used
+    def to_text(self):
+        return "%d,%f,%f,%f,%f\n" % (self.lock, self.aim, self.distance, self.skew, self.age)
+
+    def __repr__(self):
+        return "VisionResult(%d, %f, robot %f, lock %d, aim %f, distance %f, skew %f, age %f)" % (self.sequence,\
+            self.capture_timestamp, self.robot_timestamp, self.lock, self.aim, self.distance, self.skew, self.age)
+
+# returns the size of the binary message at the start of buffer, 0 if
+# buffer doesn't start with one or None if more bytes are needed to tell
+def cal_message_size(buffer):
+    if len(buffer) < HEADER_SIZE:
+        if PROTOCOL_MAGIC.startswith(buffer[:len(PROTOCOL_MAGIC)]):
+            return None
+        return 0
+    if not buffer.startswith(PROTOCOL_MAGIC):
+        return 0
+    message_struct = MESSAGE_STRUCTS.get(ord(buffer[3]))
+    if message_struct is None:
+        return 0
+    return message_struct.size
+
+# returns the type of a whole binary message or None if it isn't one
+def get_message_type(message):
+    if len(message) < HEADER_SIZE:
+        return None
+    magic, version, message_type = struct.unpack("!2sBB", message[:HEADER_SIZE])
+    if magic != PROTOCOL_MAGIC or version != PROTOCOL_VERSION or message_type not in MESSAGE_STRUCTS:
+        return None
+    if len(message) != MESSAGE_STRUCTS[message_type].size:
+        return None
+    return message_type
+
+# turns a message back into a VisionResult, returns None if it isn't one
+def unpack_result(message):
+    if get_message_type(message) != RESULT_MESSAGE:
+        return None
+    magic, version, message_type, sequence, capture_timestamp, robot_timestamp, lock, aim, distance, skew, age =\
+        RESULT_STRUCT.unpack(message)
+    return VisionResult(capture_timestamp, lock, aim, distance, skew, age, sequence, robot_timestamp)
+
+def pack_ping(ping_id, send_time):
+    return PING_STRUCT.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, PING_MESSAGE, ping_id, send_time)
+
+# returns (ping_id, send_time) or None if message isn't a ping
+def unpack_ping(message):
+    if get_message_type(message) != PING_MESSAGE:
+        return None
+    return PING_STRUCT.unpack(message)[3:]
+
+def pack_pong(ping_id, send_time, robot_receive_time, robot_send_time):
+    return PONG_STRUCT.pack(PROTOCOL_MAGIC, PROTOCOL_VERSION, PONG_MESSAGE, ping_id, send_time,\
+        robot_receive_time, robot_send_time)
+
+# returns (ping_id, send_time, robot_receive_time, robot_send_time) or None
+# if message isn't a pong
+def unpack_pong(message):
+    if get_message_type(message) != PONG_MESSAGE:
+        return None
+    return PONG_STRUCT.unpack(message)[3:]
+
+# Test only code, prints the results sent to us over UDP, skipping stale ones
+if __name__ == "__main__":
+    port = 5801
+    if len(sys.argv) > 1:
+        port = int(sys.argv[1])
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("", port))
+    print("listening for results on udp port %d" % port)
+    last = VisionResult(sequence = -1)
+    while True:
+        result = unpack_result(s.recv(RESULT_STRUCT.size))
+        if result is None:
+            print("not a result")
+            continue
+        # the sequence starts again if the vision script restarts
+        if result.sequence <= last.sequence and result.capture_timestamp <= last.capture_timestamp:
+            print("stale result %d" % result.sequence)
+            continue
+        last = result
+        print("%r, %.1f ms old when received" % (result, (time.time() - result.capture_timestamp) * 1000))